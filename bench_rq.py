@@ -0,0 +1,66 @@
+"""Measure the round-trip time of the requests sent by HtPlatform to the workers.
+
+A fake worker (an rq SimpleWorker listening to a dedicated queue) is started in a separate process.
+redis-server must be running (see start_redis.py).
+"""
+
+import argparse
+import tempfile
+import time
+from multiprocessing import Process
+from pathlib import Path
+
+from redis import Redis
+from rq import Queue, SimpleWorker
+
+from hypertrainer.htplatform import HtPlatform
+from hypertrainer.utils import read_config
+
+bench_queue_name = 'hypertrainer_bench'
+
+
+def work(redis_port):
+    SimpleWorker([bench_queue_name], connection=Redis(port=redis_port)).work(logging_level='WARNING')
+
+
+def measure(name, fn, num_requests):
+    fn()  # Warmup
+    durations = []
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    print('{:<16} median {:7.1f} ms   max {:7.1f} ms'.format(
+        name, 1000 * durations[len(durations) // 2], 1000 * durations[-1]))
+
+
+class FakeTask:
+    def __init__(self, output_path):
+        self.hostname = bench_queue_name
+        self.output_path = output_path
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=50, help='number of requests of each type')
+    args = ap.parse_args()
+
+    redis_port = read_config()['ht_platform']['redis_port']
+
+    platform = HtPlatform()
+    platform.worker_hostnames = [bench_queue_name]
+    platform.worker_queues = {bench_queue_name: Queue(name=bench_queue_name, connection=platform.redis_conn)}
+
+    worker_process = Process(target=work, args=(redis_port,))
+    worker_process.start()
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            (Path(tmpdir) / 'out.txt').write_text('x' * 10000)
+            task = FakeTask(tmpdir)
+
+            measure('ping_workers', platform.ping_workers, args.n)
+            measure('get_jobs_info', platform._get_info_dict_for_each_worker, args.n)
+            measure('get_logs', lambda: platform.fetch_logs(task), args.n)
+    finally:
+        worker_process.terminate()
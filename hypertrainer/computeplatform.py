@@ -1,7 +1,15 @@
 from abc import ABC, abstractmethod
+from typing import List
 
 
 class ComputePlatform(ABC):
+    # If True, update_tasks sets the progress of the active tasks (see Task.set_progress), so that the progress logs do
+    # not have to be fetched for listing the tasks
+    summarizes_progress = False
+    # If True, the platform writes the statuses of its tasks to the db itself, e.g. from a supervisor thread; the status
+    # set by update_tasks is then not written by the ExperimentManager, so that it cannot overwrite a newer one
+    records_statuses = False
+
     @abstractmethod
     def submit(self, task, resume=False) -> str:
         """Setup and submit a task and return the plaform specific task id.
@@ -12,8 +20,15 @@ class ComputePlatform(ABC):
         """
         pass
 
+    def submit_many(self, tasks, resume=False) -> List[str]:
+        """Submit several tasks, and return their platform specific ids.
+
+        Platforms can override this to submit the tasks in bulk.
+        """
+        return [self.submit(t, resume) for t in tasks]
+
     @abstractmethod
-    def fetch_logs(self, task, keys=None):
+    def fetch_logs(self, task, keys=None, offsets=None, max_bytes=None, starts=None):
         """Return a dict of logs.
 
         Example: {
@@ -21,6 +36,16 @@ class ComputePlatform(ABC):
             'err': '...',
             'metric_loss': '...'
         }
+
+        If keys is given, only the logs whose name matches one of the keys must be returned. A key is either a log
+        name (e.g. 'progress') or a glob pattern (e.g. 'metric_*').
+
+        If offsets is given (a dict mapping log names to byte offsets), only the data appended after each offset must
+        be returned, and offsets must be updated in place with the new positions. In that case:
+        - If max_bytes is given, at most the last max_bytes of the out and err logs must be returned.
+        - If starts is given, it must be filled with the offset at which the returned data of each log starts.
+
+        See utils.read_logs().
         """
         pass
 
@@ -32,6 +57,11 @@ class ComputePlatform(ABC):
         """
         pass
 
+    def cancel_many(self, tasks):
+        """Cancel several tasks. Platforms can override this to cancel the tasks in bulk."""
+        for t in tasks:
+            self.cancel(t)
+
     @abstractmethod
     def update_tasks(self, tasks):
         """Request the platform to update the specified tasks.
@@ -50,3 +80,8 @@ class ComputePlatform(ABC):
         This must remove the task from any database, and delete the output folder of the task.
         """
         pass
+
+    def delete_many(self, tasks):
+        """Delete several tasks. Platforms can override this to delete the tasks in bulk."""
+        for t in tasks:
+            self.delete(t)
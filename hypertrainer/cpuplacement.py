@@ -0,0 +1,143 @@
+import math
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from hypertrainer.utils import hypertrainer_home, read_config, gpu_numa_nodes, PidFile, _flock
+
+numa_nodes_path = Path('/sys/devices/system/node')
+cpu_locks_path = hypertrainer_home / 'cpu_locks'
+
+
+class CpuLock(PidFile):
+    """Claim on a cpu, shared by the processes of the host like the GpuLocks"""
+
+    # Keep the file, so that two processes cannot both hold a lock on it (one of them on the unlinked file)
+    remove_on_release = False
+
+    def __init__(self, cpu: int):
+        self.cpu = cpu
+        cpu_locks_path.mkdir(exist_ok=True)
+        super().__init__(cpu_locks_path / f'cpu_{cpu}.lock')
+
+
+class CpuLockManager:
+    """Gives each task a set of cpus which is disjoint from the sets of the other tasks of the host.
+
+    The cpus of a task are taken from a single NUMA node if possible, so that its processes share the memory of the
+    node: the node closest to its gpus, otherwise the one on which they fit most tightly.
+    """
+
+    allocation_lock_path = hypertrainer_home / 'cpu_allocation.lock'
+
+    def __init__(self, nodes: Dict[int, List[int]] = None):
+        """nodes: {node: [cpu, ...]}. Default: the NUMA nodes of the host, restricted to the cpus of this process."""
+
+        if nodes is None:
+            allowed = os.sched_getaffinity(0)
+            nodes = {node: [cpu for cpu in cpus if cpu in allowed] for node, cpus in read_numa_nodes().items()}
+        self.nodes = {node: cpus for node, cpus in nodes.items() if cpus}
+
+    def try_acquire_cpus(self, num_cpus: int, gpu_ids: Sequence[str] = ()) -> Optional[List[CpuLock]]:
+        """Acquire num_cpus cpus if they are free now, otherwise return None. The CpuLocks must be released when the
+        task is done.
+        """
+
+        preferred_node = _closest_node(gpu_ids) if gpu_ids else None
+        with _flock(self.allocation_lock_path):  # Only one process at a time tries to allocate
+            free = {node: [lock for lock in map(CpuLock, cpus) if lock.try_acquire()]
+                    for node, cpus in self.nodes.items()}
+            chosen = choose_cpus(free, num_cpus, preferred_node)
+            for locks in free.values():
+                for lock in locks:
+                    if lock not in chosen:
+                        lock.release()
+        return chosen or None
+
+
+def claim_cpus(num_cpus: float, gpu_ids: Sequence[str] = ()) -> List[CpuLock]:
+    """Claim cpus for a task, if the placement is enabled in the config. Example: cpu_placement: {enabled: true}
+
+    Empty if the placement is disabled, or if there are not enough free cpus; the task is then not pinned. The task is
+    pinned to the cpus of the returned locks when it is started (see start_script).
+    """
+
+    if not (read_config().get('cpu_placement') or {}).get('enabled', False):
+        return []
+    num_cpus = max(1, math.ceil(num_cpus))
+    cpu_locks = CpuLockManager().try_acquire_cpus(num_cpus, gpu_ids)
+    if cpu_locks is None:
+        print(f'There are less than {num_cpus} free cpus: the task is not pinned')
+        return []
+    return cpu_locks
+
+
+def reclaim_cpus(pid: int) -> List[CpuLock]:
+    """Claim again the cpus to which a running process is pinned, e.g. when the server re-attaches to it"""
+
+    try:
+        cpus = os.sched_getaffinity(pid)
+    except OSError:
+        return []  # Gone
+    if cpus >= os.sched_getaffinity(0):
+        return []  # Not pinned
+    cpu_locks = [CpuLock(cpu) for cpu in sorted(cpus)]
+    for cpu_lock in cpu_locks:
+        if not cpu_lock.try_acquire():
+            print(f'Cpu {cpu_lock.cpu} of process {pid} has been claimed by another process')
+    return [lock for lock in cpu_locks if lock.is_locked]
+
+
+def read_numa_nodes(nodes_path: Path = numa_nodes_path) -> Dict[int, List[int]]:
+    """Cpus of each NUMA node: {node: [cpu, ...]}. One node with all the cpus, if the topology is not available."""
+
+    nodes = {}
+    for node_path in nodes_path.glob('node[0-9]*'):
+        try:
+            nodes[int(node_path.name[len('node'):])] = parse_cpu_list((node_path / 'cpulist').read_text())
+        except OSError:
+            continue
+    return nodes or {0: sorted(os.sched_getaffinity(0))}
+
+
+def parse_cpu_list(cpu_list: str) -> List[int]:
+    """Example: '0-3,8' -> [0, 1, 2, 3, 8]"""
+
+    cpus = []
+    for part in cpu_list.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += range(int(first), int(last) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def choose_cpus(free: Dict[int, list], num_cpus: int, preferred_node: int = None) -> list:
+    """Choose num_cpus among the free cpus of each node, {node: [cpu, ...]}. Empty if there are not enough.
+
+    A single node is used if possible: the preferred node, otherwise the one with the fewest free cpus, so that the
+    nodes with more free cpus remain available for the larger tasks. Otherwise the cpus are spread over the nodes,
+    starting with the preferred node, then the nodes with the most free cpus.
+    """
+
+    if sum(len(cpus) for cpus in free.values()) < num_cpus:
+        return []
+    fitting = [node for node, cpus in free.items() if len(cpus) >= num_cpus]
+    if preferred_node in fitting:
+        return free[preferred_node][:num_cpus]
+    if fitting:
+        return free[min(fitting, key=lambda node: len(free[node]))][:num_cpus]
+    chosen = []
+    for node in sorted(free, key=lambda node: (node != preferred_node, -len(free[node]))):
+        chosen += free[node][:num_cpus - len(chosen)]
+    return chosen
+
+
+def _closest_node(gpu_ids: Sequence[str]) -> Optional[int]:
+    """The NUMA node of most of the gpus, or None if it is unknown"""
+
+    nodes = gpu_numa_nodes()
+    counts = Counter(nodes[gpu_id] for gpu_id in gpu_ids if gpu_id in nodes)
+    return counts.most_common(1)[0][0] if counts else None
@@ -65,12 +65,14 @@ def perform_action():
 @bp.route('/monitor/<task_id>')
 def monitor(task_id):
     task = Task.get(Task.id == task_id)
-    em.monitor(task)
+    max_kb = request.args.get('max_kb', type=int)  # To load more history
+    em.monitor(task, max_log_bytes=None if max_kb is None else max_kb * 1024)
     selected_log = 'out' if 'out' in task.logs else 'yaml'
 
     viz_scripts, viz_divs = None, None
-    if len(task.metrics) > 0:
-        viz_scripts, viz_divs = viz.generate_plots(task.metrics)
+    metrics = task.metrics  # Read from the metric store
+    if len(metrics) > 0:
+        viz_scripts, viz_divs = viz.generate_plots(metrics)
 
     return render_template('monitor.html', task=task, selected_log=selected_log,
                            viz_scripts=viz_scripts, viz_divs=viz_divs)
@@ -0,0 +1,47 @@
+"""Runs a command and writes its exit code to a file, so that it can be collected by a process which is not its parent.
+
+Usage: python exitcode_wrapper.py [--cpus CPU,...] [--exit-code-path EXIT_CODE_PATH] COMMAND [ARG...]
+Used by the LocalPlatform, which can re-attach to the processes launched before the server restarted (see
+LocalPlatform._reattach). SIGTERM and SIGINT are forwarded to the command. The exit code is negative if the command was
+killed by a signal, like subprocess.Popen.returncode; the wrapper then exits by the same signal. With --cpus, the
+command is pinned to the cpus before it starts (also used by the HT workers, without --exit-code-path).
+
+NOTE: Only the standard library can be imported here, so that the wrapper starts fast.
+"""
+
+import os
+import signal
+import subprocess
+import sys
+
+
+def main(exit_code_path, command, cpus=None):
+    """exit_code_path: None if the exit code is only needed by the parent"""
+
+    if cpus:
+        os.sched_setaffinity(0, cpus)  # Inherited by the command, and by all its threads
+    p = subprocess.Popen(command)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: p.send_signal(signum))
+    returncode = p.wait()
+
+    if exit_code_path is not None:
+        tmp_path = f'{exit_code_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(str(returncode))
+        os.replace(tmp_path, exit_code_path)  # Atomic: the file is never read incomplete
+
+    if returncode < 0:
+        signal.signal(-returncode, signal.SIG_DFL)
+        os.kill(os.getpid(), -returncode)
+    sys.exit(returncode)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {}
+    while args[0] in ('--cpus', '--exit-code-path'):
+        options[args[0]] = args[1]
+        args = args[2:]
+    cpus = [int(cpu) for cpu in options['--cpus'].split(',')] if '--cpus' in options else None
+    main(options.get('--exit-code-path'), args, cpus)
@@ -1,7 +1,11 @@
 import csv
+import threading
+import time
 import uuid
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Iterable, Optional, List
+from typing import Iterable, Optional, List, Dict, Tuple
 
 from tabulate import tabulate
 from termcolor import colored
@@ -10,10 +14,12 @@ from hypertrainer.computeplatform import ComputePlatform
 from hypertrainer.computeplatformtype import ComputePlatformType
 from hypertrainer.db import init_db
 from hypertrainer.hpsearch import generate as generate_hpsearch
-from hypertrainer.htplatform import HtPlatform, ConnectionError
+from hypertrainer.htplatform import HtPlatform, ConnectionError, WorkerError
 from hypertrainer.localplatform import LocalPlatform
+from hypertrainer.logparser import LogParser
+from hypertrainer.metricstore import metric_store
 from hypertrainer.task import Task
-from hypertrainer.utils import yaml, print_yaml, TaskStatus, TestState
+from hypertrainer.utils import yaml, print_yaml, TaskStatus, TestState, LogCursor, read_config
 
 
 class ExperimentManager:
@@ -21,6 +27,10 @@ class ExperimentManager:
 
     platform_instances = None
 
+    # Concurrent monitoring of the tasks (see get_tasks)
+    monitor_max_per_host = 4  # Max number of concurrent requests per (platform, worker host)
+    monitor_deadline_secs = 10
+
     def __init__(self):
         if ExperimentManager._instantiated:
             raise Exception('ExperimentManager should not be instantiated manually. Use experiment_manager.')
@@ -28,6 +38,17 @@ class ExperimentManager:
 
         init_db()
 
+        self.log_cursors: Dict[int, LogCursor] = {}  # Reading position in the logs of each task (by task id)
+        self.log_parsers: Dict[int, LogParser] = {}  # State of the interpretation of the logs of each task
+        self.progress_summaries: Dict[int, dict] = {}  # Last progress provided by the platforms (see update_tasks)
+        self.max_log_bytes = read_config().get('max_log_kb', 256) * 1024  # Default limit for the out and err logs
+        self._monitor_locks: Dict[int, threading.Lock] = {}  # One lock per task id, protecting its cursor and parser
+        # One pool per (platform, worker host), so that the requests to a host which does not respond do not hold up
+        # the monitoring of the other hosts. Deadline and futures of the last requests to each host.
+        self._monitor_executors: Dict[tuple, ThreadPoolExecutor] = {}
+        self._monitor_futures: Dict[tuple, Tuple[float, list]] = {}
+        self._monitor_executors_lock = threading.Lock()
+
         self.platform_instances = {
             ComputePlatformType.LOCAL: LocalPlatform()
         }
@@ -60,13 +81,82 @@ class ExperimentManager:
             q = q.order_by(Task.id.desc())
         tasks = list(q)
 
-        # Get the logs
+        # Get the progress (the other logs are not needed for listing tasks). Some platforms provide it with the status.
+        to_monitor = []
         for t in tasks:
-            try:
-                self.monitor(t)
-            except TimeoutError:
+            if not self.get_platform(t).summarizes_progress:
+                to_monitor.append(t)
+            elif t.id in self.progress_summaries:
+                t.set_progress(self.progress_summaries[t.id])
+        monitored = {t.id: t for t in self._monitor_concurrently(to_monitor, keys=['progress'])}
+        return [monitored.get(t.id, t) for t in tasks]
+
+    def _monitor_concurrently(self, tasks: List[Task], keys: Optional[List[str]] = None) -> List[Task]:
+        """Monitor the tasks in parallel, and return the monitored tasks.
+
+        The tasks are grouped by platform and worker host, and each group is processed by at most
+        monitor_max_per_host threads, in the pool of the host. The threads monitor snapshots of the tasks: the snapshots
+        which are done before the deadline are saved and returned in place of the tasks, by this thread. The other tasks
+        get a 'Timed out' log; their threads keep running, but only modify the discarded snapshots. A host whose
+        previous requests are still running after their deadline is skipped, so that the requests do not pile up in its
+        pool.
+        """
+
+        deadline = time.monotonic() + self.monitor_deadline_secs
+        snapshots = [t.snapshot() for t in tasks]
+        groups = defaultdict(deque)
+        for s in snapshots:
+            groups[(s.platform_type, s.hostname)].append(s)
+        done_ids = set()
+        done_lock = threading.Lock()
+        expired = False
+
+        def process_group(group: deque):
+            while time.monotonic() < deadline:
+                try:
+                    s = group.popleft()
+                except IndexError:
+                    return
+                try:
+                    self.monitor(s, keys=keys, save=False)
+                except TimeoutError:
+                    s.logs = {'err': 'Timed out'}
+                except WorkerError as e:
+                    s.logs = {'err': f'Error in worker: {e}'}
+                with done_lock:
+                    if not expired:
+                        done_ids.add(s.id)
+
+        futures = []
+        with self._monitor_executors_lock:
+            for host, group in groups.items():
+                previous_deadline, previous_futures = self._monitor_futures.get(host, (deadline, []))
+                if previous_deadline < time.monotonic() and any(not f.done() for f in previous_futures):
+                    continue  # The host did not respond to the previous requests
+                executor = self._monitor_executors.get(host)
+                if executor is None:
+                    executor = ThreadPoolExecutor(max_workers=self.monitor_max_per_host)
+                    self._monitor_executors[host] = executor
+                host_futures = [executor.submit(process_group, group)
+                                for _ in range(min(self.monitor_max_per_host, len(group)))]
+                self._monitor_futures[host] = (deadline, host_futures)
+                futures += host_futures
+        done, _ = wait(futures, timeout=max(deadline - time.monotonic(), 0))
+        with done_lock:
+            expired = True
+        for f in done:
+            f.result()  # Raise the unexpected exceptions
+        monitored = []
+        for t, s in zip(tasks, snapshots):
+            if s.id in done_ids:
+                changed_fields = s.changed_fields(t)
+                if changed_fields:
+                    s.save(only=changed_fields)  # The progress
+                monitored.append(s)
+            else:
                 t.logs = {'err': 'Timed out'}
-        return tasks
+                monitored.append(t)
+        return monitored
 
     def update_tasks(self, platforms: list = None):
         if platforms is None:
@@ -77,8 +167,17 @@ class ExperimentManager:
                                              & (Task.status.in_(TaskStatus.active_states()))))
             if len(tasks) == 0:
                 continue
+            job_ids = {t.id: t.job_id for t in tasks}
             platform.update_tasks(tasks)
-            Task.bulk_update(tasks, Task.get_fields())  # FIXME updating all records everytime is heavy
+            fields = Task.get_fields()
+            if platform.records_statuses:
+                fields = [f for f in fields if f.name != 'status']
+            Task.bulk_update(tasks, fields)  # FIXME updating all records everytime is heavy
+            for t in tasks:
+                if t.job_id != job_ids[t.id]:
+                    self._forget_logs(t.id)  # The task has been resubmitted by the platform (e.g. preempted)
+                elif t.progress_summary is not None:
+                    self.progress_summaries[t.id] = t.progress_summary
 
     def create_tasks(self, platform: str, config_file: str, project: str = ''):
         """Create and submit tasks to the specified platform according to the config yaml file"""
@@ -107,14 +206,13 @@ class ExperimentManager:
             t.save()  # insert in database
             tasks.append(t)
         # Submit tasks
-        for t in tasks:
-            self._submit_task(t)  # TODO submit in batch to server!
+        for platform, platform_tasks in self._group_by_platform(tasks):
+            job_ids = platform.submit_many(platform_tasks)
+            for t, job_id in zip(platform_tasks, job_ids):
+                t.job_id = job_id
+                t.post_submit()
         return tasks
 
-    def _submit_task(self, task: Task):
-        task.job_id = self.get_platform(task).submit(task)
-        task.post_submit()
-
     def get_tasks_by_id(self, task_ids: List[int]):
         """Get the tasks records from the db"""
 
@@ -125,10 +223,12 @@ class ExperimentManager:
 
         Resume the tasks from where they left off, if possible.
         """
-        for t in tasks:
-            if not t.status.is_active:
-                t.job_id = self.get_platform(t).submit(t, resume=True)  # TODO one bulk ssh command
+        for platform, platform_tasks in self._group_by_platform(t for t in tasks if not t.status.is_active):
+            job_ids = platform.submit_many(platform_tasks, resume=True)
+            for t, job_id in zip(platform_tasks, job_ids):
+                t.job_id = job_id
                 t.post_resume()
+                self._forget_logs(t.id)  # The logs will be rewritten
 
     def resume_tasks_by_id(self, task_ids: List[int]):
         """Resume the non-active tasks.
@@ -142,9 +242,9 @@ class ExperimentManager:
 
         Stop the execution of the tasks.
         """
-        for t in tasks:
-            if t.status.is_active:
-                self.get_platform(t).cancel(t)  # TODO one bulk ssh command
+        for platform, platform_tasks in self._group_by_platform(t for t in tasks if t.status.is_active):
+            platform.cancel_many(platform_tasks)
+            for t in platform_tasks:
                 t.post_cancel()
 
     def cancel_tasks_by_id(self, task_ids: List[int]):
@@ -154,10 +254,40 @@ class ExperimentManager:
         """
         self.cancel_tasks(self.get_tasks_by_id(task_ids))
 
-    def monitor(self, t: Task):
+    def monitor(self, t: Task, keys: Optional[List[str]] = None, max_log_bytes: Optional[int] = None,
+                save: bool = True):
+        """Fetch the new logs of the task, and interpret them.
+
+        If keys is given, only the logs matching the keys (log names or glob patterns) are fetched.
+        Only the last bytes of the out and err logs are fetched (see the max_log_kb config). If max_log_bytes is
+        given, up to max_log_bytes of history is fetched instead. If save is False, the progress is not saved.
+        """
+
         # TODO rename this method 'update' or something?
-        t.logs = self.get_platform(t).fetch_logs(t)
-        t.interpret_logs()
+        with self._monitor_locks.setdefault(t.id, threading.Lock()):
+            self._monitor(t, keys, max_log_bytes, save)
+
+    def _monitor(self, t: Task, keys: Optional[List[str]], max_log_bytes: Optional[int], save: bool):
+        cursor = self.log_cursors.setdefault(t.id, LogCursor(self.max_log_bytes))
+        parser = self.log_parsers.setdefault(t.id, LogParser())
+        if max_log_bytes is None:
+            max_log_bytes = self.max_log_bytes
+        else:
+            cursor.request_history(max_log_bytes)
+        # Only the data appended since last time
+        t.logs = self.get_platform(t).fetch_logs(t, keys=keys, offsets=cursor.offsets,
+                                                 max_bytes=max_log_bytes, starts=cursor.starts)
+        parser.reset(cursor.restarted_logs())
+        t.interpret_logs(parser, save=save)  # Consumes the progress and metric logs
+        cursor.update(t.logs)
+        t.logs = dict(cursor.logs)
+        t.partial_logs = {name: (cursor.offsets[name] - cursor.log_starts[name], cursor.offsets[name])
+                          for name in t.logs if cursor.is_partial(name)}
+
+    def _forget_logs(self, task_id: int):
+        self.log_cursors.pop(task_id, None)
+        self.log_parsers.pop(task_id, None)
+        self.progress_summaries.pop(task_id, None)
 
     def archive_tasks_by_id(self, task_ids: List[int]):
         """Archive the tasks
@@ -184,16 +314,26 @@ class ExperimentManager:
         if Task.select().where(Task.id.in_(task_ids) & (Task.is_archived == False)).count() > 0:
             raise RuntimeError('Only archived tasks can be deleted')
 
-        # Ask the platform to delete each task (on the corresponding worker)
-        for t in Task.select().where(Task.id.in_(task_ids)):
-            self.get_platform(t).delete(t)
+        # Ask the platforms to delete the tasks (on the corresponding workers)
+        for platform, platform_tasks in self._group_by_platform(Task.select().where(Task.id.in_(task_ids))):
+            platform.delete_many(platform_tasks)
+            for t in platform_tasks:
+                metric_store.delete(t.uuid)
 
         # Delete the task from the server database
         Task.delete().where(Task.id.in_(task_ids)).execute()
+        for task_id in task_ids:
+            self._forget_logs(int(task_id))
 
     def list_projects(self):
         return [t.project for t in Task.select(Task.project).where(Task.project != '').distinct()]
 
+    def _group_by_platform(self, tasks: Iterable[Task]) -> List[Tuple[ComputePlatform, List[Task]]]:
+        groups = defaultdict(list)
+        for t in tasks:
+            groups[t.platform_type].append(t)
+        return [(self.get_platform(group[0]), group) for group in groups.values()]
+
     def get_platform(self, task: Task) -> ComputePlatform:
         try:
             return self.platform_instances[task.platform_type]
@@ -244,6 +384,8 @@ class ExperimentManager:
         task = self.get_tasks_by_id([task_id])[0]
         self.monitor(task)
         logs = task.logs
+        for name, (num_bytes, total_bytes) in task.partial_logs.items():
+            print(colored(f'NOTE: Only the last {num_bytes} bytes (of {total_bytes}) of `{name}` are shown', 'yellow'))
 
         print(colored('--- Begin log `out` ---', attrs=['bold']))
         print(logs.get('out', '`out` log does not exist'))
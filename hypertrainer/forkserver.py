@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from hypertrainer.utils import hypertrainer_home, read_config, _flock
+
+zygote_script = Path(__file__).parent / 'forkserver_zygote.py'
+exitcode_wrapper_script = Path(__file__).parent / 'exitcode_wrapper.py'
+
+
+class ForkServerError(RuntimeError):
+    pass
+
+
+class ForkServer:
+    """Launches the training scripts by forking a warm zygote process, instead of starting python from scratch.
+
+    There is one zygote per python environment and list of preloaded modules, shared by the processes of the host
+    through a unix socket (see forkserver_zygote.py). The zygote is started on first use, and exits after being idle
+    for an hour.
+
+    NOTE: The preloaded modules must not initialize CUDA or start threads, since the children are forked. The env
+    variables which are read at import (e.g. CUDA_VISIBLE_DEVICES for some libraries) are the ones of the zygote.
+    """
+
+    start_timeout_secs = 120  # Preloading can take a while
+
+    def __init__(self, python_env_command: List[str], preload: List[str], socket_dir: Path = None):
+        self.python_env_command = list(python_env_command)
+        self.preload = list(preload)
+        socket_dir = hypertrainer_home / 'forkservers' if socket_dir is None else socket_dir
+        socket_dir.mkdir(exist_ok=True)
+        key = hashlib.sha1(json.dumps([self.python_env_command, self.preload]).encode()).hexdigest()[:16]
+        self.socket_path = socket_dir / f'{key}.sock'
+        self.lock_path = socket_dir / f'{key}.lock'
+        self.log_path = socket_dir / f'{key}.log'
+
+    def launch(self, args: List[str], cwd: Path, stdout_path: Path, stderr_path: Path, env=None,
+               exit_code_path: Path = None, cpus: List[int] = None) -> 'ForkedProcess':
+        """Run python args[0] args[1:] in a child of the zygote, starting the zygote if needed.
+
+        If exit_code_path is given, the zygote writes the exit code of the child to this file. If cpus are given, the
+        child is pinned to them.
+        """
+
+        request = {'argv': [str(a) for a in args], 'cwd': str(cwd), 'stdout': str(stdout_path),
+                   'stderr': str(stderr_path), 'env': dict(os.environ if env is None else env)}
+        if exit_code_path is not None:
+            request['exit_code_path'] = str(exit_code_path)
+        if cpus:
+            request['cpus'] = list(cpus)
+        try:
+            return self._send(request)
+        except ConnectionError:
+            pass  # The zygote is not running, or it exited while we connected
+        with _flock(self.lock_path):  # Only one process starts the zygote
+            try:
+                return self._send(request)
+            except ConnectionError:
+                self._start_zygote()
+            return self._send(request)
+
+    def stop(self):
+        """Make the zygote exit, if it is running. The processes it launched are not affected."""
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(str(self.socket_path))
+            conn.sendall(json.dumps({'stop': True}).encode() + b'\n')
+            conn.recv(1)  # Wait until the zygote closes the connection
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+        finally:
+            conn.close()
+
+    def _send(self, request) -> 'ForkedProcess':
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(str(self.socket_path))
+            conn.sendall(json.dumps(request).encode() + b'\n')
+            line, buffer = _read_line(conn)
+        except (FileNotFoundError, ConnectionRefusedError):
+            conn.close()
+            raise ConnectionError(f'No fork server at {self.socket_path}')
+        except ConnectionError:
+            conn.close()
+            raise
+        return ForkedProcess(json.loads(line)['pid'], conn, buffer)
+
+    def _start_zygote(self):
+        with self.log_path.open('a') as log:
+            subprocess.Popen(self.python_env_command + [str(zygote_script), str(self.socket_path)] + self.preload,
+                             stdin=subprocess.DEVNULL, stdout=log, stderr=log, cwd=str(Path.home()),
+                             start_new_session=True)  # Outlives this process
+        deadline = time.monotonic() + self.start_timeout_secs
+        while time.monotonic() < deadline:
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(str(self.socket_path))
+                return  # The zygote accepts requests. It ignores this empty one.
+            except (FileNotFoundError, ConnectionRefusedError):
+                time.sleep(0.1)
+            finally:
+                probe.close()
+        raise ForkServerError(f'The fork server did not start, see {self.log_path}')
+
+
+class ForkedProcess:
+    """A child of the zygote. Same interface as subprocess.Popen, for the parts used by the platforms.
+
+    The exit code is sent by the zygote, on the connection of the request.
+    """
+
+    lost_returncode = 1  # If the zygote died before the child
+
+    def __init__(self, pid: int, conn: socket.socket, buffer: bytes = b''):
+        self.pid = pid
+        self.returncode: Optional[int] = None
+        self._conn = conn
+        self._buffer = buffer  # Received after the pid
+        self._lock = threading.Lock()  # wait() can be called from several threads
+        self._orphaned = False  # The zygote died: the exit of the process is detected from its pid
+
+    def poll(self) -> Optional[int]:
+        """Never blocks, since it is called by the supervision of the platform"""
+
+        if self.returncode is None and self._lock.acquire(blocking=False):
+            try:
+                if self.returncode is None and not self._orphaned and \
+                        (b'\n' in self._buffer or select.select([self._conn], [], [], 0)[0]):
+                    self._read_returncode()
+                if self._orphaned and not _pid_exists(self.pid):
+                    self.returncode = self.lost_returncode
+            finally:
+                self._lock.release()
+        return self.returncode
+
+    def fileno(self) -> int:
+        """The connection to the zygote, which becomes readable when the process exits"""
+
+        return self._conn.fileno()
+
+    def wait(self) -> int:
+        with self._lock:
+            if self.returncode is None and not self._orphaned:
+                self._read_returncode()
+            if self.returncode is None:
+                while _pid_exists(self.pid):
+                    time.sleep(1)
+                self.returncode = self.lost_returncode
+        return self.returncode
+
+    def terminate(self):
+        self.send_signal(15)
+
+    def kill(self):
+        self.send_signal(9)
+
+    def send_signal(self, sig: int):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def _read_returncode(self):
+        try:
+            line, _ = _read_line(self._conn, self._buffer)
+            self.returncode = json.loads(line)['returncode']
+        except ConnectionError:
+            print(f'Lost the fork server of process {self.pid}; its exit code is unknown')
+            self._orphaned = True
+        self._conn.close()
+
+
+def _read_line(conn: socket.socket, buffer: bytes = b''):
+    """Receive until a newline. Return the line and the data received after it."""
+
+    while b'\n' not in buffer:
+        chunk = conn.recv(4096)
+        if not chunk:
+            raise ConnectionError('The fork server closed the connection')
+        buffer += chunk
+    line, _, rest = buffer.partition(b'\n')
+    return line, rest
+
+
+def _pid_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def start_script(python_env_command: List[str], script_file: Path, config_file: Path, cwd: Path, stdout_path: Path,
+                 stderr_path: Path, env=None, exit_code_path: Path = None, cpus: List[int] = None):
+    """Start python script_file config_file, and return the process (a subprocess.Popen or a ForkedProcess).
+
+    The process is forked from a warm zygote if the fork server is enabled in the config. Example:
+        fork_server: {enabled: true, preload: [numpy, torch]}
+
+    If exit_code_path is given, the exit code of the script is written to this file, so that it can be collected by
+    another process than this one; the script then runs in its own session. If cpus are given, the script is pinned to
+    them (see cpuplacement.py) before it starts. Without the fork server, both are done by exitcode_wrapper.py; the
+    returned process is then the wrapper, which forwards SIGTERM and SIGINT to the script.
+    """
+
+    fork_server_config = read_config().get('fork_server') or {}
+    if fork_server_config.get('enabled', False):
+        fork_server = ForkServer(python_env_command, fork_server_config.get('preload') or [])
+        try:
+            return fork_server.launch([script_file, config_file], cwd, stdout_path, stderr_path, env, exit_code_path,
+                                      cpus)
+        except ForkServerError as e:
+            print(f'{e}. Starting the script without the fork server.')
+
+    command = python_env_command + [str(script_file), str(config_file)]
+    if exit_code_path is not None or cpus:
+        wrapper_options = []
+        if cpus:
+            wrapper_options += ['--cpus', ','.join(map(str, cpus))]
+        if exit_code_path is not None:
+            wrapper_options += ['--exit-code-path', str(exit_code_path)]
+        command = [sys.executable, str(exitcode_wrapper_script)] + wrapper_options + command
+    return subprocess.Popen(command,
+                            stdout=stdout_path.open(mode='w'),
+                            stderr=stderr_path.open(mode='w'),
+                            cwd=str(cwd),
+                            universal_newlines=True,
+                            env=env,
+                            start_new_session=exit_code_path is not None)  # Outlives this process if needed
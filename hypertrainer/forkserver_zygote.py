@@ -0,0 +1,228 @@
+"""Zygote of the fork server (see forkserver.py).
+
+Started as a script by the python of the environment of the tasks: python forkserver_zygote.py SOCKET_PATH [MODULE...]
+The modules are imported once, then a child is forked for each request received on the unix socket. The child runs the
+script as __main__, like python script.py args would.
+
+NOTE: Only the standard library can be imported here, since hypertrainer might not be installed in the environment.
+
+Protocol, one json line per message:
+    client -> zygote: {'argv': [script, args...], 'cwd': ..., 'stdout': path, 'stderr': path, 'env': {...}}
+                      Optionally 'exit_code_path': the returncode is also written to this file, when the child exits.
+                      Optionally 'cpus': the child is pinned to these cpus.
+    zygote -> client: {'pid': ...}, then {'returncode': ...} when the child exits (negative: killed by a signal)
+    client -> zygote: {'stop': true} makes the zygote exit. The running children are not affected.
+"""
+
+import importlib
+import json
+import os
+import runpy
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+
+idle_timeout_secs = 3600  # The zygote exits when it has had no child and no client for this long
+request_timeout_secs = 5
+
+
+def main(socket_path, preload):
+    # Do not shadow the modules of the scripts with the modules of the hypertrainer package
+    own_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path = [p for p in sys.path if os.path.abspath(p or '.') != own_dir]
+
+    for module_name in preload:
+        try:
+            importlib.import_module(module_name)
+        except Exception:
+            print(f'Could not preload {module_name}:', file=sys.stderr)
+            traceback.print_exc()
+
+    # Bind after preloading, so that a successful connection means the zygote is ready
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # Left by a zygote that was killed
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(16)
+
+    # Exits of the children wake up the selector through the wakeup fd
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wakeup_r, selectors.EVENT_READ)
+    clients = {}  # child pid -> connection of the client which is waiting for its exit
+    exit_code_paths = {}  # child pid -> path of the file where its returncode is written
+    idle_since = time.monotonic()
+    stop = False
+    stop_conn = None
+
+    while True:
+        for key, _ in selector.select(timeout=60):
+            if key.fileobj is wakeup_r:
+                _drain(wakeup_r)
+            else:
+                conn, _ = listener.accept()
+                request = _read_request(conn)
+                if request is not None and request.get('stop', False):
+                    stop = True
+                    stop_conn = conn  # Closed once the zygote is stopped
+                elif request is not None:
+                    pid = _fork_child(request, conn, listener, wakeup_r, wakeup_w, clients)
+                    clients[pid] = conn
+                    if 'exit_code_path' in request:
+                        exit_code_paths[pid] = request['exit_code_path']
+                else:
+                    conn.close()
+        _reap_children(clients, exit_code_paths)
+
+        if clients:
+            idle_since = time.monotonic()
+        elif time.monotonic() - idle_since > idle_timeout_secs:
+            stop = True
+        if stop:
+            listener.close()
+            os.unlink(socket_path)
+            if stop_conn is not None:
+                stop_conn.close()
+            return
+
+
+def _read_request(conn):
+    """Return the request, or None if it is invalid"""
+
+    try:
+        conn.settimeout(request_timeout_secs)
+        line = _read_line(conn)
+        if not line:
+            return None  # Probe of the client which started the zygote
+        return json.loads(line)
+    except (OSError, ValueError):
+        traceback.print_exc()
+        return None
+
+
+def _fork_child(request, conn, listener, wakeup_r, wakeup_w, clients) -> int:
+    """Fork a child which runs the requested script, send its pid to the client and return it"""
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Child: forget the state of the zygote
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for f in [listener, conn] + list(clients.values()):
+            f.close()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+        _run_child(request)  # Does not return
+
+    try:
+        conn.sendall(json.dumps({'pid': pid}).encode() + b'\n')
+    except OSError:
+        pass  # The client is gone; the child runs anyway
+    return pid
+
+
+def _run_child(request):
+    returncode = 1
+    try:
+        os.chdir(request['cwd'])
+        _redirect(0, os.devnull, os.O_RDONLY)
+        _redirect(1, request['stdout'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        _redirect(2, request['stderr'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        os.environ.clear()
+        os.environ.update(request['env'])
+        if 'cpus' in request:
+            os.sched_setaffinity(0, request['cpus'])  # Before the script starts its threads, which inherit it
+
+        script = request['argv'][0]
+        sys.argv = list(request['argv'])
+        sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+        try:
+            runpy.run_path(script, run_name='__main__')
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None:
+                returncode = 0
+            elif isinstance(e.code, int):
+                returncode = e.code
+            else:
+                print(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(returncode & 0xFF)
+
+
+def _redirect(fd, path, flags):
+    new_fd = os.open(path, flags, 0o666)
+    os.dup2(new_fd, fd)
+    os.close(new_fd)
+
+
+def _reap_children(clients, exit_code_paths):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return  # No children
+        if pid == 0:
+            return  # No more exited children
+        returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        if pid in exit_code_paths:
+            _write_exit_code(exit_code_paths.pop(pid), returncode)
+        conn = clients.pop(pid, None)
+        if conn is not None:
+            try:
+                conn.sendall(json.dumps({'returncode': returncode}).encode() + b'\n')
+            except OSError:
+                pass
+            conn.close()
+
+
+def _write_exit_code(path, returncode):
+    try:
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(str(returncode))
+        os.replace(f'{path}.tmp', path)  # Atomic: the file is never read incomplete
+    except OSError:
+        traceback.print_exc()
+
+
+def _read_line(conn) -> bytes:
+    """Receive until a newline. Return b'' if the client closed the connection without sending anything."""
+
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            if data:
+                raise ConnectionError('Connection closed before the end of the request')
+            return data
+        data += chunk
+    return data
+
+
+def _drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2:])
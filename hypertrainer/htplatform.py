@@ -1,21 +1,42 @@
+import json
+import math
+import pickle
 import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
 from pathlib import Path
-from typing import List, Iterable, Dict
+from typing import List, Dict, Tuple, Set
 
 import redis.exceptions
 from redis import Redis
 from rq import Queue
-from rq.job import Job, cancel_job as cancel_rq_job
+from rq.job import Job, JobStatus
 
 from hypertrainer.computeplatform import ComputePlatform
 from hypertrainer.computeplatformtype import ComputePlatformType
-from hypertrainer.htplatform_worker import run, get_jobs_info, get_logs, ping, raise_exception, delete_job, \
-    cancel_job
-from hypertrainer.utils import TaskStatus, get_python_env_command, config_context
+import hypertrainer.htplatform_worker
+from hypertrainer.htplatform_worker import run, get_jobs_info, get_logs, ping, raise_exception, delete_jobs, \
+    cancel_jobs, call_and_reply, job_status_key, job_progress_key, heartbeat_key_prefix, jobs_queue_name, \
+    host_jobs_queue_name, capacity_key_prefix, reservations_key_prefix, worker_pool_key_prefix, task_priority, \
+    priority_rank, queue_priority, default_priority, worker_heartbeat_key_prefix, ended_jobs_key, ended_job_ttl_secs
+from hypertrainer.logstream import LogStreamReader
+from hypertrainer.resources import has_declared_resources, required_resources, required_gpus, free_resources, \
+    best_fit_host
+from hypertrainer.utils import TaskStatus, get_python_env_command, read_config, decompress_data
 
 
 ConnectionError = redis.exceptions.ConnectionError
 
+pending_placement_key = 'hypertrainer:pending_placement'  # List of the ids of the jobs waiting to be placed
+placement_lock_key = 'hypertrainer:placement_lock'
+preempted_key = 'hypertrainer:preempted'  # Hash: id of the job that resumes a preempted task -> json info
+
+
+class WorkerError(RuntimeError):
+    """An exception was raised in the worker while handling a request"""
+    pass
+
 
 def check_connection(redis_conn):
     try:
@@ -30,109 +51,471 @@ def check_connection(redis_conn):
 class HtPlatform(ComputePlatform):
     """The HT (HyperTrainer) Platform allows to send jobs to one or more Linux machines.
 
-    Each participating worker consumes jobs from a global queue. There can be several workers per machine.
+    Each participating worker consumes jobs from global queues, one per number of required gpus (see GpuAwareWorker).
+    There can be several workers per machine.
+    The workers forward the logs of their running jobs to Redis streams (see logstream.py), and publish the summary of
+    their progress with their status (see ProgressSummarizer).
+    The tasks which declare their resources (see resources.py) are placed on a host by the server (see
+    place_pending_jobs), instead of being taken by the first free worker.
+    The jobs queues are consumed in order of priority (see htplatform_worker.priority_levels). If preemption is
+    enabled, the running jobs of low priority make room for the jobs of higher priority which have waited too long (see
+    preempt_jobs).
+    The workers of each host send heartbeats; the tasks of a host which stopped sending them are lost, or resubmitted
+    (see handle_lost_jobs).
     """
 
+    summarizes_progress = True
+
     def __init__(self, same_thread=False):
-        with config_context() as config:
-            self.worker_hostnames = config['ht_platform']['worker_hostnames']
+        config = read_config()
+        self.worker_hostnames = config['ht_platform']['worker_hostnames']
+
+        redis_conn = Redis(port=config['ht_platform']['redis_port'])
+        check_connection(redis_conn)
+        self.redis_conn = redis_conn
 
-            redis_conn = Redis(port=config['ht_platform']['redis_port'])
-            check_connection(redis_conn)
-            self.redis_conn = redis_conn
+        preemption_config = config['ht_platform'].get('preemption') or {}
+        self.preemption_enabled = preemption_config.get('enabled', False)
+        self.preemption_wait_secs = preemption_config.get('wait_threshold_secs', 600)
 
-        self.jobs_queue = Queue(name='jobs', connection=redis_conn, is_async=not same_thread)
+        dead_workers_config = config['ht_platform'].get('dead_workers') or {}
+        self.dead_worker_grace_secs = dead_workers_config.get('grace_period_secs', 300)
+        self.requeue_lost_jobs = dead_workers_config.get('requeue', False)
+
+        self.same_thread = same_thread
+        self.jobs_queues: Dict[tuple, Queue] = {}  # (num_gpus, priority) -> queue (see jobs_queue_name)
+        self._preempted_for = set()  # Ids of the waiting jobs for which a job has been preempted
+        self._host_down_since: Dict[str, float] = {}  # Hostname -> time.monotonic() when its heartbeat was first missed
         self.worker_queues: Dict[str, Queue] = {h: Queue(name=h, connection=redis_conn, is_async=not same_thread)
                                                 for h in self.worker_hostnames}
+        self.log_stream_reader = LogStreamReader(redis_conn)
+        if same_thread:
+            # This process acts as the worker
+            hypertrainer.htplatform_worker.worker_hostname = self.worker_hostnames[0]
 
     def submit(self, task, resume=False):
-        output_path = Path(task.output_root) / str(task.uuid)
-        task.output_path = str(output_path)
+        return self.submit_many([task], resume)[0]
+
+    def submit_many(self, tasks, resume=False) -> List[str]:
+        """Enqueue the jobs of the tasks in one round-trip to Redis"""
+
+        pipe = self.redis_conn.pipeline()
+        job_ids = [None] * len(tasks)
+        enqueue_data = defaultdict(list)  # Jobs queue -> [(task index, data)]
+        for i, t in enumerate(tasks):
+            t.output_path = str(Path(t.output_root) / str(t.uuid))
+            run_kwargs, meta = self._get_run_args(t, resume)
+            if 'resources' in meta:
+                # The job will be placed on a host which has the required resources
+                job = self._create_job(run_kwargs, meta)
+                job.save(pipeline=pipe)
+                pipe.rpush(pending_placement_key, job.id)
+                job_ids[i] = job.id
+            else:
+                enqueue_data[self._get_jobs_queue(meta['num_gpus'], meta['priority'])].append(
+                    (i, Queue.prepare_data(run, kwargs=run_kwargs, timeout=-1, meta=meta)))
+        for jobs_queue, items in enqueue_data.items():
+            if self.same_thread:
+                # The jobs are executed when they are enqueued, so they must be saved first
+                jobs = [jobs_queue.enqueue_call(run, kwargs=data.kwargs, timeout=-1, meta=data.meta)
+                        for _, data in items]
+            else:
+                jobs = jobs_queue.enqueue_many([data for _, data in items], pipeline=pipe)
+            for (i, _), job in zip(items, jobs):
+                job_ids[i] = job.id
+        pipe.execute()
+        if any(has_declared_resources(t.config) for t in tasks):
+            self.place_pending_jobs()
+        # At this point, we only know the rq job ids. No pid since the jobs might have to wait.
+        return job_ids
+
+    def _create_job(self, run_kwargs: dict, meta: dict) -> Job:
+        """Create the rq job which runs a task (see _get_run_args), without saving it"""
+
+        return Job.create(run, kwargs=run_kwargs, connection=self.redis_conn, timeout=-1, meta=meta)
+
+    @staticmethod
+    def _get_run_args(task, resume: bool) -> Tuple[dict, dict]:
+        """The kwargs of run() for the task, and the meta of its job"""
+
         python_env_command = get_python_env_command(Path(task.project_path), ComputePlatformType.HT.value)
-        job = self.jobs_queue.enqueue(run, job_timeout=-1, kwargs=dict(
+        run_kwargs = dict(
             script_file=Path(task.script_file),
-            output_path=output_path,
+            output_path=Path(task.output_path),
             python_env_command=python_env_command,
             config_dump=task.dump_config(),
-            resume=resume))
-        # At this point, we only know the rq job id. No pid since the job might have to wait.
-        return job.id
+            resume=resume)
+        meta = {'num_gpus': required_gpus(task.config), 'priority': task_priority(task.config)}
+        if has_declared_resources(task.config):
+            meta['resources'] = required_resources(task.config)
+        return run_kwargs, meta
+
+    def place_pending_jobs(self):
+        """Assign the jobs which declare their resources to hosts, and enqueue them in the queues of the hosts.
+
+        The jobs are placed in order of priority, then of submission, with best-fit bin packing (see best_fit_host). The
+        free resources of a host are its capacity, as reported by its workers, minus the resources reserved by the jobs
+        placed on it. The jobs that do not fit anywhere stay pending until resources are released.
+        """
+
+        with self.redis_conn.lock(placement_lock_key, timeout=30):
+            job_ids = [job_id.decode() for job_id in self.redis_conn.lrange(pending_placement_key, 0, -1)]
+            if not job_ids:
+                return
+            capacities = self._get_host_capacities()
+            free = {h: free_resources(c, self._get_reservations(h)) for h, c in capacities.items()}
+            jobs = []
+            for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection=self.redis_conn)):
+                if job is None or job.get_status() == JobStatus.CANCELED:
+                    self.redis_conn.lrem(pending_placement_key, 0, job_id)
+                else:
+                    jobs.append(job)
+            jobs.sort(key=lambda j: priority_rank(j.meta.get('priority', default_priority)))  # Stable
+            for job in jobs:
+                job_id = job.id
+                required = job.meta['resources']
+                host = best_fit_host(free, capacities, required)
+                if host is None:
+                    continue  # Wait for resources to be released
+                free[host] = free_resources(free[host], [required])
+                pipe = self.redis_conn.pipeline()
+                pipe.hset(reservations_key_prefix + host, job_id, json.dumps(required))
+                pipe.lrem(pending_placement_key, 0, job_id)
+                pipe.execute()
+                self._get_host_jobs_queue(host).enqueue_job(job)
+
+    def _get_host_capacities(self) -> Dict[str, dict]:
+        """Capacity of the hosts whose workers are alive"""
+
+        reports = self.redis_conn.mget([capacity_key_prefix + h for h in self.worker_hostnames])
+        return {h: json.loads(r) for h, r in zip(self.worker_hostnames, reports) if r is not None}
 
-    def fetch_logs(self, task, keys=None):
+    def _get_reservations(self, hostname: str) -> List[dict]:
+        return [json.loads(r) for r in self.redis_conn.hvals(reservations_key_prefix + hostname)]
+
+    def _release_resources(self, job_ids: List[str], pipe):
+        """Forget the jobs in the placement data (pending jobs and reservations), and in the preempted jobs"""
+
+        if not job_ids:
+            return
+        for job_id in job_ids:
+            pipe.lrem(pending_placement_key, 0, job_id)
+        pipe.hdel(preempted_key, *job_ids)
+        for h in self.worker_hostnames:
+            pipe.hdel(reservations_key_prefix + h, *job_ids)
+
+    def _get_host_jobs_queue(self, hostname: str) -> Queue:
+        return Queue(name=host_jobs_queue_name(hostname), connection=self.redis_conn, is_async=not self.same_thread)
+
+    def _get_jobs_queue(self, num_gpus: int, priority: str) -> Queue:
+        if (num_gpus, priority) not in self.jobs_queues:
+            self.jobs_queues[num_gpus, priority] = Queue(name=jobs_queue_name(num_gpus, priority),
+                                                         connection=self.redis_conn, is_async=not self.same_thread)
+        return self.jobs_queues[num_gpus, priority]
+
+    def fetch_logs(self, task, keys=None, offsets=None, max_bytes=None, starts=None):
         if task.hostname == '':  # The job hasn't been consumed yet
             return {}
-        rq_job = self.worker_queues[task.hostname].enqueue(get_logs, args=(task.output_path,), ttl=2, result_ttl=2)
-        logs = wait_for_result(rq_job)
-        return logs
+        keys = None if keys is None else list(keys)
+        if offsets is not None:
+            # Read the logs forwarded by the worker to Redis, if available
+            logs = self.log_stream_reader.read(task.job_id, offsets, keys, max_bytes, starts)
+            if not task.status.is_active:
+                self.log_stream_reader.forget(task.job_id)
+            if logs is not None:
+                return logs
+        reply_key = self._call(self.worker_queues[task.hostname], get_logs,
+                               args=(task.output_path, offsets, keys, max_bytes))
+        response = decompress_data(wait_for_reply(self.redis_conn, reply_key))
+        if offsets is not None:
+            offsets.update(response['offsets'])
+        if starts is not None:
+            starts.update(response['starts'])
+        return response['logs']
 
     def cancel(self, task):
-        cancel_rq_job(task.job_id, connection=self.redis_conn)  # This ensures the job will not start
+        self.cancel_many([task])
 
-        if task.hostname == '':
-            print(f'Cannot send cancellation for {task.uuid}: no assigned worker hostname')
+    def cancel_many(self, tasks):
+        """Cancel the tasks in one round-trip to Redis, with one cancellation request per worker host"""
+
+        jobs = Job.fetch_many([t.job_id for t in tasks], connection=self.redis_conn)
+        pipe = self.redis_conn.pipeline()
+        for job in jobs:
+            if job is not None and job.get_status(refresh=False) != JobStatus.CANCELED:
+                job.cancel(pipeline=pipe)  # This ensures the job will not start
+        self._release_resources([t.job_id for t in tasks], pipe)
+        for hostname, host_tasks in self._group_by_hostname(tasks, 'send cancellation').items():
+            self._enqueue_request(hostname, cancel_jobs, ([t.job_id for t in host_tasks],), pipe)
+        pipe.execute()
+
+    def _enqueue_request(self, hostname: str, func, args: tuple, pipe):
+        """Add a request for a worker host to the pipeline. In same_thread mode, the request is executed now."""
+
+        queue = self.worker_queues[hostname]
+        if self.same_thread:
+            queue.enqueue(func, args=args, ttl=4)  # The job must be saved before it is executed
         else:
-            self.worker_queues[task.hostname].enqueue(cancel_job, args=(task.job_id,), ttl=4)
+            queue.enqueue_many([Queue.prepare_data(func, args=args, ttl=4)], pipeline=pipe)
+
+    @staticmethod
+    def _group_by_hostname(tasks, action: str) -> Dict[str, list]:
+        """Group the tasks by worker host, skipping the tasks which have not been assigned to a host yet"""
+
+        groups = defaultdict(list)
+        for t in tasks:
+            if t.hostname == '':
+                print(f'Cannot {action} for {t.uuid}: no assigned worker hostname')
+            else:
+                groups[t.hostname].append(t)
+        return groups
 
     def update_tasks(self, tasks):
-        # TODO only check requested ids
+        self.place_pending_jobs()  # Resources might have been released
 
+        # The workers publish the status and progress of their jobs in Redis. Get them, with the heartbeats of the jobs
+        # and of the hosts, in one round-trip.
+        job_ids = [t.job_id for t in tasks]
+        pipe = self.redis_conn.pipeline()
+        pipe.hmget(job_status_key, job_ids)
+        pipe.hmget(job_progress_key, job_ids)
+        pipe.mget([worker_heartbeat_key_prefix + h for h in self.worker_hostnames])
+        pipe.zrangebyscore(ended_jobs_key, '-inf', time.time() - ended_job_ttl_secs)
         for t in tasks:
+            pipe.exists(heartbeat_key_prefix + t.job_id)
+        statuses, progresses, host_heartbeats, expired_job_ids, *heartbeats = pipe.execute()
+        if expired_job_ids:
+            self._trim_ended_jobs(expired_job_ids)
+
+        unmonitored = []
+        for t, status_json, progress_json, heartbeat in zip(tasks, statuses, progresses, heartbeats):
             assert t.status.is_active
-            if t.status != TaskStatus.Waiting:  # Waiting will not be found until they are picked up
-                t.status = TaskStatus.Unknown  # State is unknown, unless we find the task in a worker db
-        job_id_to_task = {t.job_id: t for t in tasks}
-
-        info_dicts = self._get_info_dict_for_each_worker()
-        for hostname, local_db in zip(self.worker_hostnames, info_dicts):
-            if local_db is None:
-                continue  # Did not receive an answer from worker
-            for job_id in set(local_db.keys()).intersection(job_id_to_task.keys()):
-                # For each task in the intersection of (tasks to update) and (tasks in worker db)
-                t = job_id_to_task[job_id]
-                job_info = local_db[job_id]
-                t.status = TaskStatus(job_info['status'])
-                t.hostname = hostname
+            if progress_json is not None:
+                t.set_progress(json.loads(progress_json))
+            if status_json is None:
+                if t.status != TaskStatus.Waiting:  # Waiting will not be found until they are picked up
+                    t.status = TaskStatus.Unknown
+                continue
+            job_info = json.loads(status_json)
+            t.status = TaskStatus(job_info['status'])
+            t.hostname = job_info['hostname']
+            if not t.status.is_active:
+                self.log_stream_reader.forget(t.job_id)  # Its logs will not be read incrementally anymore
+            if t.status.is_active and not heartbeat:
+                t.status = TaskStatus.Unknown  # The job is not monitored anymore (e.g. the worker is down)
+                unmonitored.append(t)
 
-    def delete(self, task):
-        if task.hostname == '':
-            print(f'Cannot perform worker deletion for {task.uuid}: no assigned worker hostname')
+        if not self.same_thread:  # In same_thread mode, there is no worker to send heartbeats
+            self.handle_lost_jobs(unmonitored, self._get_dead_hosts(host_heartbeats))
+        if self.preemption_enabled:
+            self.preempt_jobs(tasks)
+        self.resume_preempted_jobs()
+
+    def _trim_ended_jobs(self, job_ids: list):
+        """Remove the status and progress of the jobs which ended more than ended_job_ttl_secs ago"""
+
+        pipe = self.redis_conn.pipeline()
+        pipe.hdel(job_status_key, *job_ids)
+        pipe.hdel(job_progress_key, *job_ids)
+        pipe.zrem(ended_jobs_key, *job_ids)
+        pipe.execute()
+
+    def _get_dead_hosts(self, host_heartbeats: list) -> Set[str]:
+        """Hosts whose workers have not sent a heartbeat for longer than the grace period"""
+
+        now = time.monotonic()
+        for h, heartbeat in zip(self.worker_hostnames, host_heartbeats):
+            if heartbeat is None:
+                self._host_down_since.setdefault(h, now)
+            else:
+                self._host_down_since.pop(h, None)
+        return {h for h, since in self._host_down_since.items() if now - since >= self.dead_worker_grace_secs}
+
+    def handle_lost_jobs(self, tasks, dead_hosts: Set[str]):
+        """Mark Lost the tasks whose job is not monitored anymore because its host is dead.
+
+        If requeue is enabled, the tasks are resubmitted with resume=True instead, with new job ids, so that another
+        host runs them. Their output is resumed if the hosts share it, otherwise they start over.
+        NOTE: The gpu locks of the dead host are flocks, which do not outlive the processes that hold them.
+        """
+
+        lost = [t for t in tasks if t.hostname in dead_hosts]
+        if not lost:
+            return
+        lost_job_ids = [t.job_id for t in lost]
+        pipe = self.redis_conn.pipeline()
+        pipe.hdel(job_status_key, *lost_job_ids)
+        pipe.hdel(job_progress_key, *lost_job_ids)
+        self._release_resources(lost_job_ids, pipe)
+        pipe.execute()
+        for t in lost:
+            self.log_stream_reader.forget(t.job_id)
+
+        if self.requeue_lost_jobs:
+            for t, job_id in zip(lost, self.submit_many(lost, resume=True)):
+                print(f'Task {t.id} was lost by dead host {t.hostname}; resubmitted')
+                t.job_id = job_id
+                t.hostname = ''
+                t.status = TaskStatus.Waiting
         else:
-            self.worker_queues[task.hostname].enqueue(delete_job, args=(task.job_id, task.output_path), ttl=4)
+            for t in lost:
+                print(f'Task {t.id} was lost by dead host {t.hostname}')
+                t.status = TaskStatus.Lost
+
+    def preempt_jobs(self, tasks):
+        """Cancel running jobs to make room for the jobs of higher priority which have waited too long.
+
+        For each job waiting for more than preemption_wait_secs, the running job of the lowest priority below its own
+        is cancelled, the most recently started first. Only the jobs that use at least as many gpus as the waiting job
+        are preempted. The task of the preempted job is resumed later (see resume_preempted_jobs), with a new job id.
+        """
+
+        waiting = [t for t in tasks if t.status == TaskStatus.Waiting]
+        running = [t for t in tasks if t.status == TaskStatus.Running]
+        self._preempted_for &= {t.job_id for t in waiting}
+        waiting = [t for t in waiting if t.job_id not in self._preempted_for]
+        if not waiting or not running:
+            return
+
+        job_ids = [t.job_id for t in waiting + running]
+        jobs = {j.id: j for j in Job.fetch_many(job_ids, connection=self.redis_conn) if j is not None}
+        now = datetime.utcnow()  # The rq timestamps are naive utc
+
+        def waited_secs(t):
+            job = jobs[t.job_id]
+            return (now - (job.enqueued_at or job.created_at)).total_seconds()
+
+        starving = [t for t in waiting if t.job_id in jobs and waited_secs(t) > self.preemption_wait_secs]
+        for t in sorted(starving, key=lambda t: priority_rank(task_priority(t.config))):
+            rank = priority_rank(task_priority(t.config))
+            candidates = [r for r in running if priority_rank(task_priority(r.config)) > rank
+                          and required_gpus(r.config) >= required_gpus(t.config) and r.job_id in jobs]
+            if not candidates:
+                continue
+            victim = max(candidates, key=lambda r: (priority_rank(task_priority(r.config)),
+                                                    jobs[r.job_id].started_at or now))
+            print(f'Preempting task {victim.id} for task {t.id}')
+            running.remove(victim)
+            self._preempt(victim)
+            self._preempted_for.add(t.job_id)
+
+    def _preempt(self, task):
+        """Cancel the job of the task, and create the job that will resume it on the same host"""
+
+        cancelled_job_id = task.job_id
+        self.cancel(task)
+        job = self._create_job(*self._get_run_args(task, resume=True))
+        job.save()
+        self.redis_conn.hset(preempted_key, job.id,
+                             json.dumps({'hostname': task.hostname, 'cancelled_job_id': cancelled_job_id}))
+        task.job_id = job.id
+        task.status = TaskStatus.Waiting
+
+    def resume_preempted_jobs(self):
+        """Enqueue the jobs of the preempted tasks, once no job of higher priority is waiting in the jobs queues.
+
+        The jobs are enqueued in the queue of the host where the tasks ran, since their output is there.
+        """
+
+        preempted = {job_id.decode(): json.loads(info)
+                     for job_id, info in self.redis_conn.hgetall(preempted_key).items()}
+        if not preempted:
+            return
+        waiting_ranks = {priority_rank(queue_priority(q.name)) for q in Queue.all(connection=self.redis_conn)
+                         if q.name.startswith('jobs') and ':' not in q.name and q.count > 0}
+        for job_id, job in zip(preempted, Job.fetch_many(list(preempted), connection=self.redis_conn)):
+            info = preempted[job_id]
+            if job is not None and job.get_status() != JobStatus.CANCELED:
+                if any(r < priority_rank(job.meta['priority']) for r in waiting_ranks):
+                    continue
+                if 'resources' in job.meta:
+                    self.redis_conn.hset(reservations_key_prefix + info['hostname'], job_id,
+                                         json.dumps(job.meta['resources']))
+                self._get_host_jobs_queue(info['hostname']).enqueue_job(job)
+            pipe = self.redis_conn.pipeline()
+            pipe.hdel(preempted_key, job_id)
+            pipe.hdel(job_status_key, info['cancelled_job_id'])
+            pipe.hdel(job_progress_key, info['cancelled_job_id'])
+            pipe.execute()
+
+    def delete(self, task):
+        self.delete_many([task])
 
-    def _get_info_dict_for_each_worker(self):
-        rq_jobs = [q.enqueue(get_jobs_info, ttl=2, result_ttl=2) for q in self.worker_queues.values()]
-        results = wait_for_results(rq_jobs, raise_exc=False)
+    def delete_many(self, tasks):
+        """Delete the tasks in one round-trip to Redis, with one deletion request per worker host"""
+
+        pipe = self.redis_conn.pipeline()
+        for hostname, host_tasks in self._group_by_hostname(tasks, 'perform worker deletion').items():
+            self._enqueue_request(hostname, delete_jobs, ([t.job_id for t in host_tasks],
+                                                          [t.output_path for t in host_tasks]), pipe)
+        self._release_resources([t.job_id for t in tasks], pipe)
+        pipe.execute()
+        for t in tasks:
+            self.log_stream_reader.forget(t.job_id)
+
+    def get_worker_pools(self) -> Dict[str, dict]:
+        """Stats of the pools of workers on the jobs queues, for the hosts which autoscale their pool (see worker.py)
+
+        Example: {'host1': {'queue_depth': 3, 'num_workers': 4, 'num_busy_workers': 4, 'max_workers': 8}}
+        """
+
+        stats = self.redis_conn.mget([worker_pool_key_prefix + h for h in self.worker_hostnames])
+        return {h: json.loads(s) for h, s in zip(self.worker_hostnames, stats) if s is not None}
+
+    def _get_info_dict_for_each_worker(self, active_only=False):
+        reply_keys = [self._call(q, get_jobs_info, args=(active_only,)) for q in self.worker_queues.values()]
+        results = wait_for_replies(self.redis_conn, reply_keys, raise_exc=False)
         return results
 
     def ping_workers(self):
-        rq_jobs = [q.enqueue(ping, ttl=2, result_ttl=2, args=(h,)) for h, q in self.worker_queues.items()]
-        results = wait_for_results(rq_jobs)
+        reply_keys = [self._call(q, ping, args=(h,)) for h, q in self.worker_queues.items()]
+        results = wait_for_replies(self.redis_conn, reply_keys)
         return results
 
+    @staticmethod
+    def _call(queue: Queue, func, args=()) -> str:
+        """Send a request to a worker, and return the key of the Redis list where the reply will be pushed.
+
+        Use wait_for_reply() to block until the reply is received.
+        """
+
+        reply_key = f'hypertrainer:reply:{uuid.uuid4()}'
+        queue.enqueue(call_and_reply, args=(reply_key, func, args), ttl=2, result_ttl=0)
+        return reply_key
+
     def raise_exception_in_worker(self, exc_type, queue_name):
         self.worker_queues[queue_name].enqueue(raise_exception, ttl=2, result_ttl=2, args=(exc_type,))
 
 
-def wait_for_result(rq_job: Job, interval_secs=1, tries=4, raise_exc=True):
-    for i in range(tries):
-        if rq_job.result is not None:
-            return rq_job.result
-        else:
-            time.sleep(interval_secs)
-    if raise_exc:
-        raise TimeoutError
-    return None
+def wait_for_reply(redis_conn: Redis, reply_key: str, timeout_secs=4, raise_exc=True):
+    """Block until a worker pushes its reply (see call_and_reply), and return the result"""
 
+    return wait_for_replies(redis_conn, [reply_key], timeout_secs, raise_exc)[0]
 
-def wait_for_results(rq_jobs: Iterable[Job], interval_secs=1, tries=4, raise_exc=True):
-    assert tries >= 1
-    for i in range(tries):
-        results = [j.result for j in rq_jobs]
-        if any(r is None for r in results):
-            time.sleep(interval_secs)
-        else:
-            return results
-    if raise_exc:
+
+def wait_for_replies(redis_conn: Redis, reply_keys: List[str], timeout_secs=4, raise_exc=True) -> list:
+    """Block until the workers push their replies (see call_and_reply), and return the results in order.
+
+    If raise_exc=False, the result is None for the replies that were not received in time, or that are errors.
+    """
+
+    results = [None] * len(reply_keys)
+    remaining = {k: i for i, k in enumerate(reply_keys)}
+    deadline = time.monotonic() + timeout_secs
+    while remaining:
+        timeout = math.ceil(deadline - time.monotonic())  # Note: the BLPOP timeout is in whole seconds before Redis 6
+        if timeout <= 0:
+            break
+        item = redis_conn.blpop(list(remaining.keys()), timeout=timeout)
+        if item is None:
+            break
+        key, data = item
+        i = remaining.pop(key.decode())
+        success, result = pickle.loads(data)
+        if success:
+            results[i] = result
+        elif raise_exc:
+            raise WorkerError(result)
+    if remaining and raise_exc:
         raise TimeoutError
-    # noinspection PyUnboundLocalVariable
     return results
@@ -1,17 +1,153 @@
-import contextlib
+import json
 import os
 import pickle
+import queue
 import shutil
-import subprocess
+import socket
+import threading
+import time
 from pathlib import Path
-from time import sleep
-from typing import List
+from typing import List, Dict
 
-from rq import get_current_job
+from rq import get_current_job, Worker
 
-from hypertrainer.utils import yaml, hypertrainer_home, GpuLockManager, TaskStatus
+from hypertrainer.utils import yaml, hypertrainer_home, GpuLockManager, TaskStatus, read_logs, compress_data
+from hypertrainer.cpuplacement import claim_cpus
+from hypertrainer.forkserver import start_script
+from hypertrainer.logparser import ProgressSummarizer
+from hypertrainer.logstream import LogForwarder, log_stream_key_prefix
+from hypertrainer.resources import required_gpus, required_resources
+from hypertrainer.workerdb import WorkerDb
 
-local_db = hypertrainer_home / 'db.pkl'  # FIXME config
+local_db = WorkerDb(hypertrainer_home / 'worker_db.sqlite')  # FIXME config
+reply_ttl_secs = 10
+
+# The workers publish the status of their jobs in Redis, so that the server does not have to ask them
+job_status_key = 'hypertrainer:job_status'  # Hash: job id -> json {'status': ..., 'hostname': ...}
+job_progress_key = 'hypertrainer:job_progress'  # Hash: job id -> json summary of the progress (see ProgressSummarizer)
+heartbeat_key_prefix = 'hypertrainer:heartbeat:'  # + job id. Expires if the job is not monitored anymore
+heartbeat_ttl_secs = 10
+# Sorted set: job id -> time at which it ended. The status and progress of the ended jobs are trimmed after a while,
+# since the server does not read them anymore once it has recorded the final status (see HtPlatform.update_tasks).
+ended_jobs_key = 'hypertrainer:ended_jobs'
+ended_job_ttl_secs = 24 * 3600
+forward_interval_secs = 1  # The logs are forwarded, and the heartbeat refreshed, at this interval
+cancel_channel_prefix = 'hypertrainer:cancel:'  # + job id. Pub/sub channel on which the running job is cancelled
+cancel_check_interval_secs = 10  # The running job also checks its status in the local db, in case a message is missed
+# + hostname. Expires if the workers of the host are down
+worker_heartbeat_key_prefix = 'hypertrainer:worker_heartbeat:'
+worker_heartbeat_ttl_secs = 10
+
+worker_hostname = socket.gethostname()  # Set by the worker process (see worker.py)
+
+claimed_gpus_env_var = 'HYPERTRAINER_CLAIMED_GPUS'
+
+# Placement of the jobs which declare their resources (see HtPlatform.place_pending_jobs)
+capacity_key_prefix = 'hypertrainer:capacity:'  # + hostname. Json resources dict, reported by the worker
+capacity_ttl_secs = 30
+reservations_key_prefix = 'hypertrainer:reservations:'  # + hostname. Hash: job id -> json resources dict
+
+worker_pool_key_prefix = 'hypertrainer:worker_pool:'  # + hostname. Json stats of the worker pool (see worker.py)
+
+
+# Priority of a task, from its config. Example: priority: high
+priority_levels = ('high', 'normal', 'low')  # In order of priority
+default_priority = 'normal'
+
+
+def task_priority(config: dict) -> str:
+    priority = config.get('priority', default_priority)
+    if priority not in priority_levels:
+        raise ValueError(f'Unknown priority: {priority}. Must be one of {", ".join(priority_levels)}')
+    return priority
+
+
+def priority_rank(priority: str) -> int:
+    """0 for the highest priority"""
+
+    return priority_levels.index(priority)
+
+
+def jobs_queue_name(num_gpus: int = 0, priority: str = default_priority) -> str:
+    """Name of the queue of the jobs which require num_gpus gpus, and have the given priority"""
+
+    name = 'jobs' if num_gpus == 0 else f'jobs_gpu_{num_gpus}'
+    return name if priority == default_priority else f'{name}_{priority}'
+
+
+def host_jobs_queue_name(hostname: str) -> str:
+    """Name of the queue of the jobs which have been placed on a host"""
+
+    return f'jobs:{hostname}'
+
+
+def queue_num_gpus(queue_name: str) -> int:
+    """Inverse of jobs_queue_name(), for the number of gpus"""
+
+    return int(queue_name[len('jobs_gpu_'):].split('_')[0]) if queue_name.startswith('jobs_gpu_') else 0
+
+
+def queue_priority(queue_name: str) -> str:
+    """Inverse of jobs_queue_name(), for the priority"""
+
+    suffix = queue_name.rsplit('_', 1)[-1]
+    return suffix if suffix in priority_levels else default_priority
+
+
+class GpuAwareWorker(Worker):
+    """rq Worker which only dequeues the jobs whose gpu requirement can be satisfied right now.
+
+    The worker listens to the jobs queues (see jobs_queue_name) of the jobs that can run on the currently free gpus, so
+    that it does not block while waiting for gpus. The gpus of a job are claimed before it is started; if another
+    process took them in the meantime, the job is put back at the front of its queue.
+
+    The worker also listens to the queue of the jobs placed on its host (see host_jobs_queue_name), first. Then the jobs
+    queues are listened to in order of priority (see priority_levels).
+    """
+
+    gpu_poll_interval_secs = 2  # Interval at which the free gpus are checked while idle
+
+    def __init__(self, *args, **kwargs):
+        self.gpu_lock_manager = GpuLockManager()
+        super().__init__(self.get_queue_names(worker_hostname, len(self.gpu_lock_manager.locks)), *args, **kwargs)
+
+    @staticmethod
+    def get_queue_names(hostname: str, num_gpus: int) -> List[str]:
+        """Names of the queues to listen to, in order of priority"""
+
+        queue_names = [host_jobs_queue_name(hostname)]
+        for priority in priority_levels:
+            queue_names += [jobs_queue_name(n, priority) for n in range(num_gpus, -1, -1)]  # Largest gpu jobs first
+        return queue_names
+
+    def dequeue_job_and_maintain_ttl(self, timeout, max_idle_time=None):
+        idle_since = time.monotonic()
+        while True:
+            num_available_gpus = self.gpu_lock_manager.num_available_gpus()
+            self._ordered_queues = [q for q in self.queues if queue_num_gpus(q.name) <= num_available_gpus]
+            result = super().dequeue_job_and_maintain_ttl(timeout, max_idle_time=self.gpu_poll_interval_secs)
+            if result is not None or timeout is None:  # timeout is None in burst mode
+                return result
+            if max_idle_time is not None and time.monotonic() - idle_since >= max_idle_time:
+                return None  # The worker quits
+
+    def execute_job(self, job, queue):
+        num_gpus = job.meta.get('num_gpus', queue_num_gpus(queue.name))
+        if num_gpus == 0:
+            return super().execute_job(job, queue)
+
+        gpu_locks = self.gpu_lock_manager.try_acquire_gpus(num_gpus)
+        if gpu_locks is None:
+            queue.enqueue_job(job, at_front=True)  # The gpus have been taken by another process
+            self.gpu_lock_manager.wait_for_release(num_gpus, timeout_secs=self.gpu_poll_interval_secs)
+            return
+        os.environ[claimed_gpus_env_var] = ','.join(lock.gpu_id for lock in gpu_locks)  # Inherited by the work horse
+        try:
+            super().execute_job(job, queue)
+        finally:
+            del os.environ[claimed_gpus_env_var]
+            for gpu_lock in gpu_locks:
+                gpu_lock.release()
 
 
 def run(
@@ -21,14 +157,16 @@ def run(
         python_env_command: List[str],
         resume: bool
         ):
-    gpu_lock = None
+    gpu_locks = []
+    cpu_locks = []
     try:
         # Prepare the job
         config_file = output_path / 'config.yaml'
         config = yaml.load(config_dump)
-        if not resume:
-            # Setup task dir
-            output_path.mkdir(parents=True, exist_ok=False)
+        if not resume or not config_file.exists():
+            # Setup task dir. A resumed task starts over if its output is not on this host (e.g. it was lost by a dead
+            # host, see HtPlatform.handle_lost_jobs).
+            output_path.mkdir(parents=True, exist_ok=resume)
             config = yaml.load(config_dump)
             yaml.dump(config, config_file)
         stdout_path = output_path / 'out.txt'  # FIXME this ignores task.stdout_path
@@ -36,82 +174,150 @@ def run(
 
         # Manage GPU dependency
         env_vars = os.environ
-        if 'num_gpus' in config:
-            num_required_gpus = config['num_gpus']
-            if num_required_gpus > 1:
-                raise NotImplementedError
-            gpu_lock = GpuLockManager().acquire_one_gpu()
+        gpu_ids = []
+        if claimed_gpus_env_var in os.environ:
+            # The gpus have been claimed by the worker before dequeuing the job (see GpuAwareWorker)
             env_vars = os.environ.copy()
-            env_vars['CUDA_VISIBLE_DEVICES'] = gpu_lock.gpu_id
+            env_vars['CUDA_VISIBLE_DEVICES'] = env_vars.pop(claimed_gpus_env_var)
+            gpu_ids = env_vars['CUDA_VISIBLE_DEVICES'].split(',')
+        elif required_gpus(config) > 0:
+            gpu_locks = GpuLockManager().acquire_gpus(required_gpus(config))
+            gpu_ids = [lock.gpu_id for lock in gpu_locks]
+            env_vars = os.environ.copy()
+            env_vars['CUDA_VISIBLE_DEVICES'] = ','.join(gpu_ids)
+
+        # Pin the job to its own cpus, close to its gpus, if the placement is enabled
+        cpu_locks = claim_cpus(required_resources(config)['cpus'], gpu_ids)
 
         # Start the subprocess
-        p = subprocess.Popen(python_env_command + [str(script_file), str(config_file)],
-                             stdout=stdout_path.open(mode='w'),
-                             stderr=stderr_path.open(mode='w'),
-                             cwd=str(output_path),
-                             universal_newlines=True,
-                             env=env_vars)
+        p = start_script(python_env_command, script_file, config_file, output_path, stdout_path, stderr_path, env_vars,
+                         cpus=[lock.cpu for lock in cpu_locks])
 
-        # Write into to local db
-        job_id = get_current_job().id
-        with local_db_context() as db:
-            assert job_id not in db, 'Job id already exists in worker db.'
-            db[job_id] = {'pid': p.pid, 'status': TaskStatus.Unknown.value}
+        # Listen for cancellation before the job can be found in the local db (see cancel_jobs)
+        job = get_current_job()
+        job_id = job.id
+        events = queue.Queue()
+        pubsub = job.connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{cancel_channel_prefix + job_id: lambda message: events.put('cancelled')})
+        pubsub_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
 
-        # Monitor the job
-        monitor_interval = 2  # TODO config?
-        while True:
-            poll_result = p.poll()
-            if poll_result is None:
-                with local_db_context() as db:
-                    if db[job_id]['status'] == TaskStatus.Cancelled.value:
-                        break  # End the rq job, which will kill the subprocess
-                    else:
-                        db[job_id]['status'] = TaskStatus.Running.value
-            else:
-                if p.returncode == 0:
+        # Write into to local db
+        local_db.insert_job(job_id, p.pid, TaskStatus.Running.value)
+        _publish_job_status(job_id, TaskStatus.Running.value)
+
+        # Wait for the subprocess in a separate thread, so that its exit is an event like the cancellation
+        threading.Thread(target=lambda: events.put(p.wait()), daemon=True).start()
+
+        # Supervise the job. Nothing is written to the local db until a state transition occurs.
+        log_forwarder = LogForwarder(job.connection, job_id, output_path)
+        progress_summarizer = ProgressSummarizer(output_path)
+        next_cancel_check = time.monotonic() + cancel_check_interval_secs
+        try:
+            while True:
+                try:
+                    event = events.get(timeout=forward_interval_secs)
+                except queue.Empty:
+                    log_forwarder.forward()
+                    _update_progress(job.connection, job_id, progress_summarizer)
+                    _refresh_heartbeat(job.connection, job_id)
+                    if time.monotonic() < next_cancel_check:
+                        continue
+                    # The cancellation message is lost if the pubsub connection was down when it was published
+                    next_cancel_check = time.monotonic() + cancel_check_interval_secs
+                    if local_db.get_status(job_id) != TaskStatus.Cancelled.value:
+                        continue
+                    event = 'cancelled'
+                if event == 'cancelled':
+                    print('Cancelled')
+                    p.terminate()
+                    p.wait()
+                # Before the final status is published, so that the logs and the progress are complete
+                log_forwarder.close()
+                _update_progress(job.connection, job_id, progress_summarizer)
+                if event == 'cancelled':
+                    pass  # The status has been set by cancel_jobs
+                elif p.returncode == 0:
                     print('Finished successfully')
                     _set_job_status(job_id, TaskStatus.Finished.value)
                 else:
                     print('Crashed!')
                     _set_job_status(job_id, TaskStatus.Crashed.value)
                 break  # End the rq job
-            sleep(monitor_interval)
+        finally:
+            pubsub_thread.stop()  # The thread closes the pubsub connection
 
     except Exception:
         job_id = get_current_job().id
         _set_job_status(job_id, TaskStatus.RunFailed.value)
         raise
     finally:
-        # Release the GPU lock if needed
-        if gpu_lock is not None:
-            gpu_lock.release()
+        # Release the GPU and CPU locks if needed
+        for lock in gpu_locks + cpu_locks:
+            lock.release()
+        # Release the resources reserved on this host, if the job was placed (see HtPlatform.place_pending_jobs)
+        job = get_current_job()
+        job.connection.hdel(reservations_key_prefix + worker_hostname, job.id)
+
+
+def get_logs(output_path: str, offsets: Dict[str, int] = None, keys: List[str] = None, max_bytes: int = None):
+    """Return the logs appended after the given byte offsets, the new offsets and the starts (see read_logs).
 
+    The response is compressed with compress_data(), to reduce the load on Redis.
+    """
 
-def get_logs(output_path: str):
-    logs = {}
-    patterns = ('*.log', '*.txt')
-    for pattern in patterns:
-        for matched_file_path in Path(output_path).glob(pattern):
-            log_name = matched_file_path.stem
-            logs[log_name] = matched_file_path.read_text()
-    return logs
+    offsets = {} if offsets is None else dict(offsets)
+    starts = {}
+    logs = read_logs(output_path, offsets, keys, max_bytes, starts)
+    return compress_data({'logs': logs, 'offsets': offsets, 'starts': starts})
 
 
-def delete_job(job_id: str, output_path: str):
-    _delete_job(job_id)
-    print('Deleting', output_path)
-    shutil.rmtree(output_path,
-                  onerror=lambda function, path, excinfo: print('ERROR', function, path, excinfo))
+def call_and_reply(reply_key: str, func, args=()):
+    """Call func(*args) and push the outcome to the Redis list reply_key, on which the server is waiting.
 
+    The pushed value is the pickled tuple (True, result), or (False, error message) if func raised an exception.
+    """
+
+    try:
+        result = func(*args)
+    except Exception as e:
+        _push_reply(reply_key, (False, repr(e)))
+        raise
+    _push_reply(reply_key, (True, result))
 
-def cancel_job(job_id: str):
-    assert isinstance(job_id, str)
-    # We communicate with the running job through the local db
-    with local_db_context() as db:
-        if job_id not in db:
-            raise Exception('Cannot cancel job that is not in worker db')
-        db[job_id]['status'] = TaskStatus.Cancelled.value
+
+def _push_reply(reply_key: str, reply):
+    redis_conn = get_current_job().connection
+    pipe = redis_conn.pipeline()
+    pipe.rpush(reply_key, pickle.dumps(reply))
+    pipe.expire(reply_key, reply_ttl_secs)  # In case the server stopped waiting
+    pipe.execute()
+
+
+def delete_jobs(job_ids: List[str], output_paths: List[str]):
+    """Delete the jobs of this host, and their output. One request for all the jobs."""
+
+    _delete_jobs(job_ids)
+    for output_path in output_paths:
+        print('Deleting', output_path)
+        shutil.rmtree(output_path,
+                      onerror=lambda function, path, excinfo: print('ERROR', function, path, excinfo))
+
+
+def cancel_jobs(job_ids: List[str]):
+    """Cancel the jobs of this host. One request for all the jobs."""
+
+    # We communicate with the running jobs through the local db
+    known_jobs = local_db.get_jobs(job_ids=job_ids)
+    known_job_ids = [job_id for job_id in job_ids if job_id in known_jobs]
+    local_db.set_statuses(known_job_ids, TaskStatus.Cancelled.value)
+    pipe = get_current_job().connection.pipeline()
+    for job_id in known_job_ids:
+        _publish_job_status(job_id, TaskStatus.Cancelled.value, pipe)
+        pipe.publish(cancel_channel_prefix + job_id, 'cancel')  # Wakes up the running job
+    pipe.execute()
+    if len(known_job_ids) < len(job_ids):
+        unknown_job_ids = set(job_ids) - set(known_job_ids)
+        raise Exception(f'Cannot cancel jobs that are not in worker db: {", ".join(sorted(unknown_job_ids))}')
 
 
 def ping(msg):
@@ -122,37 +328,51 @@ def raise_exception(exc_type):
     raise exc_type
 
 
-def get_jobs_info():
-    with local_db_context() as db:
-        jobs_info = db
-    return jobs_info
+def get_jobs_info(active_only=True):
+    """Return the info of the jobs in the worker db: {job_id: {'pid': ..., 'status': ...}}"""
 
+    statuses = [s.value for s in TaskStatus.active_states()] if active_only else None
+    return local_db.get_jobs(statuses)
 
-def _check_init_db():
-    if not local_db.exists():
-        with local_db.open('wb') as f:
-            pickle.dump({}, f)
 
+def _set_job_status(job_id: str, status_str: str):
+    _publish_job_status(job_id, status_str)
+    local_db.set_status(job_id, status_str)
 
-@contextlib.contextmanager
-def local_db_context():
-    _check_init_db()  # FIXME avoid 2 opens
-    with local_db.open('r+b') as f:
-        db = pickle.load(f)
-        yield db
-        f.seek(0)
-        f.truncate()
-        pickle.dump(db, f)
 
+def _delete_jobs(job_ids: List[str]):
+    pipe = get_current_job().connection.pipeline()
+    pipe.hdel(job_status_key, *job_ids)
+    pipe.hdel(job_progress_key, *job_ids)
+    pipe.zrem(ended_jobs_key, *job_ids)
+    pipe.delete(*[log_stream_key_prefix + job_id for job_id in job_ids])
+    pipe.execute()
+    missing = local_db.delete_jobs(job_ids)
+    if missing:
+        print('Not in worker db:', ', '.join(missing))
+
+
+def _update_progress(redis_conn, job_id: str, progress_summarizer: ProgressSummarizer):
+    """Publish the summary of the progress of the job, if it changed"""
+
+    if progress_summarizer.update():
+        redis_conn.hset(job_progress_key, job_id, json.dumps(progress_summarizer.summary))
+
+
+def _refresh_heartbeat(redis_conn, job_id: str):
+    redis_conn.set(heartbeat_key_prefix + job_id, 1, ex=heartbeat_ttl_secs)
 
-def _set_job_status(job_id: str, status_str: str):
-    with local_db_context() as db:
-        db[job_id]['status'] = status_str
 
+def _publish_job_status(job_id: str, status_str: str, pipeline=None):
+    """Publish the status of a job in Redis, and refresh its heartbeat. Executed by the caller if pipeline is given."""
 
-def _delete_job(job_id: str):
-    with local_db_context() as db:
-        del db[job_id]
+    pipe = get_current_job().connection.pipeline() if pipeline is None else pipeline
+    pipe.hset(job_status_key, job_id, json.dumps({'status': status_str, 'hostname': worker_hostname}))
+    pipe.set(heartbeat_key_prefix + job_id, 1, ex=heartbeat_ttl_secs)
+    if not TaskStatus(status_str).is_active:
+        pipe.zadd(ended_jobs_key, {job_id: time.time()})
+    if pipeline is None:
+        pipe.execute()
 
 
 def test_job(msg: str):
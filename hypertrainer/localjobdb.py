@@ -0,0 +1,44 @@
+import json
+from typing import Dict, List
+
+from hypertrainer.sqlitetable import SqliteTable
+
+
+class LocalJobDb(SqliteTable):
+    """Table of the jobs of the LocalPlatform: job id -> launch args, and pid, start time, command and gpus once
+    started.
+
+    It outlives the server, so that the LocalPlatform can re-attach to its jobs after a restart (see
+    LocalPlatform._reattach).
+    """
+
+    schema = ['CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, args TEXT NOT NULL, pid INTEGER, '
+              'start_time INTEGER, command TEXT, gpu_ids TEXT)']
+
+    def insert_job(self, job_id: str, args: dict):
+        """Insert a pending job, with the json-serializable args needed to start it"""
+
+        with self._connect() as conn:
+            conn.execute('INSERT INTO jobs (job_id, args) VALUES (?, ?)', (job_id, json.dumps(args)))
+
+    def set_started(self, job_id: str, pid: int, start_time: int, command: List[str], gpu_ids: List[str]):
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET pid = ?, start_time = ?, command = ?, gpu_ids = ? WHERE job_id = ?',
+                         (pid, start_time, json.dumps(command), json.dumps(gpu_ids), job_id))
+
+    def delete_jobs(self, job_ids: List[str]):
+        with self._connect() as conn:
+            conn.executemany('DELETE FROM jobs WHERE job_id = ?', [(job_id,) for job_id in job_ids])
+
+    def get_jobs(self) -> Dict[str, dict]:
+        """Return {job_id: {'args': ..., 'pid': ..., 'start_time': ..., 'command': ..., 'gpu_ids': ...}}, in order of
+        insertion. The fields other than args are None for the jobs that have not been started.
+        """
+
+        with self._connect() as conn:
+            rows = conn.execute('SELECT job_id, args, pid, start_time, command, gpu_ids FROM jobs ORDER BY rowid')
+            rows = rows.fetchall()
+        return {job_id: {'args': json.loads(args), 'pid': pid, 'start_time': start_time,
+                         'command': None if command is None else json.loads(command),
+                         'gpu_ids': None if gpu_ids is None else json.loads(gpu_ids)}
+                for job_id, args, pid, start_time, command, gpu_ids in rows}
@@ -1,16 +1,66 @@
+import math
 import os
+import selectors
 import shutil
 import signal
-import subprocess
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, defaultdict
 from pathlib import Path
+from typing import Dict, List, Optional
 
 from hypertrainer.computeplatform import ComputePlatform
-from hypertrainer.utils import TaskStatus, get_python_env_command
+from hypertrainer.computeplatformtype import ComputePlatformType
+from hypertrainer.cpuplacement import CpuLock, claim_cpus, reclaim_cpus
+from hypertrainer.forkserver import start_script, ForkedProcess
+from hypertrainer.localjobdb import LocalJobDb
+from hypertrainer.resources import required_resources
+from hypertrainer.utils import TaskStatus, get_python_env_command, read_logs, read_config, GpuLockManager, GpuLock, \
+    hypertrainer_home, TestState
 
 
 class LocalPlatform(ComputePlatform):
+    """Runs the tasks as subprocesses of the server.
+
+    The submitted tasks wait in a local queue, and are started when the cpu and gpu slots they require are free (see
+    dispatch). There is one cpu slot per cpu by default, and one gpu slot per visible gpu; the gpus are claimed with
+    the GpuLockManager, so that they are shared with the HT workers of this host. If the cpu placement is enabled, each
+    task is also pinned to its own cpus (see cpuplacement.py).
+
+    The jobs are recorded in a LocalJobDb, and their exit code is written to a file by their launcher (see
+    start_script), so that a restarted server re-attaches to the jobs that are still running, and collects the exit
+    code of the others (see _reattach).
+
+    A background thread supervises the jobs: it records their exits as they happen, starts the pending jobs when slots
+    are freed, and writes the status transitions to the db in batches (see supervise). update_tasks does not poll the
+    processes.
+    """
+
+    records_statuses = True
+    supervision_interval_secs = 1  # At most, between two passes of the supervisor
+
     def __init__(self):
-        self.processes = {}
+        local_config = read_config().get('local_platform') or {}
+        self.cpu_slots = local_config.get('cpu_slots') or os.cpu_count()
+        self.gpu_lock_manager = GpuLockManager()
+
+        self.processes = {}  # Job id -> process
+        self.pending: Dict[str, dict] = OrderedDict()  # Job id -> launch args (see submit), in order of submission
+        self.used_cpus: Dict[str, int] = {}  # Job id -> cpu slots, for the running jobs
+        self.gpu_locks: Dict[str, List[GpuLock]] = {}  # Job id -> claimed gpus, for the running jobs
+        self.cpu_locks: Dict[str, List[CpuLock]] = {}  # Job id -> cpus it is pinned to, for the running jobs
+        self.failed = set()  # Ids of the jobs which could not be started
+        self.statuses: Dict[str, TaskStatus] = {}  # Job id -> status written to the db
+        self._supervised = set()  # Ids of the jobs whose final status has not been written to the db yet
+        self._exit_fds = {}  # Job id -> fd, or object with a fileno(), which becomes readable when the job exits
+        self._lock = threading.Lock()  # The tasks are submitted and updated from several threads, and supervised
+
+        self.job_db = LocalJobDb(self._get_job_db_path())
+        self._dormant: Dict[str, dict] = OrderedDict()  # Job id -> launch args, for the pending jobs of the last run
+        self._reattach()
+        threading.Thread(target=self.supervise, daemon=True).start()
 
     def submit(self, task, resume=False):
         job_path: Path = self._make_job_path(task)
@@ -20,58 +70,316 @@ class LocalPlatform(ComputePlatform):
             job_path.mkdir(parents=True, exist_ok=False)
             task.output_path = str(job_path)
             config_file.write_text(task.dump_config())
-        # Launch process
         script_file_local = Path(task.script_file)
         if not script_file_local.is_absolute():
             script_file_local = Path(task.project_path) / script_file_local
-        python_env_command = get_python_env_command(Path(task.project_path), task.platform_type.value)
-
-        p = subprocess.Popen(python_env_command + [str(script_file_local), str(config_file)],
-                             stdout=task.stdout_path.open(mode='w'),
-                             stderr=task.stderr_path.open(mode='w'),
-                             cwd=task.output_path,
-                             universal_newlines=True)
-        job_id = str(p.pid)
-        self.processes[job_id] = p
+        required = required_resources(task.config)
+
+        job_id = str(uuid.uuid4())
+        args = dict(
+            python_env_command=get_python_env_command(Path(task.project_path), task.platform_type.value),
+            script_file=str(script_file_local),
+            config_file=str(config_file),
+            cwd=task.output_path,
+            stdout_path=str(task.stdout_path),
+            stderr_path=str(task.stderr_path),
+            exit_code_path=str(Path(task.output_path) / '.exit_code'),
+            cpus=min(math.ceil(required['cpus']), self.cpu_slots),  # Otherwise the task could never start
+            gpus=int(required['gpus']))
+        with self._lock:
+            self.job_db.insert_job(job_id, args)
+            self.pending[job_id] = args
+            self.statuses[job_id] = TaskStatus.Waiting  # The status of the new tasks
+            self._supervised.add(job_id)
+            self.dispatch()
         return job_id
 
-    def fetch_logs(self, task, keys=None):
-        job_path = self._make_job_path(task)
-        logs = {}
-        patterns = ('*.log', '*.txt')
-        for pattern in patterns:
-            for f in job_path.glob(pattern):
-                p = Path(f)
-                logs[p.stem] = p.read_text()
-        return logs
+    def dispatch(self):
+        """Start the pending jobs whose slots are free, in order of submission.
+
+        A job which does not fit is skipped, so that it does not block the smaller jobs behind it. The caller must hold
+        self._lock.
+        """
+
+        self._release_exited()
+        for job_id, args in list(self.pending.items()):
+            if args['cpus'] > self.cpu_slots - sum(self.used_cpus.values()):
+                continue
+            gpu_locks = []
+            if args['gpus'] > 0:
+                if args['gpus'] > len(self.gpu_lock_manager.locks):
+                    print(f'Cannot start job {job_id}: {args["gpus"]} GPUs are required, but only '
+                          f'{len(self.gpu_lock_manager.locks)} are visible.')
+                    del self.pending[job_id]
+                    self.failed.add(job_id)
+                    continue
+                gpu_locks = self.gpu_lock_manager.try_acquire_gpus(args['gpus'])
+                if gpu_locks is None:
+                    continue  # Wait for gpus to be released
+            del self.pending[job_id]
+            self._start(job_id, args, gpu_locks)
+
+    def _start(self, job_id: str, args: dict, gpu_locks: List[GpuLock]):
+        env = None
+        if gpu_locks:
+            env = os.environ.copy()
+            env['CUDA_VISIBLE_DEVICES'] = ','.join(lock.gpu_id for lock in gpu_locks)
+        exit_code_path = Path(args['exit_code_path'])
+        cpu_locks = []
+        try:
+            if exit_code_path.exists():
+                exit_code_path.unlink()  # Written by a previous run of the task
+            cpu_locks = claim_cpus(args['cpus'], [lock.gpu_id for lock in gpu_locks])
+            p = start_script(args['python_env_command'], Path(args['script_file']), Path(args['config_file']),
+                             Path(args['cwd']), Path(args['stdout_path']), Path(args['stderr_path']), env,
+                             exit_code_path, [lock.cpu for lock in cpu_locks])
+            self.job_db.set_started(job_id, p.pid, _process_start_time(p.pid),
+                                    args['python_env_command'] + [args['script_file'], args['config_file']],
+                                    [lock.gpu_id for lock in gpu_locks])
+        except Exception:
+            traceback.print_exc()
+            for lock in gpu_locks + cpu_locks:
+                lock.release()
+            self.failed.add(job_id)
+            return
+        self.processes[job_id] = p
+        self.used_cpus[job_id] = args['cpus']
+        self.gpu_locks[job_id] = gpu_locks
+        self.cpu_locks[job_id] = cpu_locks
+        self._watch_exit(job_id, p)
+
+    def _reattach(self):
+        """Re-attach to the jobs started by a previous instance of the server, and keep its pending jobs.
+
+        A job whose pid now belongs to another process (see _process_start_time) is lost, unless it wrote its exit
+        code. The gpus and cpus of the running jobs are claimed again, since their locks were released with the previous
+        server.
+        The pending jobs are dormant until their task is updated (see update_tasks), in case it is gone.
+        """
+
+        for job_id, job in self.job_db.get_jobs().items():
+            if job['pid'] is None:
+                self._dormant[job_id] = job['args']
+                continue
+            self._supervised.add(job_id)
+            p = AttachedProcess(job['pid'], job['start_time'], Path(job['args']['exit_code_path']))
+            is_running = p.is_running()
+            if not is_running and not p.exit_code_path.exists():
+                continue  # Lost
+            if is_running:
+                self._watch_exit(job_id, p)
+                gpu_locks = [GpuLock(gpu_id) for gpu_id in job['gpu_ids']]
+                for gpu_lock in gpu_locks:
+                    if not gpu_lock.try_acquire():
+                        print(f'GPU {gpu_lock.gpu_id} of job {job_id} has been claimed by another process')
+                self.gpu_locks[job_id] = [lock for lock in gpu_locks if lock.is_locked]
+                self.cpu_locks[job_id] = reclaim_cpus(p.pid)
+                self.used_cpus[job_id] = job['args']['cpus']
+            self.processes[job_id] = p
+
+    def _release_exited(self):
+        """Free the slots of the jobs which have exited"""
+
+        for job_id in list(self.used_cpus):
+            if self.processes[job_id].poll() is not None:
+                del self.used_cpus[job_id]
+                for lock in self.gpu_locks.pop(job_id) + self.cpu_locks.pop(job_id):
+                    lock.release()
+                exit_fd = self._exit_fds.pop(job_id, None)
+                if isinstance(exit_fd, int):
+                    os.close(exit_fd)
+
+    def _watch_exit(self, job_id: str, p):
+        """Wake up the supervisor when the process exits, with a pidfd, or the connection of a forked process"""
+
+        if isinstance(p, ForkedProcess):
+            self._exit_fds[job_id] = p
+            return
+        try:
+            self._exit_fds[job_id] = os.pidfd_open(p.pid)
+        except (AttributeError, OSError):
+            pass  # Not supported (Python < 3.9, or Linux < 5.3): the exit is noticed at the next pass
+
+    def supervise(self):
+        """Record the exits of the jobs, start the pending jobs when slots are freed, and write the status transitions
+        to the db in batches. Runs in a background thread.
+        """
+
+        while True:
+            try:
+                self._wait_for_exits(self.supervision_interval_secs)
+                with self._lock:
+                    self.dispatch()
+                    changes = {}
+                    for job_id in self._supervised:
+                        status = self._get_status(job_id)
+                        if status != self.statuses.get(job_id):
+                            changes[job_id] = status
+                    self.statuses.update(changes)
+                    ended = [job_id for job_id, status in changes.items() if not status.is_active]
+                    self._supervised.difference_update(ended)
+                self._write_statuses(changes)
+                # The status will not be requested again. Only once it is in the db, since a restart of the server
+                # in between re-attaches to the jobs which are still in the job db.
+                self.job_db.delete_jobs(ended)
+            except Exception:
+                traceback.print_exc()
+                time.sleep(self.supervision_interval_secs)
+
+    def _wait_for_exits(self, timeout: float):
+        """Block until a job exits, or the timeout"""
+
+        with self._lock:
+            exit_fds = list(self._exit_fds.values())
+        with selectors.DefaultSelector() as selector:
+            for exit_fd in exit_fds:
+                try:
+                    selector.register(exit_fd, selectors.EVENT_READ)
+                except (ValueError, OSError):
+                    pass  # Closed in the meantime: the job has exited
+            if selector.get_map():
+                selector.select(timeout)
+            else:
+                time.sleep(timeout)
+
+    @staticmethod
+    def _write_statuses(statuses: Dict[str, TaskStatus]):
+        """Write the statuses of the jobs to the tasks in the db, in one transaction"""
+
+        from hypertrainer.task import Task  # NOTE: Not at module level, since the db is chosen when it is imported
+
+        if not statuses:
+            return
+        job_ids_by_status = defaultdict(list)
+        for job_id, status in statuses.items():
+            job_ids_by_status[status].append(job_id)
+        with Task._meta.database.atomic():
+            for status, job_ids in job_ids_by_status.items():
+                # The tasks which have been cancelled in the meantime are not updated
+                Task.update(status=status).where((Task.platform_type == ComputePlatformType.LOCAL)
+                                                 & Task.job_id.in_(job_ids)
+                                                 & Task.status.in_(TaskStatus.active_states())).execute()
+
+    def fetch_logs(self, task, keys=None, offsets=None, max_bytes=None, starts=None):
+        return read_logs(self._make_job_path(task), offsets, keys, max_bytes, starts)
 
     def cancel(self, task):
-        os.kill(int(task.job_id), signal.SIGTERM)
+        with self._lock:
+            if self.pending.pop(task.job_id, None) is None:
+                p = self.processes.get(task.job_id)
+                if p is not None and p.poll() is None:
+                    os.kill(p.pid, signal.SIGTERM)
+            self.statuses[task.job_id] = TaskStatus.Cancelled
+            self._supervised.discard(task.job_id)
+            self.job_db.delete_jobs([task.job_id])
         task.status = TaskStatus.Cancelled
         task.save()
 
     def update_tasks(self, tasks):
+        """The statuses of the supervised jobs are written to the db by the supervisor: they are the ones the tasks were
+        read with. The statuses of the other jobs (e.g. lost) are set here, and written to the db. The processes of
+        the supervised jobs are not polled here.
+        """
+
+        with self._lock:
+            restored = [t.job_id for t in tasks if t.job_id in self._dormant]
+            for job_id in restored:
+                self.pending[job_id] = self._dormant.pop(job_id)  # Pending before the server restarted
+                self.statuses[job_id] = TaskStatus.Waiting
+                self._supervised.add(job_id)
+            if restored:
+                self.dispatch()
+            unsupervised = {t.job_id: self._get_status(t.job_id) for t in tasks
+                            if t.job_id not in self._supervised and t.job_id not in self.statuses}
+        self._write_statuses(unsupervised)
         for t in tasks:
             assert t.status.is_active
+            if t.job_id in unsupervised:
+                t.status = unsupervised[t.job_id]
 
-            p = self.processes.get(t.job_id)
-            if p is None:
-                t.status = TaskStatus.Lost
-                continue
-            poll_result = p.poll()
-            if poll_result is None:
-                t.status = TaskStatus.Running
-            else:
-                if p.returncode == 0:
-                    t.status = TaskStatus.Finished
-                else:
-                    t.status = TaskStatus.Crashed
+    def _get_status(self, job_id: str) -> TaskStatus:
+        if job_id in self.pending:
+            return TaskStatus.Waiting
+        if job_id in self.failed:
+            return TaskStatus.RunFailed
+        p = self.processes.get(job_id)
+        if p is None:
+            return TaskStatus.Lost
+        poll_result = p.poll()
+        if poll_result is None:
+            return TaskStatus.Running
+        elif poll_result == 0:
+            return TaskStatus.Finished
+        else:
+            return TaskStatus.Crashed
 
     def delete(self, task):
+        with self._lock:
+            self.pending.pop(task.job_id, None)
+            self._dormant.pop(task.job_id, None)
+            self._supervised.discard(task.job_id)
+            self.job_db.delete_jobs([task.job_id])
         print('Deleting', task.output_path)
         shutil.rmtree(task.output_path,
                       onerror=lambda function, path, excinfo: print('ERROR', function, path, excinfo))
 
+    @staticmethod
+    def _get_job_db_path() -> Path:
+        if TestState.test_mode:
+            # Decided here, since this module can be imported before the test mode is set. One db per test session.
+            return Path(f'/tmp/dummy_ht_local_jobs_{os.getpid()}.sqlite')
+        return hypertrainer_home / 'local_jobs.sqlite'
+
     @staticmethod
     def _make_job_path(task):
         return Path(task.output_root) / str(task.uuid)
+
+
+class AttachedProcess:
+    """A process started by a previous instance of the server. Same interface as subprocess.Popen, for the parts used by
+    the LocalPlatform.
+
+    Its exit code is read from the file written by its launcher (see start_script), since it is not a child of this
+    process.
+    """
+
+    lost_returncode = 1  # If the process exited without writing its exit code
+    exit_code_delay_secs = 5  # The fork server writes the exit code after the process exits
+
+    def __init__(self, pid: int, start_time: int, exit_code_path: Path):
+        self.pid = pid
+        self.start_time = start_time
+        self.exit_code_path = exit_code_path
+        self.returncode: Optional[int] = None
+        self._exited_at = None
+
+    def is_running(self) -> bool:
+        """False if the process has exited, even if its pid has been reused"""
+
+        return self.start_time is not None and _process_start_time(self.pid) == self.start_time
+
+    def poll(self) -> Optional[int]:
+        if self.returncode is None and not self.is_running():
+            if self.exit_code_path.exists():
+                self.returncode = int(self.exit_code_path.read_text())
+            elif self._exited_at is None:
+                self._exited_at = time.monotonic()
+            elif time.monotonic() - self._exited_at > self.exit_code_delay_secs:
+                self.returncode = self.lost_returncode
+        return self.returncode
+
+
+def _process_start_time(pid: int) -> Optional[int]:
+    """Start time of a process, in clock ticks after boot, from /proc/<pid>/stat. None if the process does not exist.
+
+    The pid and the start time identify a process, since pids are reused.
+    """
+
+    try:
+        stat = Path(f'/proc/{pid}/stat').read_text()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    fields = stat[stat.rindex(')') + 2:].split()  # The name of the executable, in parentheses, can contain spaces
+    if fields[0] == 'Z':
+        return None  # Zombie: exited, but not reaped yet by its parent
+    return int(fields[19])
@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional, Iterable, Set, Tuple
+
+import numpy as np
+
+from hypertrainer.utils import read_log_bytes
+
+
+class LogParser:
+    """Incrementally interprets the progress and metric logs of a task.
+
+    The parser is fed with the data appended to the logs since the last call, and keeps running aggregates, so that
+    the cost of an update only depends on the amount of new data. The metric rows are not kept: they are meant to be
+    appended to the MetricStore.
+    """
+
+    def __init__(self):
+        self._partial_lines: Dict[str, str] = {}  # Incomplete last line of each log
+
+        # Progress. Columns = epoch_idx, phase, iter_idx, iter_per_epoch, unix_timestamp
+        self.cur_epoch: Optional[int] = None
+        self.cur_phase: Optional[str] = None
+        self.cur_iter: Optional[int] = None
+        self.iter_per_epoch: Optional[int] = None
+        self.epoch_start_times: Dict[int, float] = {}
+
+        # Metrics. Columns = epoch_idx, value; or epoch_idx, class_idx, value
+        # The new rows are kept until they are collected with pop_metric_updates()
+        self._new_metric_rows: Dict[Tuple[str, Optional[str]], List[List[float]]] = {}  # (metric, label) -> rows
+        self._cleared_metrics: Set[str] = set()
+
+    @property
+    def has_progress(self):
+        return self.cur_epoch is not None
+
+    @property
+    def epoch_duration(self) -> Optional[float]:
+        """Mean duration of the completed epochs"""
+
+        if len(self.epoch_start_times) < 2:
+            return None
+        epochs = sorted(self.epoch_start_times)
+        first, last = self.epoch_start_times[epochs[0]], self.epoch_start_times[epochs[-1]]
+        return (last - first) / (len(epochs) - 1)  # Mean of the differences between consecutive start times
+
+    @property
+    def cur_epoch_start_time(self) -> Optional[float]:
+        if not self.epoch_start_times:
+            return None
+        return self.epoch_start_times[max(self.epoch_start_times)]
+
+    def progress_summary(self) -> Optional[dict]:
+        """The current state of the progress, or None if no progress has been logged (see Task.set_progress)"""
+
+        if not self.has_progress:
+            return None
+        return {'cur_epoch': self.cur_epoch, 'cur_phase': self.cur_phase, 'cur_iter': self.cur_iter,
+                'iter_per_epoch': self.iter_per_epoch, 'epoch_duration': self.epoch_duration,
+                'cur_epoch_start_time': self.cur_epoch_start_time}
+
+    def pop_metric_updates(self) -> Tuple[Set[str], Dict[Tuple[str, Optional[str]], np.ndarray]]:
+        """Return the metrics that must be cleared, and the new rows of each (metric, class label) pair.
+
+        The label is None for metrics that are not classwise. The metrics must be cleared before appending the new
+        rows.
+        """
+
+        cleared = self._cleared_metrics
+        new_rows = {key: np.array(rows, dtype=float) for key, rows in self._new_metric_rows.items()}
+        self._cleared_metrics = set()
+        self._new_metric_rows = {}
+        return cleared, new_rows
+
+    def feed(self, name: str, data: str):
+        """Consume the data appended to the log `name`"""
+
+        if name == 'progress':
+            for row in self._new_rows(name, data, num_columns=5):
+                self._consume_progress(row)
+        elif name.startswith('metric_'):
+            m_name = metric_name(name)
+            if name.startswith('metric_classwise_'):
+                for epoch_idx, class_idx, value in self._new_rows(name, data, num_columns=3):
+                    label = str(int(float(class_idx))) if _is_number(class_idx) else class_idx
+                    self._new_metric_rows.setdefault((m_name, label), []).append([float(epoch_idx), float(value)])
+            else:
+                for epoch_idx, value in self._new_rows(name, data, num_columns=2):
+                    self._new_metric_rows.setdefault((m_name, None), []).append([float(epoch_idx), float(value)])
+
+    def reset(self, names: Iterable[str]):
+        """Forget what was consumed from the specified logs (e.g. because they have been rewritten)"""
+
+        for name in names:
+            self._partial_lines.pop(name, None)
+            if name == 'progress':
+                self.cur_epoch = self.cur_phase = self.cur_iter = self.iter_per_epoch = None
+                self.epoch_start_times = {}
+            elif name.startswith('metric_'):
+                m_name = metric_name(name)
+                self._cleared_metrics.add(m_name)
+                for key in [key for key in self._new_metric_rows if key[0] == m_name]:
+                    del self._new_metric_rows[key]
+
+    def _consume_progress(self, row):
+        ep_idx, phase, iter_idx, iter_per_epoch, timestamp = row
+        self.cur_epoch = int(float(ep_idx))
+        self.cur_phase = phase
+        self.cur_iter = int(float(iter_idx))
+        self.iter_per_epoch = int(float(iter_per_epoch))
+        timestamp = float(timestamp)
+        start_time = self.epoch_start_times.get(self.cur_epoch)
+        if start_time is None or timestamp < start_time:
+            self.epoch_start_times[self.cur_epoch] = timestamp
+
+    def _new_rows(self, name: str, data: str, num_columns: int):
+        """Split the complete lines of data into columns, skipping headers and malformed lines"""
+
+        data = self._partial_lines.pop(name, '') + data
+        lines = data.split('\n')
+        if lines[-1] != '':
+            self._partial_lines[name] = lines[-1]  # Keep the incomplete line for the next call
+        for line in lines[:-1]:
+            row = line.split()
+            if len(row) == num_columns and _is_number(row[0]):  # Handle presence/absence of header
+                yield row
+
+
+class ProgressSummarizer:
+    """Tails the progress log of a running job, and keeps the summary of its progress (see LogParser.progress_summary).
+
+    Used by the HT workers, so that the server receives the summary instead of the whole log.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.offsets: Dict[str, int] = {}
+        self.parser = LogParser()
+
+    @property
+    def summary(self) -> Optional[dict]:
+        return self.parser.progress_summary()
+
+    def update(self) -> bool:
+        """Consume the data appended to the progress log since the last call. Return True if the summary changed."""
+
+        previous_offset = self.offsets.get('progress', 0)
+        starts = {}
+        data = read_log_bytes(self.output_path, self.offsets, keys=['progress'], starts=starts).get('progress')
+        if not data:
+            return False
+        if starts['progress'] < previous_offset:
+            self.parser.reset(['progress'])  # The log has been rewritten
+        summary = self.summary
+        self.parser.feed('progress', data.decode('utf-8', errors='replace'))  # data never ends in a character
+        return self.summary != summary
+
+
+def metric_name(log_name: str) -> str:
+    """Examples: 'metric_loss' -> 'loss', 'metric_classwise_iou' -> 'iou'"""
+
+    m_name = log_name.partition('_')[2]  # Example: 'd_j_trump'.partition('_') -> ('d', '_', 'j_trump')
+    if log_name.startswith('metric_classwise_'):
+        m_name = m_name.partition('_')[2]
+    return m_name
+
+
+def _is_number(s: str):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
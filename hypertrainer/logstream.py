@@ -0,0 +1,136 @@
+from typing import Dict, Iterable, Optional
+
+from redis import Redis
+
+from hypertrainer.utils import read_log_bytes, match_log_keys, capped_logs, lstrip_continuation_bytes
+
+log_stream_key_prefix = 'hypertrainer:logs:'  # + job id
+log_stream_maxlen = 2000  # Entries. The oldest entries are trimmed.
+log_stream_chunk_bytes = 16 * 1024  # Max size of the data of an entry
+log_stream_ttl_secs = 24 * 3600  # After the end of the job
+log_stream_read_count = 200  # Entries per XREAD
+
+
+class LogForwarder:
+    """Tails the logs of a running job, and appends the new data to the job's Redis stream.
+
+    Each entry holds a chunk of one log: {'seq': entry number, 'name': log name, 'start': byte offset, 'data': bytes}.
+    The stream is read by LogStreamReader, so that the server does not have to ask the worker for the logs.
+    """
+
+    def __init__(self, redis_conn: Redis, job_id: str, output_path):
+        self.redis_conn = redis_conn
+        self.stream_key = log_stream_key_prefix + job_id
+        self.output_path = output_path
+        self.offsets: Dict[str, int] = {}
+        self.seq = 0
+
+    def forward(self):
+        """Send the data appended to the logs since the last call"""
+
+        starts = {}
+        logs = read_log_bytes(self.output_path, self.offsets, starts=starts)
+        pipe = self.redis_conn.pipeline()
+        for name, data in logs.items():
+            start = starts[name]
+            while data:
+                chunk = _split_chunk(data, log_stream_chunk_bytes)
+                pipe.xadd(self.stream_key, {'seq': self.seq, 'name': name, 'start': start, 'data': chunk},
+                          maxlen=log_stream_maxlen, approximate=True)
+                self.seq += 1
+                start += len(chunk)
+                data = data[len(chunk):]
+        pipe.execute()
+
+    def close(self):
+        """Send the remaining data, and let the stream expire"""
+
+        self.forward()
+        self.redis_conn.expire(self.stream_key, log_stream_ttl_secs)
+
+
+class LogStreamReader:
+    """Reads the logs of the HT jobs from their Redis streams (see LogForwarder).
+
+    The position reached in each stream is kept, so that only the new entries are read. The stream is read from the
+    beginning if the caller needs older data (e.g. more history, or logs that were filtered out by keys).
+    """
+
+    def __init__(self, redis_conn: Redis):
+        self.redis_conn = redis_conn
+        self._cursors: Dict[str, tuple] = {}  # job id -> (last entry id, last seq, {name: end byte offset})
+
+    def read(self, job_id: str, offsets: Dict[str, int], keys: Iterable[str] = None, max_bytes: int = None,
+             starts: Dict[str, int] = None) -> Optional[Dict[str, str]]:
+        """Same interface as read_logs() with offsets. Return None if the stream cannot provide the requested data
+        (the stream does not exist, or entries have been trimmed).
+        """
+
+        stream_key = log_stream_key_prefix + job_id
+        last_id, last_seq, ends = self._cursors.get(job_id, ('0', -1, {}))
+        if any(offsets.get(name, 0) < end for name, end in ends.items() if match_log_keys(name, keys)):
+            last_id, last_seq, ends = '0', -1, {}  # The caller needs data that was already read
+        ends = dict(ends)
+
+        segments: Dict[str, list] = {}  # name -> [start, data, restarted]. Data read in this call.
+        trimmed = False
+        while True:
+            response = self.redis_conn.xread({stream_key: last_id}, count=log_stream_read_count)
+            entries = response[0][1] if response else []
+            if not entries and last_id == '0':
+                self._cursors.pop(job_id, None)
+                return None  # The stream does not exist (yet), or it has expired
+            for entry_id, fields in entries:
+                seq = int(fields[b'seq'])
+                trimmed = trimmed or seq != last_seq + 1  # Some entries have been trimmed
+                last_id, last_seq = entry_id, seq
+                name, start, data = fields[b'name'].decode(), int(fields[b'start']), fields[b'data']
+                if trimmed:
+                    ends[name] = start + len(data)  # Only the position is needed
+                    continue
+                if name in segments and start == ends[name]:
+                    segments[name][1] += data
+                else:
+                    restarted = name in ends and start != ends[name]  # The file has been truncated
+                    segments[name] = [start, data, restarted]
+                ends[name] = start + len(data)
+            if len(entries) < log_stream_read_count:
+                break
+        # When entries have been trimmed, the caller reads the logs through the worker; the next call resumes here
+        self._cursors[job_id] = (last_id, last_seq, ends)
+        if trimmed:
+            return None
+
+        logs = {}
+        for name, (start, data, restarted) in segments.items():
+            if not match_log_keys(name, keys):
+                continue
+            offset = offsets.get(name, 0)
+            if not restarted and start <= offset:
+                if offset >= ends[name]:
+                    continue  # The caller is already further (e.g. it read the file through the worker)
+                data = data[offset - start:]
+                start = offset
+            if max_bytes is not None and name in capped_logs and len(data) > max_bytes:
+                stripped = lstrip_continuation_bytes(data[-max_bytes:])  # Do not start in the middle of a character
+                start += len(data) - len(stripped)
+                data = stripped
+            logs[name] = data.decode('utf-8', errors='replace')
+            offsets[name] = ends[name]
+            if starts is not None:
+                starts[name] = start
+        return logs
+
+    def forget(self, job_id: str):
+        self._cursors.pop(job_id, None)
+
+
+def _split_chunk(data: bytes, max_bytes: int) -> bytes:
+    """Return the beginning of data, up to max_bytes, without splitting a character"""
+
+    if len(data) <= max_bytes:
+        return data
+    end = max_bytes
+    while end > 0 and data[end] & 0b1100_0000 == 0b1000_0000:  # data[end] is a continuation byte
+        end -= 1
+    return data[:end]
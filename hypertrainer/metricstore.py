@@ -0,0 +1,104 @@
+import shutil
+import threading
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from hypertrainer.utils import hypertrainer_home, TestState
+
+
+class MetricStore:
+    """Server-side storage of the metrics of the tasks.
+
+    Each (task, metric) pair has its own append-only binary file of float64 rows (epoch_idx, value), which is read
+    back with numpy.memmap. A classwise metric is a directory containing one such file per class.
+
+    Layout: root/<task uuid>/<metric>.f8 or root/<task uuid>/<metric>/<class label>.f8
+    """
+
+    suffix = '.f8'
+    dtype = np.dtype('<f8')
+    num_columns = 2
+
+    def __init__(self, root: Path = None):
+        """root: default, hypertrainer_home/metrics, or a directory in /tmp in test mode. It is chosen on first use."""
+
+        self._root = root
+        self._root_lock = threading.Lock()  # The tasks are monitored from several threads
+
+    @property
+    def root(self) -> Path:
+        with self._root_lock:
+            if self._root is None:
+                self._root = self._default_root()
+            return self._root
+
+    @staticmethod
+    def _default_root() -> Path:
+        if TestState.test_mode:
+            # Decided here, since this module can be imported before the test mode is set. Emptied once per session.
+            root = Path('/tmp/dummy_ht_metrics')
+            shutil.rmtree(str(root), ignore_errors=True)
+            return root
+        return hypertrainer_home / 'metrics'
+
+    def append(self, task_uuid, metric: str, rows: np.ndarray, label: Optional[str] = None):
+        """Append rows to a metric. The label must be given for classwise metrics."""
+
+        path = self._make_path(task_uuid, metric, label)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('ab') as f:
+            f.write(np.asarray(rows, dtype=self.dtype).reshape(-1, self.num_columns).tobytes())
+
+    def clear(self, task_uuid, metric: str):
+        """Delete all the data of a metric"""
+
+        path = self._make_path(task_uuid, metric)
+        if path.exists():
+            path.unlink()
+        classwise_dir = path.with_suffix('')
+        if classwise_dir.is_dir():
+            shutil.rmtree(str(classwise_dir))
+
+    def delete(self, task_uuid):
+        """Delete all the metrics of a task"""
+
+        shutil.rmtree(str(self.root / str(task_uuid)), ignore_errors=True)
+
+    def load(self, task_uuid) -> dict:
+        """Return the metrics of a task, as a dict: {name: array} or {name: {class_label: array}}
+
+        The arrays are memory-mapped, and have one row (epoch_idx, value) per entry.
+        """
+
+        task_dir = self.root / str(task_uuid)
+        if not task_dir.exists():
+            return {}
+        metrics = {}
+        for path in sorted(task_dir.iterdir()):
+            if path.is_dir():
+                class_paths = sorted(path.glob('*' + self.suffix), key=lambda p: _label_sort_key(p.stem))
+                metrics[path.name] = {p.stem: self._map(p) for p in class_paths}
+            elif path.suffix == self.suffix:
+                metrics[path.stem] = self._map(path)
+        return metrics
+
+    def _map(self, path: Path) -> np.ndarray:
+        num_rows = path.stat().st_size // (self.dtype.itemsize * self.num_columns)  # Ignore an incomplete last row
+        if num_rows == 0:
+            return np.empty((0, self.num_columns), dtype=self.dtype)
+        return np.memmap(str(path), dtype=self.dtype, mode='r', shape=(num_rows, self.num_columns))
+
+    def _make_path(self, task_uuid, metric: str, label: Optional[str] = None) -> Path:
+        if label is None:
+            return self.root / str(task_uuid) / (metric + self.suffix)
+        else:
+            return self.root / str(task_uuid) / metric / (label + self.suffix)
+
+
+def _label_sort_key(label: str):
+    return (0, int(label), '') if label.isdigit() else (1, 0, label)
+
+
+metric_store = MetricStore()
@@ -0,0 +1,68 @@
+from pathlib import Path
+from typing import Dict, Optional
+
+resource_names = ('cpus', 'mem_gb', 'gpus')
+
+
+def has_declared_resources(config: dict) -> bool:
+    return 'resources' in config
+
+
+def required_resources(config: dict) -> Dict[str, float]:
+    """Resources required by a task, from its config.
+
+    Example config: resources: {cpus: 4, mem_gb: 16, gpus: 1}. The defaults are 1 cpu, no memory and num_gpus gpus.
+    """
+
+    declared = config.get('resources') or {}
+    unknown = set(declared.keys()) - set(resource_names)
+    if unknown:
+        raise ValueError(f'Unknown resources: {", ".join(sorted(unknown))}')
+    required = {'cpus': 1, 'mem_gb': 0, 'gpus': config.get('num_gpus', 0)}
+    required.update(declared)
+    return required
+
+
+def required_gpus(config: dict) -> int:
+    return int(required_resources(config)['gpus'])
+
+
+def read_host_capacity(proc_path=Path('/proc'), num_gpus: int = 0) -> Dict[str, float]:
+    """Total resources of this host: cpus from /proc/cpuinfo, mem_gb from /proc/meminfo"""
+
+    cpuinfo = (proc_path / 'cpuinfo').read_text()
+    num_cpus = sum(1 for line in cpuinfo.splitlines() if line.startswith('processor'))
+    mem_kb = 0
+    for line in (proc_path / 'meminfo').read_text().splitlines():
+        if line.startswith('MemTotal:'):
+            mem_kb = int(line.split()[1])
+    return {'cpus': num_cpus, 'mem_gb': mem_kb / 1024 ** 2, 'gpus': num_gpus}
+
+
+def free_resources(capacity: Dict[str, float], reservations) -> Dict[str, float]:
+    """Capacity minus the sum of the reservations (an iterable of resources dicts)"""
+
+    free = dict(capacity)
+    for reserved in reservations:
+        for r in resource_names:
+            free[r] -= reserved.get(r, 0)
+    return free
+
+
+def best_fit_host(free: Dict[str, Dict[str, float]], capacities: Dict[str, Dict[str, float]],
+                  required: Dict[str, float]) -> Optional[str]:
+    """Choose the host on which the required resources fit most tightly (best-fit bin packing).
+
+    The leftover of each resource is normalized by the capacity of the host. Return None if the resources do not fit
+    on any host.
+    """
+
+    best_host, best_leftover = None, None
+    for host, host_free in free.items():
+        if any(host_free[r] < required[r] for r in resource_names):
+            continue
+        leftover = sum((host_free[r] - required[r]) / capacities[host][r]
+                       for r in resource_names if capacities[host][r] > 0)
+        if best_leftover is None or leftover < best_leftover:
+            best_host, best_leftover = host, leftover
+    return best_host
@@ -1,13 +1,16 @@
+import shlex
 import subprocess
-import tempfile
-from glob import glob
 from pathlib import Path
+from typing import Dict
 
 from hypertrainer.computeplatform import ComputePlatform
-from hypertrainer.utils import TaskStatus, parse_columns
+from hypertrainer.sshconnection import SshConnection
+from hypertrainer.utils import TaskStatus, parse_columns, add_log_bytes, capped_logs
 
 
 class SlurmPlatform(ComputePlatform):
+    """Submits the tasks to a Slurm cluster through ssh, over a persistent connection (see SshConnection)"""
+
     status_map = {
         'PD': TaskStatus.Waiting,
         'R': TaskStatus.Running,
@@ -22,6 +25,7 @@ class SlurmPlatform(ComputePlatform):
     def __init__(self, server_user):
         self.server_user = server_user
         self.user = server_user.split('@')[0]
+        self.ssh = SshConnection(server_user)
         self.submission_template = Path('platform/slurm/slurm_template.sh')
         self.setup_template = Path('platform/slurm/slurm_setup.sh')
 
@@ -36,9 +40,8 @@ class SlurmPlatform(ComputePlatform):
                                                   submission=self.submission_template.read_text())
         completed_process = None
         try:
-            completed_process = subprocess.run(['ssh', self.server_user],
-                                               input=setup_script.encode(), stdout=subprocess.PIPE,
-                                               stderr=subprocess.PIPE)
+            completed_process = self.ssh.run(input=setup_script.encode(), stdout=subprocess.PIPE,
+                                             stderr=subprocess.PIPE)
             completed_process.check_returncode()
         except subprocess.CalledProcessError:
             print(completed_process.stderr)
@@ -46,16 +49,49 @@ class SlurmPlatform(ComputePlatform):
         job_id = completed_process.stdout.decode('utf-8').strip()
         return job_id
 
-    def fetch_logs(self, task, keys=None):
+    def fetch_logs(self, task, keys=None, offsets=None, max_bytes=None, starts=None):
+        """Only the data after the offsets is transferred, over the ssh connection"""
+
+        read_all = offsets is None
+        offsets = {} if read_all else offsets
+        script = self._read_logs_script(self._make_job_path(task), offsets, keys, None if read_all else max_bytes)
+        output = self.ssh.run(input=script.encode(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
         logs = {}
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Get all .txt, .log files in output path
-            subprocess.run(['scp', self.server_user + ':' + self._make_job_path(task) + '/*.{log,txt}', tmpdir],
-                           stderr=subprocess.DEVNULL)  # Ignore errors (e.g. if *.log doesn't exist)
-            for f in glob(tmpdir + '/*'):
-                p = Path(f)
-                logs[p.stem] = p.read_text()
-        return logs
+        while output:
+            header, _, output = output.partition(b'\n')
+            name, offset, length, skipped = header.decode('utf-8', errors='replace').rsplit(' ', 3)
+            data, output = output[:int(length)], output[int(length):]
+            add_log_bytes(logs, name, data, int(offset), skipped == '1', offsets, starts)
+        return {name: data.decode('utf-8', errors='replace') for name, data in logs.items()}
+
+    @staticmethod
+    def _read_logs_script(job_path: str, offsets: Dict[str, int], keys=None, max_bytes: int = None) -> str:
+        """Shell script which prints, for each log: 'name offset length skipped', then the length bytes read from
+        offset. The offset is chosen like in read_log_bytes.
+        """
+
+        offset_cases = ''.join(f'{shlex.quote(name)}) offset={int(offset)} ;; ' for name, offset in offsets.items())
+        lines = [f'cd {shlex.quote(job_path)} 2>/dev/null || exit 0',
+                 'for f in *.log *.txt; do',
+                 '  [ -f "$f" ] || continue',
+                 '  name=${f%.*}']
+        if keys is not None:
+            patterns = '|'.join(_shell_pattern(key) for key in keys)
+            lines.append(f'  case "$name" in {patterns}) ;; *) continue ;; esac' if patterns else '  continue')
+        lines += [f'  case "$name" in {offset_cases}*) offset=0 ;; esac',
+                  '  size=$(($(wc -c < "$f")))',
+                  '  if [ "$size" -lt "$offset" ]; then offset=0; fi  # Truncated',
+                  '  skipped=0']
+        if max_bytes is not None:
+            lines += [f'  case "$name" in {"|".join(capped_logs)})',
+                      f'    if [ $((size - offset)) -gt {int(max_bytes)} ]; then '
+                      f'offset=$((size - {int(max_bytes)})); skipped=1; fi ;;',
+                      '  esac']
+        lines += ['  echo "$name $offset $((size - offset)) $skipped"',
+                  # head: not the data appended in the meantime, which is read next time
+                  '  tail -c +$((offset + 1)) "$f" | head -c $((size - offset))',
+                  'done']
+        return '\n'.join(lines) + '\n'
 
     def update_tasks(self, tasks):
         job_ids = [t.job_id for t in tasks]
@@ -75,8 +111,8 @@ class SlurmPlatform(ComputePlatform):
                     t.status = TaskStatus.Lost  # Job not found -> lost
 
     def _get_statuses(self, job_ids):
-        data = subprocess.run(['ssh', self.server_user, 'squeue -u $USER | grep $USER'],
-                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+        data = self.ssh.run('squeue -u $USER | grep $USER',
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
         data_grid = parse_columns(data)
         statuses = {}
         for l in data_grid:
@@ -87,8 +123,8 @@ class SlurmPlatform(ComputePlatform):
         return statuses
 
     def _get_completion_codes(self):
-        data = subprocess.run(['ssh', self.server_user, 'sacct -o JobID,ExitCode -n -s CD,F,CA,DL,TO -S 010100'],
-                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
+        data = self.ssh.run('sacct -o JobID,ExitCode -n -s CD,F,CA,DL,TO -S 010100',
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode('utf-8')
         data_grid = parse_columns(data)
         ccodes = {}
         for l in data_grid:
@@ -99,10 +135,15 @@ class SlurmPlatform(ComputePlatform):
         return ccodes
 
     def cancel(self, task):
-        subprocess.run(['ssh', self.server_user, f'scancel {task.job_id}'])
+        self.ssh.run(f'scancel {task.job_id}')
         task.status = TaskStatus.Cancelled
         task.save()
 
+    def delete(self, task):
+        job_remote_dir = self._make_job_path(task)
+        print('Deleting', job_remote_dir)
+        self.ssh.run(f'rm -rf {shlex.quote(job_remote_dir)}')
+
     def _make_job_path(self, task):
         return '/home/' + self.user + '/hypertrainer/output/' + str(task.id)
 
@@ -121,4 +162,10 @@ class SlurmPlatform(ComputePlatform):
         output = input_text
         for key, value in key_value_map:
             output = output.replace(key, value)
-        return output
\ No newline at end of file
+        return output
+
+
+def _shell_pattern(key: str) -> str:
+    """Log key (a name or a glob pattern) as a pattern of the case command of sh"""
+
+    return ''.join(c if c.isalnum() or c in '*?[]' else '\\' + c for c in key)
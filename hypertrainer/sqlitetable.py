@@ -0,0 +1,38 @@
+import contextlib
+import sqlite3
+from pathlib import Path
+from typing import List
+
+
+class SqliteTable:
+    """Base of the tables which are shared by several processes (see WorkerDb, LocalJobDb).
+
+    Backed by SQLite in WAL mode, so that the processes can read and update their own rows concurrently, without
+    rewriting the whole table. Each operation uses its own short-lived connection, so that the table can be used after a
+    fork. The subclasses define the schema.
+    """
+
+    busy_timeout_secs = 10
+    schema: List[str] = []  # Statements creating the tables and indexes, if they do not exist
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._initialized = False
+
+    @contextlib.contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(str(self.path), timeout=self.busy_timeout_secs)
+        try:
+            if not self._initialized:
+                self._init_schema(conn)
+                self._initialized = True
+            with conn:  # Transaction: commit, or rollback on exception
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_schema(self, conn: sqlite3.Connection):
+        conn.execute('PRAGMA journal_mode=WAL')  # Persistent; readers do not block the writer
+        with conn:
+            for statement in self.schema:
+                conn.execute(statement)
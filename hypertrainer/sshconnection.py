@@ -0,0 +1,99 @@
+import hashlib
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from hypertrainer.utils import hypertrainer_home
+
+
+class SshConnection:
+    """Runs the ssh and scp commands of a platform over one persistent connection to the server, so that each command
+    does not pay for the TCP, key exchange and authentication handshakes.
+
+    The connection is an OpenSSH ControlMaster, started in the background on first use. Its health is checked before
+    the commands (ssh -O check), at most every check_interval_secs, and it is restarted if it died, e.g. after a
+    network failure (see ServerAliveInterval). In the meantime, the commands open their own connection. The master exits
+    after being idle for control_persist_secs.
+
+    NOTE: The authentication must not be interactive (e.g. keys loaded in an agent), since the master runs in the
+    background.
+    """
+
+    control_persist_secs = 600
+    check_interval_secs = 30
+    connect_timeout_secs = 10
+    server_alive_interval_secs = 15  # The master exits after 3 missed replies
+
+    def __init__(self, server_user: str, control_dir: Path = None):
+        self.server_user = server_user
+        control_dir = hypertrainer_home / 'ssh' if control_dir is None else control_dir
+        control_dir.mkdir(mode=0o700, exist_ok=True)
+        # The path of a unix socket is limited to about 100 characters
+        key = hashlib.sha1(server_user.encode()).hexdigest()[:16]
+        self.control_path = control_dir / f'{key}.sock'
+        self.log_path = control_dir / f'{key}.log'
+        self._checked_at = None  # Monotonic time of the last check
+        self._lock = threading.Lock()  # The platform can run commands from several threads
+
+    def run(self, remote_command: str = None, **kwargs) -> subprocess.CompletedProcess:
+        """ssh server_user remote_command. The kwargs are passed to subprocess.run (e.g. input, stdout)."""
+
+        self.ensure_connected()
+        command = ['ssh'] + self._client_options() + [self.server_user]
+        if remote_command is not None:
+            command.append(remote_command)
+        return subprocess.run(command, **kwargs)
+
+    def scp(self, source: str, destination: str, **kwargs) -> subprocess.CompletedProcess:
+        """scp source destination, where the remote path is server_user:path"""
+
+        self.ensure_connected()
+        return subprocess.run(['scp'] + self._client_options() + [source, destination], **kwargs)
+
+    def ensure_connected(self):
+        """Start the master if it is not running. It is checked, or retried, at most every check_interval_secs."""
+
+        with self._lock:
+            if self._checked_at is not None and time.monotonic() - self._checked_at < self.check_interval_secs:
+                return
+            if not self.is_connected():
+                self._start_master()
+            self._checked_at = time.monotonic()
+
+    def is_connected(self) -> bool:
+        return self._control_command('check') == 0
+
+    def close(self):
+        """Make the master exit, if it is running"""
+
+        with self._lock:
+            self._control_command('exit')
+            self._checked_at = None
+
+    def _start_master(self):
+        if self.control_path.exists():
+            self.control_path.unlink()  # Left by a master which died
+        # -f: in the background once connected. Its output goes to a file, since a pipe would be held until it exits.
+        with self.log_path.open('w') as log:
+            returncode = subprocess.run(['ssh', '-N', '-f',
+                                         '-o', 'ControlMaster=yes',
+                                         '-o', f'ControlPath={self.control_path}',
+                                         '-o', f'ControlPersist={self.control_persist_secs}',
+                                         '-o', f'ConnectTimeout={self.connect_timeout_secs}',
+                                         '-o', f'ServerAliveInterval={self.server_alive_interval_secs}',
+                                         '-o', 'BatchMode=yes',
+                                         self.server_user],
+                                        stdin=subprocess.DEVNULL, stdout=log, stderr=log).returncode
+        if returncode != 0:
+            print(f'Could not start the ssh master of {self.server_user}: {self.log_path.read_text().strip()}')
+
+    def _control_command(self, command: str) -> int:
+        return subprocess.run(['ssh', '-O', command, '-o', f'ControlPath={self.control_path}', self.server_user],
+                              stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode
+
+    def _client_options(self) -> List[str]:
+        # Without a master, the command connects by itself
+        return ['-o', 'ControlMaster=no', '-o', f'ControlPath={self.control_path}']
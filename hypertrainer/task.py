@@ -1,13 +1,14 @@
 from pathlib import Path
 from time import time
+from typing import List
 
-import numpy as np
-import pandas as pd
 from peewee import CharField, IntegerField, FloatField, Field, BooleanField, UUIDField
 
 from hypertrainer.computeplatformtype import ComputePlatformType
 from hypertrainer.db import BaseModel, EnumField, YamlField
-from hypertrainer.utils import TaskStatus, get_item_at_path, yaml_to_str, parse_columns, make_path
+from hypertrainer.logparser import LogParser
+from hypertrainer.metricstore import metric_store
+from hypertrainer.utils import TaskStatus, get_item_at_path, yaml_to_str, make_path
 
 
 class Task(BaseModel):
@@ -38,18 +39,42 @@ class Task(BaseModel):
         super().__init__(**kwargs)
 
         self.logs = {}
-        self.metrics = {}
+        self.partial_logs = {}  # For the logs whose beginning was skipped: {name: (num_bytes, total_bytes)}
         self.total_time_remain = None
         self.ep_time_remain = None
         self.cur_phase = None
+        self.progress_summary = None  # See set_progress
 
         self._script_file = None
         self._output_root = None
 
+    def snapshot(self) -> 'Task':
+        """Copy of the task, which can be modified (e.g. monitored by another thread) without affecting this one"""
+
+        task = Task(**{f.name: getattr(self, f.name) for f in self.get_fields()})
+        task.logs = dict(self.logs)
+        task.partial_logs = dict(self.partial_logs)
+        task.total_time_remain = self.total_time_remain
+        task.ep_time_remain = self.ep_time_remain
+        task.cur_phase = self.cur_phase
+        task.progress_summary = self.progress_summary
+        return task
+
+    def changed_fields(self, other: 'Task') -> List[Field]:
+        """The fields whose value differs from the one of other, e.g. the task this one is a snapshot of"""
+
+        return [f for f in self.get_fields() if getattr(self, f.name) != getattr(other, f.name)]
+
     @property
     def is_running(self):
         return self.status == TaskStatus.Running
 
+    @property
+    def metrics(self) -> dict:
+        """The metrics of the task, read from the metric store"""
+
+        return metric_store.load(self.uuid)
+
     @property
     def stdout_path(self) -> Path:
         return Path(self.output_path) / 'out.txt'
@@ -104,58 +129,35 @@ class Task(BaseModel):
         """Called after cancel event"""
         self.save()
 
-    def interpret_logs(self):
+    def interpret_logs(self, parser: LogParser = None, save: bool = True):
+        """Interpret the progress and metric logs, and remove them from self.logs.
+
+        The metrics are written to the metric store. The parser keeps its state between calls; when one is given,
+        self.logs only needs to contain the data appended since the previous call. If save is False, the progress is
+        set but not saved.
+        """
+
         logs = self.logs
+        if parser is None:
+            parser = LogParser()
+            parser.reset(logs.keys())  # The logs are complete
 
         # Interpret logs
         try:
             for name, log in logs.items():
-                if name == 'progress':
-                    # Columns = epoch_idx, iter_idx, iter_per_epoch, unix_timestamp
-                    data = parse_columns(log)
-                    if data:
-                        data = data if data[0][0].isdigit() else data[1:]  # Handle presence/absence of header
-                        df = pd.DataFrame(data, columns=['ep_idx', 'phase', 'iter_idx', 'iter_per_epoch', 'timestamp'])
-                        self.cur_phase = df.tail(1).phase.values[0]  # TODO
-                        del df['phase']
-                        df = df.astype(float).astype(int)
-                        # Epochs
-                        self.cur_epoch = int(df.tail(1).ep_idx)
-                        epochs_times = df.groupby('ep_idx').min().timestamp.values
-                        if len(epochs_times) > 1:
-                            durations = epochs_times[1:] - epochs_times[:-1]
-                            self.epoch_duration = np.mean(durations)  # TODO more weight to last epochs?
-                            cur_ep_elapsed = time() - epochs_times[-1]
-                            self.ep_time_remain = self.epoch_duration - cur_ep_elapsed
-                            epochs_remaining = get_item_at_path(self.config, 'training.num_epochs') - self.cur_epoch - 1
-                            self.total_time_remain = self.ep_time_remain + self.epoch_duration * epochs_remaining
-
-                            self.ep_time_remain = max(self.ep_time_remain, 0)
-                            self.total_time_remain = max(self.total_time_remain, 0)
-                        # Iterations
-                        self.cur_iter = int(df.tail(1).iter_idx)
-                        self.iter_per_epoch = int(df.tail(1).iter_per_epoch)
-                        self.save()
-
-                elif name.startswith('metric_'):
-                    data = parse_columns(log)
-                    if data:
-                        data = data if data[0][0].isdigit() else data[1:]  # Handle presence/absence of header
-                        m_name = name.partition('_')[2]  # Example: 'd_j_trump'.partition('_') -> ('d', '_', 'j_trump')
-                        if name.startswith('metric_classwise_'):
-                            m_name = m_name.partition('_')[2]
-                            data_arrays = {}
-                            # Columns: epoch_idx, class_idx, value
-                            df = pd.DataFrame(data, columns=['epoch_idx', 'class_idx', 'value'], dtype=float)
-                            for class_idx, sub_df in df.groupby('class_idx'):
-                                del sub_df['class_idx']
-                                label = class_idx if type(class_idx) is str else str(int(class_idx))
-                                data_arrays[label] = sub_df.values  # convert to numpy
-                            self.metrics[m_name] = data_arrays
-                        else:
-                            # Columns: epoch_idx, value
-                            data_array = np.array(data, dtype=np.float)
-                            self.metrics[m_name] = data_array
+                if name == 'progress' or name.startswith('metric_'):
+                    parser.feed(name, log)
+
+            if parser.has_progress:
+                self.set_progress(parser.progress_summary())
+                if save:
+                    self.save()
+
+            cleared_metrics, new_metric_rows = parser.pop_metric_updates()
+            for m_name in cleared_metrics:
+                metric_store.clear(self.uuid, m_name)
+            for (m_name, label), rows in new_metric_rows.items():
+                metric_store.append(self.uuid, m_name, rows, label=label)
         except Exception as e:
             print('ERROR while interpreting logs:')
             print(e)
@@ -164,5 +166,24 @@ class Task(BaseModel):
         for k in [k for k in logs.keys() if k.startswith('metric_') or k in {'progress'}]:
             del logs[k]
 
+    def set_progress(self, progress: dict):
+        """Set the progress from its summary (see LogParser.progress_summary), and estimate the time remaining"""
+
+        self.progress_summary = progress
+        self.cur_phase = progress['cur_phase']
+        # Epochs
+        self.cur_epoch = progress['cur_epoch']
+        if progress['epoch_duration'] is not None:
+            self.epoch_duration = progress['epoch_duration']  # TODO more weight to last epochs?
+            cur_ep_elapsed = time() - progress['cur_epoch_start_time']
+            self.ep_time_remain = self.epoch_duration - cur_ep_elapsed
+            if self.num_epochs >= 0:  # Known
+                epochs_remaining = self.num_epochs - self.cur_epoch - 1
+                self.total_time_remain = max(self.ep_time_remain + self.epoch_duration * epochs_remaining, 0)
+            self.ep_time_remain = max(self.ep_time_remain, 0)
+        # Iterations
+        self.cur_iter = progress['cur_iter']
+        self.iter_per_epoch = progress['iter_per_epoch']
+
     def dump_config(self):
         return yaml_to_str(self.config)
@@ -1,13 +1,17 @@
 import contextlib
 import fcntl
+import json
 import os
+import subprocess
 import sys
 import time
+import zlib
 from pathlib import Path
 from enum import Enum
+from fnmatch import fnmatchcase
 from functools import reduce
 from itertools import chain
-from typing import Iterable, List, Dict
+from typing import Iterable, List, Dict, Set, Optional, Tuple
 from uuid import UUID
 
 from ruamel.yaml import YAML, StringIO
@@ -54,6 +58,192 @@ def parse_columns(data):
     return [l.split() for l in data_lines]
 
 
+log_patterns = ('*.log', '*.txt')
+capped_logs = ('out', 'err')  # Logs that can be limited to their last bytes (see read_logs)
+
+
+def read_logs(output_path, offsets: Dict[str, int] = None, keys: Iterable[str] = None,
+              max_bytes: int = None, starts: Dict[str, int] = None) -> Dict[str, str]:
+    """Read the logs (*.log and *.txt files) found in output_path.
+
+    If keys is given, only the logs whose name matches one of the keys are read. A key is either a log name
+    (e.g. 'progress') or a glob pattern (e.g. 'metric_*').
+
+    If offsets (a dict mapping log names to byte offsets) is given, only the data appended after each offset is read,
+    and offsets is updated in place. If a file is now shorter than its offset, it is read from the beginning.
+    The following arguments are only used with offsets:
+    - max_bytes: at most the last max_bytes of the out and err logs are read; older data is skipped.
+    - starts: dict which is filled with the byte offset at which the data returned for each log starts.
+    """
+
+    if offsets is None:
+        return {log_file.stem: log_file.read_text() for log_file in _find_logs(output_path, keys)}
+    return {name: data.decode('utf-8', errors='replace')
+            for name, data in read_log_bytes(output_path, offsets, keys, max_bytes, starts).items()}
+
+
+def read_log_bytes(output_path, offsets: Dict[str, int], keys: Iterable[str] = None,
+                   max_bytes: int = None, starts: Dict[str, int] = None) -> Dict[str, bytes]:
+    """Same as read_logs() with offsets, but the data is not decoded. It never ends with an incomplete character."""
+
+    logs = {}
+    for log_file in _find_logs(output_path, keys):
+        name = log_file.stem
+        with log_file.open('rb') as f:
+            size = f.seek(0, os.SEEK_END)
+            offset = offsets.get(name, 0)
+            if size < offset:
+                offset = 0  # The file has been truncated
+            skip = max_bytes is not None and name in capped_logs and size - offset > max_bytes
+            if skip:
+                offset = size - max_bytes
+            f.seek(offset)
+            data = f.read(size - offset)
+        add_log_bytes(logs, name, data, offset, skip, offsets, starts)
+    return logs
+
+
+def add_log_bytes(logs: Dict[str, bytes], name: str, data: bytes, offset: int, skipped: bool,
+                  offsets: Dict[str, int], starts: Dict[str, int] = None):
+    """Add the data of a log, read from offset, to logs, and update offsets and starts (see read_log_bytes).
+
+    skipped tells if older data was skipped because of max_bytes. Used by the platforms which read the logs remotely.
+    """
+
+    if skipped:
+        stripped = lstrip_continuation_bytes(data)  # Do not start in the middle of a character
+        offset += len(data) - len(stripped)
+        data = stripped
+    data = _strip_incomplete_char(data)
+    logs[name] = data
+    offsets[name] = offset + len(data)
+    if starts is not None:
+        starts[name] = offset
+
+
+def _find_logs(output_path, keys: Iterable[str] = None) -> List[Path]:
+    return [log_file for pattern in log_patterns for log_file in Path(output_path).glob(pattern)
+            if match_log_keys(log_file.stem, keys)]
+
+
+def match_log_keys(name: str, keys: Iterable[str] = None) -> bool:
+    """Check if a log name matches one of the keys (names or glob patterns). All names match if keys is None."""
+
+    return keys is None or any(fnmatchcase(name, k) for k in keys)
+
+
+def lstrip_continuation_bytes(data: bytes) -> bytes:
+    """Remove the leading UTF-8 continuation bytes, e.g. when data starts in the middle of a character"""
+
+    num_continuation_bytes = len(data[:4]) - len(data[:4].lstrip(bytes(range(0x80, 0xc0))))
+    return data[num_continuation_bytes:]
+
+
+def _strip_incomplete_char(data: bytes) -> bytes:
+    """Remove a trailing incomplete UTF-8 character, which will be read next time"""
+
+    for i in range(1, min(len(data), 4) + 1):
+        byte = data[-i]
+        if byte & 0b1100_0000 == 0b1000_0000:
+            continue  # Continuation byte
+        if byte & 0b1000_0000:
+            char_len = 2 if byte < 0b1110_0000 else 3 if byte < 0b1111_0000 else 4
+            if char_len > i:
+                return data[:-i]
+        break
+    return data
+
+
+class LogCursor:
+    """Reading position in the logs of one task.
+
+    The offsets and starts are passed to ComputePlatform.fetch_logs(), which then only returns the data appended since
+    the previous call. The data received so far is accumulated in self.logs; if older data has been skipped (see
+    max_bytes), self.log_starts tells where the data in self.logs starts. If max_bytes is given, only the last
+    max_bytes of the out and err logs are kept, except on the update that follows a request for more history (see
+    request_history).
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.offsets: Dict[str, int] = {}
+        self.starts: Dict[str, int] = {}
+        self.logs: Dict[str, str] = {}
+        self.log_starts: Dict[str, int] = {}
+        self._last_offsets: Dict[str, int] = {}
+        self._history_bytes: Optional[int] = None  # Cap of the next update only (see request_history)
+
+    def truncated_logs(self) -> Set[str]:
+        """Names of the logs that have been truncated (e.g. rewritten) since the last update"""
+
+        return {name for name, offset in self.offsets.items() if offset < self._last_offsets.get(name, 0)}
+
+    def restarted_logs(self) -> Set[str]:
+        """Names of the logs that have been read from the beginning since the last update (new or truncated)"""
+
+        return {name for name in self.offsets if name not in self._last_offsets}.union(self.truncated_logs())
+
+    def update(self, new_logs: Dict[str, str]):
+        """Append the data returned by fetch_logs()"""
+
+        truncated = self.truncated_logs()
+        max_bytes = self.max_bytes
+        if max_bytes is not None and self._history_bytes is not None:
+            max_bytes = max(max_bytes, self._history_bytes)
+        for name, data in new_logs.items():
+            default_start = 0 if name in truncated else self._last_offsets.get(name, 0)
+            start = self.starts.get(name, default_start)
+            if name in self.logs and start == self._last_offsets.get(name, 0):
+                self.logs[name] += data
+            else:
+                # New log, truncated log, or older data was skipped
+                self.logs[name] = data
+                self.log_starts[name] = start
+            if max_bytes is not None and name in capped_logs:
+                self._keep_last_bytes(name, max_bytes)
+        self._last_offsets = dict(self.offsets)
+        self.starts.clear()
+        self._history_bytes = None
+
+    def _keep_last_bytes(self, name: str, max_bytes: int):
+        if len(self.logs[name]) <= max_bytes // 4:
+            return  # Shorter than max_bytes, even if all its characters are 4 bytes long
+        data = self.logs[name].encode('utf-8')
+        if len(data) <= max_bytes:
+            return
+        kept = lstrip_continuation_bytes(data[-max_bytes:])  # Do not start in the middle of a character
+        self.logs[name] = kept.decode('utf-8')
+        self.log_starts[name] = self.log_starts.get(name, 0) + len(data) - len(kept)
+
+    def request_history(self, num_bytes: int):
+        """Rewind the capped logs, so that the next fetch returns up to their last num_bytes.
+
+        The next update keeps them; the updates after it cap the logs to max_bytes again.
+        """
+
+        self._history_bytes = num_bytes
+        for name in capped_logs:
+            if self.log_starts.get(name, 0) > 0 and self.offsets[name] - self.log_starts[name] < num_bytes:
+                self.offsets[name] = max(self.offsets[name] - num_bytes, 0)
+
+    def is_partial(self, name: str) -> bool:
+        """Whether the beginning of a log has been skipped"""
+
+        return self.log_starts.get(name, 0) > 0
+
+
+def compress_data(obj) -> bytes:
+    """Serialize and compress a json-compatible object"""
+
+    return zlib.compress(json.dumps(obj).encode('utf-8'))
+
+
+def decompress_data(data: bytes):
+    """Inverse of compress_data()"""
+
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
 def yaml_to_str(obj):
     # with io.StringIO() as stream:
     stream = StringIO()
@@ -159,6 +349,8 @@ class LockedError(Exception):
 class PidFile(object):
     """Adapted from github.com/trbs/pid"""
 
+    remove_on_release = True
+
     def __init__(self, path: Path):
         self.path: Path = path
         self.pidfile = None
@@ -178,6 +370,8 @@ class PidFile(object):
         try:
             fcntl.flock(self.pidfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError:
+            self.pidfile.close()
+            self.pidfile = None
             raise LockedError
         self.pidfile.seek(0)
         self.pidfile.truncate()
@@ -194,7 +388,8 @@ class PidFile(object):
             if err.errno != 9:
                 raise
         self.pidfile = None
-        self.path.unlink()
+        if self.remove_on_release:
+            self.path.unlink()
 
     @property
     def is_locked(self):
@@ -202,6 +397,9 @@ class PidFile(object):
 
 
 class GpuLock(PidFile):
+    # Keep the file, so that a process waiting on it (see GpuLockManager.wait_for_release) is not locking a stale file
+    remove_on_release = False
+
     def __init__(self, gpu_id):
         self.gpu_id = gpu_id
         self.path = hypertrainer_home / f'gpu_{gpu_id}.lock'
@@ -209,8 +407,11 @@ class GpuLock(PidFile):
 
 
 class GpuLockManager:
+    allocation_lock_path = hypertrainer_home / 'gpu_allocation.lock'
+    release_poll_interval_secs = 0.2
+
     def __init__(self):
-        self.locks: Dict[str, GpuLock] = {}
+        self.locks: List[GpuLock] = []
 
         cuda_visible_devices_var = os.environ.get('CUDA_VISIBLE_DEVICES', None)
         if cuda_visible_devices_var not in ('', None):
@@ -220,20 +421,156 @@ class GpuLockManager:
     def num_free_gpus(self) -> int:
         return sum(1 for lock in self.locks if not lock.is_locked)
 
+    def num_available_gpus(self) -> int:
+        """Number of gpus that are not locked by any process"""
+
+        return len(self.locks) - len(self._busy_gpu_paths())
+
     def acquire_one_gpu(self) -> GpuLock:
         """Wait for a gpu to be available, acquire it and return the GpuLock
 
         The GpuLock must be released when the job is done."""
 
+        return self.acquire_gpus(1)[0]
+
+    def acquire_gpus(self, num_gpus: int) -> List[GpuLock]:
+        """Wait for num_gpus gpus to be available, acquire them and return their GpuLocks
+
+        The gpus are acquired all at once, or not at all, so that jobs waiting for gpus cannot deadlock. Gpus that
+        share a fast interconnect (see gpu_link_scores) are preferred. The GpuLocks must be released when the job is
+        done. Example: CUDA_VISIBLE_DEVICES=','.join(lock.gpu_id for lock in gpu_locks)
+        """
+
         if len(self.locks) < 1:
             raise Exception('GpuLockManager: There are no visible GPUs.')
+        if num_gpus > len(self.locks):
+            raise Exception(f'GpuLockManager: {num_gpus} GPUs are required, but only {len(self.locks)} are visible.')
 
         while True:
-            for gpu_lock in self.locks:
-                if gpu_lock.try_acquire():
-                    return gpu_lock
-            print('GpuLockManager: waiting for a GPU...')
-            time.sleep(2)
+            gpu_locks = self.try_acquire_gpus(num_gpus)
+            if gpu_locks is not None:
+                return gpu_locks
+            print(f'GpuLockManager: waiting for {num_gpus} GPU(s)...')
+            self.wait_for_release(num_gpus)
+
+    def try_acquire_gpus(self, num_gpus: int) -> Optional[List[GpuLock]]:
+        """Acquire num_gpus gpus if they are available now, otherwise return None"""
+
+        with _flock(self.allocation_lock_path):  # Only one process at a time tries to allocate
+            free_locks = [lock for lock in self.locks if not lock.is_locked and lock.try_acquire()]
+            if len(free_locks) < num_gpus:
+                chosen = []
+            else:
+                chosen = _choose_gpus(free_locks, num_gpus, gpu_link_scores())
+            for lock in free_locks:
+                if lock not in chosen:
+                    lock.release()
+        return chosen or None
+
+    def wait_for_release(self, num_gpus: int, timeout_secs=60):
+        """Block until num_gpus gpus might be free, i.e. until gpus are released by other processes, or the timeout.
+
+        The locks are polled without blocking on them, so that nothing is left waiting after the timeout.
+        """
+
+        deadline = time.monotonic() + timeout_secs
+        while len(self.locks) - len(self._busy_gpu_paths()) < num_gpus:
+            remaining_secs = deadline - time.monotonic()
+            if remaining_secs <= 0:
+                return
+            time.sleep(min(self.release_poll_interval_secs, remaining_secs))
+
+    def _busy_gpu_paths(self) -> List[Path]:
+        busy_paths = []
+        for lock in self.locks:
+            with lock.path.open('a') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except IOError:
+                    busy_paths.append(lock.path)
+        return busy_paths
+
+
+def gpu_link_scores() -> Dict[Tuple[str, str], int]:
+    """Score of the interconnect between each pair of gpus (higher is faster), from `nvidia-smi topo -m`.
+
+    The gpus are identified by their index, as in CUDA_VISIBLE_DEVICES. Empty if nvidia-smi is not available.
+    """
+
+    return parse_gpu_topology(_read_gpu_topology())
+
+
+def gpu_numa_nodes() -> Dict[str, int]:
+    """NUMA node closest to each gpu, from `nvidia-smi topo -m`. Empty if it is not available."""
+
+    return parse_gpu_numa_nodes(_read_gpu_topology())
+
+
+def _read_gpu_topology() -> str:
+    try:
+        return subprocess.run(['nvidia-smi', 'topo', '-m'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, timeout=10).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def parse_gpu_topology(topo_output: str) -> Dict[Tuple[str, str], int]:
+    # NV# = number of NVLinks; the others are PCIe paths, from the shortest to the longest
+    path_scores = {'PIX': 5, 'PXB': 4, 'PHB': 3, 'NODE': 2, 'SYS': 1, 'SOC': 1}
+    lines = [line.split() for line in topo_output.splitlines() if line.strip()]
+    if not lines:
+        return {}
+    columns = [c[3:] for c in lines[0] if c.startswith('GPU')]
+    scores = {}
+    for row in lines[1:]:
+        if not row[0].startswith('GPU'):
+            continue
+        gpu = row[0][3:]
+        for other, link in zip(columns, row[1:]):
+            if link.startswith('NV'):
+                scores[gpu, other] = 10 + int(link[2:])
+            elif link in path_scores:
+                scores[gpu, other] = path_scores[link]
+    return scores
+
+
+def parse_gpu_numa_nodes(topo_output: str) -> Dict[str, int]:
+    # The columns are separated by tabs, and the header of the NUMA node is 'NUMA Affinity'. It is N/A on some hosts.
+    lines = [line.split('\t') for line in topo_output.splitlines() if line.strip()]
+    header = [c.strip() for c in lines[0]] if lines else []
+    if 'NUMA Affinity' not in header:
+        return {}
+    column = header.index('NUMA Affinity')
+    nodes = {}
+    for row in lines[1:]:
+        if row[0].startswith('GPU') and len(row) > column and row[column].strip().isdigit():
+            nodes[row[0].strip()[3:]] = int(row[column])
+    return nodes
+
+
+def _choose_gpus(locks: List['GpuLock'], num_gpus: int, link_scores: Dict[Tuple[str, str], int]) -> list:
+    """Greedily choose num_gpus locks among locks, maximizing the scores of the links between the chosen gpus"""
+
+    def total_score(chosen, candidate):
+        return sum(link_scores.get((c.gpu_id, candidate.gpu_id), 0) for c in chosen)
+
+    best, best_score = None, -1
+    for seed in locks:
+        chosen = [seed]
+        while len(chosen) < num_gpus:
+            candidates = [lock for lock in locks if lock not in chosen]
+            chosen.append(max(candidates, key=lambda lock: total_score(chosen, lock)))  # First one wins ties
+        score = sum(total_score(chosen[:i], lock) for i, lock in enumerate(chosen))
+        if score > best_score:
+            best, best_score = chosen, score
+    return best
+
+
+@contextlib.contextmanager
+def _flock(path: Path):
+    with path.open('a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield  # The lock is released when the file is closed
 
 
 def get_config_file() -> Path:
@@ -247,10 +584,16 @@ def get_config_file() -> Path:
 @contextlib.contextmanager
 def config_context():
     config_file_path = get_config_file()
-    file_initialized = config_file_path.exists()
-    with config_file_path.open('r+') as f:
-        config = yaml.load(f) if file_initialized else {}
-        yield config
-        f.seek(0)
-        f.truncate()
-        yaml.dump(config, f)
+    config = yaml.load(config_file_path)
+    yield config
+    # Replace the file atomically, since other processes might be reading it (see read_config)
+    tmp_path = config_file_path.with_name(f'.{config_file_path.name}.{os.getpid()}.tmp')
+    yaml.dump(config, tmp_path)
+    os.replace(tmp_path, config_file_path)
+
+
+def read_config() -> dict:
+    """Read the config without rewriting it. Safe in the worker processes, which run concurrently."""
+
+    config = yaml.load(get_config_file())
+    return {} if config is None else config
@@ -1,12 +1,13 @@
 import itertools
 
+import numpy as np
 from bokeh.plotting import figure
 from bokeh.embed import components
 from bokeh.palettes import Category10
 
 
 def generate_plots(metrics_data):
-    # metrics_data is a dict: {string: numpy_array}
+    # metrics_data is a dict: {string: numpy_array}, as returned by MetricStore.load() (arrays are memory-mapped)
 
     # select the tools we want
     TOOLS = "pan,wheel_zoom,box_zoom,reset,save"
@@ -17,8 +18,10 @@ def generate_plots(metrics_data):
         if type(data) is dict:
             colors = itertools.cycle(Category10[10])
             for label, sub_data in data.items():
+                sub_data = np.asarray(sub_data)
                 p.line(x=sub_data[:, 0], y=sub_data[:, 1], legend=label, color=next(colors))
         else:
+            data = np.asarray(data)
             p.line(x=data[:, 0], y=data[:, 1])
         plots[name] = p
 
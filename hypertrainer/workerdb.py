@@ -0,0 +1,80 @@
+import sqlite3
+from typing import Dict, Iterable, Optional, List
+
+from hypertrainer.sqlitetable import SqliteTable
+
+
+class WorkerDb(SqliteTable):
+    """Per-host table of the jobs run by the workers: job id -> pid, status.
+
+    Shared by the worker processes of the host, and by the rq work horses, which are forked (see SqliteTable).
+    """
+
+    schema = ['CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, pid INTEGER, status TEXT NOT NULL)',
+              'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)']
+    max_ids_per_query = 500
+
+    def insert_job(self, job_id: str, pid: int, status: str):
+        with self._connect() as conn:
+            try:
+                conn.execute('INSERT INTO jobs (job_id, pid, status) VALUES (?, ?, ?)', (job_id, pid, status))
+            except sqlite3.IntegrityError:
+                raise KeyError(f'Job id {job_id} already exists in worker db.')
+
+    def set_status(self, job_id: str, status: str):
+        """Set the status of a job, inserting it if needed"""
+
+        self.set_statuses([job_id], status)
+
+    def set_statuses(self, job_ids: Iterable[str], status: str):
+        """Set the status of several jobs in one transaction, inserting them if needed"""
+
+        # NOTE: Not an upsert (ON CONFLICT DO UPDATE), which requires SQLite 3.24
+        rows = [(status, job_id) for job_id in job_ids]
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO jobs (status, job_id) VALUES (?, ?)', rows)
+            conn.executemany('UPDATE jobs SET status = ? WHERE job_id = ?', rows)
+
+    def get_status(self, job_id: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute('SELECT status FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def delete_job(self, job_id: str):
+        if self.delete_jobs([job_id]):
+            raise KeyError(job_id)
+
+    def delete_jobs(self, job_ids: Iterable[str]) -> List[str]:
+        """Delete several jobs in one transaction. Return the ids of the jobs that were not found."""
+
+        missing = []
+        with self._connect() as conn:
+            for job_id in job_ids:
+                if conn.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,)).rowcount == 0:
+                    missing.append(job_id)
+        return missing
+
+    def get_jobs(self, statuses: Iterable[str] = None, job_ids: Iterable[str] = None) -> Dict[str, dict]:
+        """Return {job_id: {'pid': ..., 'status': ...}}, optionally only for the jobs having one of the statuses, or
+        one of the ids
+        """
+
+        query = 'SELECT job_id, pid, status FROM jobs'
+        conditions, params = [], ()
+        if statuses is not None:
+            statuses = tuple(statuses)
+            conditions.append(f'status IN ({", ".join("?" * len(statuses))})')  # Uses the status index
+            params += statuses
+        if job_ids is None:
+            chunks = [()]
+        else:
+            # One query per chunk of ids, since the number of parameters of a query is limited (999 by default)
+            job_ids = tuple(job_ids)
+            chunks = [job_ids[i:i + self.max_ids_per_query] for i in range(0, len(job_ids), self.max_ids_per_query)]
+        rows = []
+        with self._connect() as conn:
+            for chunk in chunks:
+                chunk_conditions = conditions + [f'job_id IN ({", ".join("?" * len(chunk))})'] if chunk else conditions
+                chunk_query = query + ' WHERE ' + ' AND '.join(chunk_conditions) if chunk_conditions else query
+                rows += conn.execute(chunk_query, params + chunk).fetchall()
+        return {job_id: {'pid': pid, 'status': status} for job_id, pid, status in rows}
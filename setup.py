@@ -13,8 +13,7 @@ setup(
         'flask>=1.0.0',
         'ruamel.yaml',
         'peewee',
-        'pandas',
-        'rq',
+        'rq>=1.13',
         'IPython',
         'termcolor',
         'tabulate'
@@ -5,6 +5,18 @@ import pytest
 from hypertrainer import create_app
 from hypertrainer.localplatform import LocalPlatform
 import hypertrainer.utils
+from hypertrainer.utils import TestState
+
+
+@pytest.fixture(scope='session', autouse=True)
+def local_job_db():
+    """Remove the db of the local jobs of the test session at the end (see LocalPlatform._get_job_db_path)"""
+
+    yield
+    if TestState.test_mode:  # Otherwise the path is the one of the real db
+        job_db_path = LocalPlatform._get_job_db_path()
+        for path in job_db_path.parent.glob(job_db_path.name + '*'):  # With the -wal and -shm files
+            path.unlink()
 
 
 @pytest.fixture
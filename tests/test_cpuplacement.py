@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+from hypertrainer import cpuplacement
+from hypertrainer.cpuplacement import CpuLockManager, parse_cpu_list, read_numa_nodes, choose_cpus
+from hypertrainer.forkserver import start_script
+from hypertrainer.utils import parse_gpu_numa_nodes
+
+
+def test_parse_cpu_list():
+    assert parse_cpu_list('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpu_list('\n') == []
+
+
+def test_read_numa_nodes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        nodes_path = Path(tmpdir)
+        for node, cpu_list in [(0, '0-1,4\n'), (1, '2-3\n')]:
+            (nodes_path / f'node{node}').mkdir()
+            (nodes_path / f'node{node}' / 'cpulist').write_text(cpu_list)
+        (nodes_path / 'online').write_text('0-1\n')
+        assert read_numa_nodes(nodes_path) == {0: [0, 1, 4], 1: [2, 3]}
+
+        # No topology: one node
+        assert read_numa_nodes(nodes_path / 'missing') == {0: sorted(os.sched_getaffinity(0))}
+
+
+def test_choose_cpus():
+    free = {0: [0, 1, 2, 3], 1: [4, 5]}
+    assert choose_cpus(free, 2) == [4, 5]  # The tightest node
+    assert choose_cpus(free, 2, preferred_node=0) == [0, 1]
+    assert choose_cpus(free, 3, preferred_node=1) == [0, 1, 2]  # The preferred node is too small
+    assert choose_cpus(free, 5, preferred_node=1) == [4, 5, 0, 1, 2]  # Spread, starting with the preferred node
+    assert choose_cpus(free, 7) == []
+
+
+def test_parse_gpu_numa_nodes():
+    topo = ('\tGPU0\tGPU1\tNIC0\tCPU Affinity\tNUMA Affinity\tGPU NUMA ID\n'
+            'GPU0\t X \tSYS\tNODE\t0-7\t0\t\tN/A\n'
+            'GPU1\tSYS\t X \tSYS\t8-15\t1\t\tN/A\n'
+            'NIC0\tNODE\tSYS\t X \t\t\t\t\n')
+    assert parse_gpu_numa_nodes(topo) == {'0': 0, '1': 1}
+    assert parse_gpu_numa_nodes('') == {}
+
+
+def test_cpu_lock_manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(cpuplacement, 'gpu_numa_nodes', lambda: {'0': 1})
+    monkeypatch.setattr(cpuplacement, 'cpu_locks_path', tmp_path / 'cpu_locks')
+    monkeypatch.setattr(CpuLockManager, 'allocation_lock_path', tmp_path / 'cpu_allocation.lock')
+    manager = CpuLockManager({0: [1000, 1001, 1002], 1: [1003, 1004]})
+
+    locks = []
+    try:
+        gpu_task_locks = manager.try_acquire_cpus(2, gpu_ids=['0'])
+        locks += gpu_task_locks
+        assert [lock.cpu for lock in gpu_task_locks] == [1003, 1004]  # Close to the gpu
+        cpu_task_locks = manager.try_acquire_cpus(2)
+        locks += cpu_task_locks
+        assert [lock.cpu for lock in cpu_task_locks] == [1000, 1001]  # Disjoint
+        assert manager.try_acquire_cpus(2) is None
+
+        for lock in gpu_task_locks + cpu_task_locks:
+            lock.release()
+        locks = manager.try_acquire_cpus(5)
+        assert len(locks) == 5
+    finally:
+        for lock in locks:
+            if lock.is_locked:
+                lock.release()
+
+
+def test_pinned_script():
+    cpu = min(os.sched_getaffinity(0))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        script_file = tmpdir / 'script.py'
+        script_file.write_text('import os\nprint(sorted(os.sched_getaffinity(0)))\n')
+        for exit_code_path in (None, tmpdir / 'exit_code'):  # Directly, and under the exit code wrapper
+            p = start_script([sys.executable], script_file, tmpdir / 'config.yaml', tmpdir, tmpdir / 'out.txt',
+                             tmpdir / 'err.txt', exit_code_path=exit_code_path, cpus=[cpu])
+            assert p.wait() == 0
+            assert (tmpdir / 'out.txt').read_text() == f'[{cpu}]\n'
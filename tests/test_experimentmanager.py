@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from time import sleep
+from time import sleep, time
 
 import pytest
 
@@ -9,9 +9,11 @@ from hypertrainer.utils import TaskStatus, yaml, deep_assert_equal, TestState
 
 TestState.test_mode = True
 
+from hypertrainer import cpuplacement
 from hypertrainer.experimentmanager import experiment_manager
 from hypertrainer.computeplatformtype import ComputePlatformType
 from hypertrainer.htplatform import HtPlatform
+from hypertrainer.localplatform import LocalPlatform
 from hypertrainer.task import Task
 
 scripts_path = Path(__file__).parent / 'scripts'
@@ -35,6 +37,12 @@ def test_export_yaml():
 
 
 class TestLocal:
+    @pytest.fixture(autouse=True)
+    def many_slots(self, monkeypatch):
+        # The tests do not wait for the tasks of the previous tests, which would hold the slots on small machines
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        monkeypatch.setattr(local_platform, 'cpu_slots', 16)
+
     def test_output_path(self):
         tasks = experiment_manager.create_tasks(
             config_file=str(scripts_path / 'test_simple.yaml'),
@@ -213,6 +221,171 @@ class TestLocal:
 
         wait_true(check_cancelled)
 
+    def test_slots(self, monkeypatch):
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        monkeypatch.setattr(local_platform, 'cpu_slots', 1)
+        tasks = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_hp.yaml'),
+            platform='local')
+        task_ids = [t.id for t in tasks]
+
+        # Only one task runs at a time; the others wait for the slot
+        experiment_manager.update_tasks([ComputePlatformType.LOCAL])
+        statuses = [t.status for t in experiment_manager.get_tasks_by_id(task_ids)]
+        assert statuses.count(TaskStatus.Running) <= 1
+        assert TaskStatus.Waiting in statuses
+
+        for task_id in task_ids:
+            wait_task_finished(task_id, interval_secs=0.5, tries=10)
+
+    def test_fractional_cpus(self, tmp_path):
+        config_file = tmp_path / 'test_fractional_cpus.yaml'
+        config_file.write_text(f'script: {scripts_path / "script_test_long.py"}\n'
+                               'output_root: ~/hypertrainer/output\n'
+                               'resources:\n'
+                               '  cpus: 1.5\n')
+        task = experiment_manager.create_tasks(config_file=str(config_file), platform='local')[0]
+
+        # The slots are rounded up
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        assert local_platform.used_cpus[task.job_id] == 2
+        experiment_manager.cancel_tasks_by_id([task.id])
+
+    def test_supervision(self):
+        task_id = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_simple.yaml'),
+            platform='local')[0].id
+
+        # The status is written to the db by the supervisor, without updating the tasks
+        wait_true(lambda: Task.get(Task.id == task_id).status == TaskStatus.Finished, interval_secs=0.5)
+
+    def test_cancel_during_supervision(self, monkeypatch):
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_long.yaml'),
+            platform='local')[0]
+        write_statuses = local_platform._write_statuses
+        written = []
+
+        def cancel_and_write_statuses(changes):
+            if task.job_id in changes:
+                local_platform.cancel(task)  # Between the computation of the changes and their recording
+            write_statuses(changes)
+            written.append(task.job_id in changes)
+
+        monkeypatch.setattr(local_platform, '_write_statuses', cancel_and_write_statuses)
+        wait_true(lambda: any(written))
+        assert local_platform.statuses[task.job_id] == TaskStatus.Cancelled
+        assert Task.get(Task.id == task.id).status == TaskStatus.Cancelled
+
+    def test_update_during_supervision(self, monkeypatch):
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_simple.yaml'),
+            platform='local')[0]
+        update_tasks = local_platform.update_tasks
+
+        def update_tasks_after_exit(tasks):
+            # The tasks were read from the db before the supervisor wrote the final status
+            wait_true(lambda: Task.get(Task.id == task.id).status == TaskStatus.Finished, interval_secs=0.5)
+            update_tasks(tasks)
+
+        monkeypatch.setattr(local_platform, 'update_tasks', update_tasks_after_exit)
+        experiment_manager.update_tasks([ComputePlatformType.LOCAL])
+        assert Task.get(Task.id == task.id).status == TaskStatus.Finished  # Not overwritten by the stale status
+
+    def test_reattach(self, monkeypatch):
+        long_task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_long.yaml'),
+            platform='local')[0]
+        simple_task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_simple.yaml'),
+            platform='local')[0]
+        wait_true(lambda: (Path(simple_task.output_path) / '.exit_code').exists())
+
+        # The server restarts: the new platform finds the running task, and the exit code of the finished one
+        monkeypatch.setitem(experiment_manager.platform_instances, ComputePlatformType.LOCAL, LocalPlatform())
+        experiment_manager.update_tasks([ComputePlatformType.LOCAL])
+        assert experiment_manager.get_tasks_by_id([long_task.id])[0].status == TaskStatus.Running
+        assert experiment_manager.get_tasks_by_id([simple_task.id])[0].status == TaskStatus.Finished
+
+        experiment_manager.cancel_tasks_by_id([long_task.id])
+
+        def check_exited():
+            return (Path(long_task.output_path) / '.exit_code').read_text() == '-15'
+
+        wait_true(check_exited)
+
+    def test_cpu_placement(self, monkeypatch):
+        monkeypatch.setattr(cpuplacement, 'read_config', lambda: {'cpu_placement': {'enabled': True}})
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_long.yaml'),
+            platform='local')[0]
+
+        # The task is pinned to the cpu it claimed
+        cpu_locks = local_platform.cpu_locks[task.job_id]
+        assert len(cpu_locks) == 1
+        assert os.sched_getaffinity(local_platform.processes[task.job_id].pid) == {cpu_locks[0].cpu}
+
+        experiment_manager.cancel_tasks_by_id([task.id])
+        wait_true(lambda: task.job_id not in local_platform.cpu_locks)
+        assert not cpu_locks[0].is_locked
+
+    def test_get_tasks_concurrent(self, monkeypatch):
+        experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_hp.yaml'),
+            platform='local')
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        fetch_logs = local_platform.fetch_logs
+
+        def slow_fetch_logs(task, **kwargs):
+            sleep(0.1)
+            return fetch_logs(task, **kwargs)
+
+        start = time()
+        experiment_manager.get_tasks(platform=ComputePlatformType.LOCAL)
+        base_duration = time() - start
+        monkeypatch.setattr(local_platform, 'fetch_logs', slow_fetch_logs)
+
+        # The tasks are monitored in parallel
+        start = time()
+        tasks = experiment_manager.get_tasks(platform=ComputePlatformType.LOCAL)
+        sequential_duration = 0.1 * len(tasks)
+        assert time() - start - base_duration < sequential_duration / 2
+
+        # The tasks that are not monitored before the deadline are marked as timed out
+        monkeypatch.setattr(experiment_manager, 'monitor_deadline_secs', 0.05)
+        tasks = experiment_manager.get_tasks(platform=ComputePlatformType.LOCAL)
+        assert all(t.logs == {'err': 'Timed out'} for t in tasks)
+        sleep(sequential_duration)  # Let the threads finish
+        assert all(t.logs == {'err': 'Timed out'} for t in tasks)  # They only modified snapshots
+
+    def test_get_tasks_dead_host(self, monkeypatch):
+        task_ids = [t.id for t in experiment_manager.create_tasks(config_file=str(scripts_path / 'test_hp.yaml'),
+                                                                  platform='local')]
+        dead_ids = set(task_ids[:2])
+        Task.update(hostname='dead').where(Task.id.in_(dead_ids)).execute()
+        local_platform = experiment_manager.platform_instances[ComputePlatformType.LOCAL]
+        fetch_logs = local_platform.fetch_logs
+
+        def fetch_logs_from_dead_host(task, **kwargs):
+            if task.hostname == 'dead':
+                sleep(2)
+            return fetch_logs(task, **kwargs)
+
+        monkeypatch.setattr(local_platform, 'fetch_logs', fetch_logs_from_dead_host)
+        monkeypatch.setattr(experiment_manager, 'monitor_deadline_secs', 0.5)
+
+        # The requests to the dead host time out; then the host is skipped while they are still running
+        for _ in range(2):
+            tasks = {t.id: t for t in experiment_manager.get_tasks(platform=ComputePlatformType.LOCAL)}
+            assert all((tasks[i].logs == {'err': 'Timed out'}) == (i in dead_ids) for i in task_ids)
+        start = time()
+        experiment_manager.get_tasks(platform=ComputePlatformType.LOCAL)
+        assert time() - start < 0.5
+        sleep(2)  # Let the threads finish
+
 
 @pytest.fixture
 def ht_platform():
@@ -253,6 +426,30 @@ class TestRq:
         # Check that the task finishes successfully
         wait_task_finished(task_id, interval_secs=2, tries=6)
 
+    def test_submit_resources(self, ht_platform):
+        tasks = experiment_manager.create_tasks(
+            platform='ht',
+            config_file=str(scripts_path / 'test_resources.yaml'))
+
+        # The task has been placed on the only worker host, which reports its capacity
+        wait_task_finished(tasks[0].id, interval_secs=1, tries=6)
+        assert experiment_manager.get_tasks_by_id([tasks[0].id])[0].hostname == 'localhost'
+
+    def test_progress(self, ht_platform):
+        task_id = experiment_manager.create_tasks(
+            platform='ht',
+            config_file=str(scripts_path / 'test_progress.yaml'))[0].id
+
+        # The progress is summarized by the worker; the progress log is not fetched
+        def check_progress():
+            tasks = experiment_manager.get_tasks(ComputePlatformType.HT)
+            t = next(t for t in tasks if t.id == task_id)
+            return t.cur_epoch == 1 and t.iter_per_epoch == 10 and t.total_time_remain is not None
+
+        wait_true(check_progress, interval_secs=1, tries=10)
+        assert task_id not in experiment_manager.log_cursors
+        wait_task_finished(task_id, interval_secs=1, tries=6)
+
     def test_submit_multiple(self, ht_platform):
         # Submit rq task
         tasks = experiment_manager.create_tasks(
@@ -323,6 +520,90 @@ class TestRq:
 
         wait_true(check_cancelled)
 
+    def test_cancel_many(self, ht_platform, monkeypatch):
+        tasks = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_long.yaml'),
+            platform='ht') + experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_long.yaml'),
+            platform='ht')
+        task_ids = [t.id for t in tasks]
+
+        def check_status(status):
+            experiment_manager.update_tasks([ComputePlatformType.HT])
+            return all(t.status == status for t in experiment_manager.get_tasks_by_id(task_ids))
+
+        wait_true(lambda: check_status(TaskStatus.Running), tries=10)
+
+        # One request for the worker host
+        worker_queue = ht_platform.worker_queues['localhost']
+        requests = []
+        enqueue_many = worker_queue.enqueue_many
+        monkeypatch.setattr(worker_queue, 'enqueue_many',
+                            lambda job_datas, **kwargs: requests.extend(job_datas) or enqueue_many(job_datas, **kwargs))
+        experiment_manager.cancel_tasks_by_id(task_ids)
+        assert len(requests) == 1
+
+        wait_true(lambda: check_status(TaskStatus.Cancelled))
+
+    def test_preemption(self, ht_platform):
+        # Occupy the two workers with low priority tasks
+        low_tasks = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_priority_low.yaml'),
+            platform='ht') + experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_priority_low.yaml'),
+            platform='ht')
+        low_ids = [t.id for t in low_tasks]
+
+        def check_running():
+            experiment_manager.update_tasks([ComputePlatformType.HT])
+            return all(t.status == TaskStatus.Running for t in experiment_manager.get_tasks_by_id(low_ids))
+
+        wait_true(check_running, tries=10)
+
+        high_task = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_priority_high.yaml'),
+            platform='ht')[0]
+        ht_platform.preemption_enabled = True
+        ht_platform.preemption_wait_secs = 0
+        try:
+            # One low priority task makes room for the high priority one, then it is resumed
+            wait_task_finished(high_task.id, interval_secs=1, tries=10)
+            preempted = [t for t in experiment_manager.get_tasks_by_id(low_ids) if t.job_id not in
+                         {lt.job_id for lt in low_tasks}]
+            assert len(preempted) == 1
+            wait_true(check_running, tries=10)
+        finally:
+            ht_platform.preemption_enabled = False
+            experiment_manager.cancel_tasks_by_id(low_ids)
+
+    def test_dead_worker(self, ht_platform, monkeypatch):
+        tasks = experiment_manager.create_tasks(
+            config_file=str(scripts_path / 'test_hp.yaml'),
+            platform='ht')[:2]
+        for t in tasks:
+            wait_task_finished(t.id, interval_secs=1, tries=8)
+
+        # Pretend that the tasks are running on a host which stopped sending heartbeats
+        monkeypatch.setattr(ht_platform, 'worker_hostnames', ht_platform.worker_hostnames + ['deadhost'])
+        monkeypatch.setattr(ht_platform, 'dead_worker_grace_secs', 0)
+
+        def run_on_dead_host(t):
+            ht_platform.redis_conn.hset('hypertrainer:job_status', t.job_id,
+                                        '{"status": "Running", "hostname": "deadhost"}')
+            ht_platform.redis_conn.delete('hypertrainer:heartbeat:' + t.job_id)
+            Task.update(status=TaskStatus.Running, hostname='deadhost').where(Task.id == t.id).execute()
+            experiment_manager.update_tasks([ComputePlatformType.HT])
+
+        # The first task is lost, the second is resubmitted and runs on the live host
+        run_on_dead_host(tasks[0])
+        assert experiment_manager.get_tasks_by_id([tasks[0].id])[0].status == TaskStatus.Lost
+        monkeypatch.setattr(ht_platform, 'requeue_lost_jobs', True)
+        run_on_dead_host(tasks[1])
+        wait_task_finished(tasks[1].id, interval_secs=1, tries=8)
+        requeued = experiment_manager.get_tasks_by_id([tasks[1].id])[0]
+        assert requeued.job_id != tasks[1].job_id
+        assert requeued.hostname == 'localhost'
+
     def test_acquire_one_gpu(self, monkeypatch, ht_platform_same_thread):
         monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0,1')
 
@@ -0,0 +1,71 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from hypertrainer.forkserver import ForkServer, ForkedProcess
+
+script = '''
+import json, os, sys
+print('preloaded' if 'csv' in sys.modules else 'not preloaded')
+print(os.getcwd())
+print(os.environ.get('HT_TEST_VAR'))
+print(sys.argv[1])
+print(sorted(os.sched_getaffinity(0)))
+print('error', file=sys.stderr)
+if sys.argv[1] == 'sleep':
+    import time
+    time.sleep(30)
+sys.exit(3)
+'''
+
+
+def test_fork_server():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        script_file = tmpdir / 'script.py'
+        script_file.write_text(script)
+        fork_server = ForkServer([sys.executable], ['csv'], socket_dir=tmpdir)
+        cpu = min(os.sched_getaffinity(0))
+        try:
+            env = dict(os.environ, HT_TEST_VAR='hello')
+            p = fork_server.launch([script_file, 'arg'], tmpdir, tmpdir / 'out.txt', tmpdir / 'err.txt', env,
+                                   exit_code_path=tmpdir / 'exit_code', cpus=[cpu])
+            assert p.wait() == 3
+            assert p.poll() == 3
+            assert (tmpdir / 'exit_code').read_text() == '3'
+            out = (tmpdir / 'out.txt').read_text().splitlines()
+            assert out == ['preloaded', str(tmpdir), 'hello', 'arg', f'[{cpu}]']
+            assert (tmpdir / 'err.txt').read_text() == 'error\n'
+
+            # The zygote is already running
+            t0 = time.monotonic()
+            p = fork_server.launch([script_file, 'sleep'], tmpdir, tmpdir / 'out.txt', tmpdir / 'err.txt')
+            assert time.monotonic() - t0 < 1
+            assert p.poll() is None
+            p.terminate()
+            assert p.wait() == -15
+        finally:
+            fork_server.stop()
+        assert not fork_server.socket_path.exists()
+
+
+def test_forked_process_orphaned():
+    sleeper = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+    conn, zygote_conn = socket.socketpair()
+    zygote_conn.close()  # The zygote died
+    p = ForkedProcess(sleeper.pid, conn)
+    try:
+        # The poll does not wait for the process
+        t0 = time.monotonic()
+        assert p.poll() is None
+        assert p.poll() is None
+        assert time.monotonic() - t0 < 1
+    finally:
+        sleeper.kill()
+        sleeper.wait()
+    assert p.poll() == ForkedProcess.lost_returncode
+    assert p.wait() == ForkedProcess.lost_returncode
@@ -1,11 +1,17 @@
 import multiprocessing as mp
 import os
+import threading
 import time
 from pathlib import Path
 
 import pytest
+from redis import Redis
+from rq import Queue
 
-from hypertrainer.utils import GpuLockManager, PidFile
+from hypertrainer import utils
+from hypertrainer.htplatform_worker import GpuAwareWorker, jobs_queue_name, claimed_gpus_env_var, queue_num_gpus, \
+    queue_priority
+from hypertrainer.utils import GpuLockManager, PidFile, read_config
 
 
 def try_acquire(q):
@@ -53,3 +59,105 @@ def test_no_gpu(monkeypatch):
 
     with pytest.raises(Exception):
         GpuLockManager().acquire_one_gpu()
+
+
+def try_acquire_gpus(q, num_gpus):
+    gpu_locks = GpuLockManager().acquire_gpus(num_gpus)
+    q.put(sorted(lock.gpu_id for lock in gpu_locks))
+    time.sleep(0.5)
+    for lock in gpu_locks:
+        lock.release()
+
+
+def test_acquire_gpus(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0,1,2')
+
+    # 2 jobs of 2 GPUs cannot run at the same time on 3 GPUs; the second one waits for the first
+    q = mp.Queue()
+    processes = [mp.Process(target=try_acquire_gpus, args=(q, 2)) for _ in range(2)]
+    for p in processes:
+        p.start()
+    start = time.time()
+    assert len(q.get()) == 2
+    assert len(q.get()) == 2
+    assert time.time() - start >= 0.5
+    for p in processes:
+        p.join()
+
+    with pytest.raises(Exception):
+        GpuLockManager().acquire_gpus(4)
+
+
+def test_wait_for_release(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0')
+    manager = GpuLockManager()
+    gpu_lock = manager.acquire_one_gpu()
+    num_threads = threading.active_count()
+    start = time.time()
+    manager.wait_for_release(1, timeout_secs=0.3)
+    assert time.time() - start >= 0.3
+    assert threading.active_count() == num_threads  # Nothing is left waiting on the lock
+
+    gpu_lock.release()
+    start = time.time()
+    manager.wait_for_release(1, timeout_secs=10)
+    assert time.time() - start < 1
+    gpu_locks = GpuLockManager().try_acquire_gpus(1)
+    assert gpu_locks is not None
+    gpu_locks[0].release()
+
+
+def test_acquire_gpus_interconnect(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0,1,2,3')
+    topo = ('\tGPU0\tGPU1\tGPU2\tGPU3\tCPU Affinity\n'
+            'GPU0\t X \tSYS\tNV2\tSYS\t0-7\n'
+            'GPU1\tSYS\t X \tSYS\tNV2\t0-7\n'
+            'GPU2\tNV2\tSYS\t X \tSYS\t0-7\n'
+            'GPU3\tSYS\tNV2\tSYS\t X \t0-7\n')
+    monkeypatch.setattr(utils, 'gpu_link_scores', lambda: utils.parse_gpu_topology(topo))
+
+    manager = GpuLockManager()
+    gpu_locks = manager.acquire_gpus(2)
+    assert sorted(lock.gpu_id for lock in gpu_locks) == ['0', '2']  # Linked with NVLink
+    assert sorted(lock.gpu_id for lock in manager.acquire_gpus(2)) == ['1', '3']
+    assert manager.try_acquire_gpus(1) is None
+    for lock in manager.locks:
+        lock.release()
+
+
+def get_claimed_gpus():
+    return os.environ.get(claimed_gpus_env_var)
+
+
+def test_gpu_aware_worker(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '0')
+    redis_conn = Redis(port=read_config()['ht_platform']['redis_port'], db=1)  # Not seen by the running workers
+    redis_conn.flushdb()
+    gpu_job = Queue(jobs_queue_name(1), connection=redis_conn).enqueue(get_claimed_gpus)
+    cpu_job = Queue(jobs_queue_name(0), connection=redis_conn).enqueue(get_claimed_gpus)
+
+    # The gpu is taken: only the cpu job can be dequeued
+    gpu_lock = GpuLockManager().acquire_one_gpu()
+    GpuAwareWorker(connection=redis_conn).work(burst=True)
+    assert cpu_job.get_status(refresh=True) == 'finished'
+    assert gpu_job.get_status(refresh=True) == 'queued'
+
+    gpu_lock.release()
+    GpuAwareWorker(connection=redis_conn).work(burst=True)
+    assert gpu_job.get_status(refresh=True) == 'finished'
+    assert gpu_job.result == '0'
+
+
+def test_priority_queues():
+    redis_conn = Redis(port=read_config()['ht_platform']['redis_port'], db=1)  # Not seen by the running workers
+    redis_conn.flushdb()
+    low_job = Queue(jobs_queue_name(0, 'low'), connection=redis_conn).enqueue(get_claimed_gpus)
+    normal_job = Queue(jobs_queue_name(0), connection=redis_conn).enqueue(get_claimed_gpus)
+    high_job = Queue(jobs_queue_name(0, 'high'), connection=redis_conn).enqueue(get_claimed_gpus)
+    assert queue_priority(jobs_queue_name(2, 'low')) == 'low' and queue_num_gpus(jobs_queue_name(2, 'low')) == 2
+
+    GpuAwareWorker(connection=redis_conn).work(burst=True)
+    jobs = [high_job, normal_job, low_job]
+    for job in jobs:
+        job.refresh()
+    assert sorted(jobs, key=lambda j: j.started_at) == jobs
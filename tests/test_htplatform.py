@@ -0,0 +1,109 @@
+import json
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from redis import Redis
+from redis.client import PubSubWorkerThread
+
+import hypertrainer.htplatform_worker
+from hypertrainer.htplatform import HtPlatform
+from hypertrainer.htplatform_worker import run, cancel_jobs, job_status_key, job_progress_key, heartbeat_key_prefix, \
+    ended_jobs_key, ended_job_ttl_secs
+from hypertrainer.logstream import LogStreamReader
+from hypertrainer.task import Task
+from hypertrainer.utils import TaskStatus, read_config
+from hypertrainer.workerdb import WorkerDb
+
+scripts_path = Path(__file__).parent / 'scripts'
+
+
+@pytest.fixture
+def platform():
+    p = HtPlatform()
+    p.redis_conn = Redis(port=read_config()['ht_platform']['redis_port'], db=1)  # Not seen by the running workers
+    p.redis_conn.flushdb()
+    p.log_stream_reader = LogStreamReader(p.redis_conn)
+    p.preemption_enabled = False
+    return p
+
+
+def publish(redis_conn, job_id, status: TaskStatus, heartbeat=True):
+    redis_conn.hset(job_status_key, job_id, json.dumps({'status': status.value, 'hostname': 'localhost'}))
+    if heartbeat:
+        redis_conn.set(heartbeat_key_prefix + job_id, 1)
+
+
+def test_update_tasks(platform):
+    r = platform.redis_conn
+    tasks = {job_id: Task(job_id=job_id, status=status) for job_id, status in
+             [('running', TaskStatus.Running), ('finished', TaskStatus.Running), ('unmonitored', TaskStatus.Running),
+              ('waiting', TaskStatus.Waiting), ('missing', TaskStatus.Running)]}
+    publish(r, 'running', TaskStatus.Running)
+    r.hset(job_progress_key, 'running', json.dumps({'cur_epoch': 2, 'cur_phase': 'train', 'cur_iter': 5,
+                                                    'iter_per_epoch': 10, 'epoch_duration': None,
+                                                    'cur_epoch_start_time': time.time()}))
+    publish(r, 'finished', TaskStatus.Finished, heartbeat=False)
+    publish(r, 'unmonitored', TaskStatus.Running, heartbeat=False)
+
+    platform.update_tasks(list(tasks.values()))
+
+    assert {job_id: t.status for job_id, t in tasks.items()} == {
+        'running': TaskStatus.Running, 'finished': TaskStatus.Finished, 'unmonitored': TaskStatus.Unknown,
+        'waiting': TaskStatus.Waiting, 'missing': TaskStatus.Unknown}
+    assert tasks['running'].hostname == 'localhost'
+    assert (tasks['running'].cur_epoch, tasks['running'].cur_phase) == (2, 'train')
+
+
+def test_update_tasks_trims_ended_jobs(platform):
+    r = platform.redis_conn
+    for job_id in ('old', 'recent'):
+        publish(r, job_id, TaskStatus.Finished, heartbeat=False)
+        r.hset(job_progress_key, job_id, '{}')
+    r.zadd(ended_jobs_key, {'old': time.time() - ended_job_ttl_secs - 1, 'recent': time.time()})
+
+    platform.update_tasks([Task(job_id='running', status=TaskStatus.Running)])
+
+    assert r.hkeys(job_status_key) == [b'recent']
+    assert r.hkeys(job_progress_key) == [b'recent']
+    assert r.zrange(ended_jobs_key, 0, -1) == [b'recent']
+
+
+def test_update_tasks_forgets_log_cursors(platform):
+    publish(platform.redis_conn, 'running', TaskStatus.Running)
+    publish(platform.redis_conn, 'finished', TaskStatus.Finished, heartbeat=False)
+    platform.log_stream_reader._cursors.update({'running': ('0', -1, {}), 'finished': ('0', -1, {})})
+
+    platform.update_tasks([Task(job_id='running', status=TaskStatus.Running),
+                           Task(job_id='finished', status=TaskStatus.Running)])
+
+    assert list(platform.log_stream_reader._cursors) == ['running']
+
+
+def test_run_cancel_message_missed(platform, monkeypatch, tmp_path):
+    monkeypatch.setattr(hypertrainer.htplatform_worker, 'local_db', WorkerDb(tmp_path / 'worker_db.sqlite'))
+    monkeypatch.setattr(hypertrainer.htplatform_worker, 'cancel_check_interval_secs', 1)
+    job = SimpleNamespace(id=str(uuid.uuid4()), connection=platform.redis_conn)
+    monkeypatch.setattr(hypertrainer.htplatform_worker, 'get_current_job', lambda: job)
+    run_thread = threading.Thread(target=run, args=(scripts_path / 'script_test_long.py', tmp_path / 'output',
+                                                    'script: script_test_long.py\n', [sys.executable], False))
+    run_thread.start()
+    for _ in range(20):
+        if hypertrainer.htplatform_worker.local_db.get_status(job.id) is not None:
+            break
+        time.sleep(0.1)
+
+    # The cancellation message is published on a channel that the job does not listen to
+    monkeypatch.setattr(hypertrainer.htplatform_worker, 'cancel_channel_prefix', 'hypertrainer:test:missed:')
+    cancel_jobs([job.id])
+
+    run_thread.join(timeout=5)
+    assert not run_thread.is_alive()
+    assert json.loads(platform.redis_conn.hget(job_status_key, job.id))['status'] == TaskStatus.Cancelled.value
+    for thread in threading.enumerate():
+        if isinstance(thread, PubSubWorkerThread):
+            thread.join()  # It closes its connection within a second of being stopped
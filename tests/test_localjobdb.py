@@ -0,0 +1,22 @@
+import tempfile
+from pathlib import Path
+
+from hypertrainer.localjobdb import LocalJobDb
+
+
+def test_local_job_db():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = LocalJobDb(Path(tmpdir) / 'db.sqlite')
+        db.insert_job('b', {'cpus': 1})
+        db.insert_job('a', {'cpus': 2})
+        db.set_started('b', 123, 456, ['python', 'script.py'], ['0'])
+        assert db.get_jobs() == {
+            'b': {'args': {'cpus': 1}, 'pid': 123, 'start_time': 456, 'command': ['python', 'script.py'],
+                  'gpu_ids': ['0']},
+            'a': {'args': {'cpus': 2}, 'pid': None, 'start_time': None, 'command': None, 'gpu_ids': None}}
+        assert list(db.get_jobs()) == ['b', 'a']  # In order of insertion
+
+        # Another instance, e.g. after a restart
+        db = LocalJobDb(Path(tmpdir) / 'db.sqlite')
+        db.delete_jobs(['b', 'c'])
+        assert db.get_jobs().keys() == {'a'}
@@ -0,0 +1,195 @@
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from hypertrainer.logparser import LogParser, ProgressSummarizer
+from hypertrainer.utils import read_logs, LogCursor, compress_data, decompress_data
+
+
+def test_read_logs_offsets():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        out_file.write_text('first\n')
+
+        offsets = {}
+        assert read_logs(tmpdir, offsets) == {'out': 'first\n'}
+        assert offsets == {'out': 6}
+
+        # Nothing new
+        assert read_logs(tmpdir, offsets) == {'out': ''}
+
+        with out_file.open('a') as f:
+            f.write('second\n')
+        assert read_logs(tmpdir, offsets) == {'out': 'second\n'}
+        assert offsets == {'out': 13}
+
+        # Without offsets, everything is read
+        assert read_logs(tmpdir) == {'out': 'first\nsecond\n'}
+
+
+def test_read_logs_incomplete_char():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        encoded = 'é'.encode('utf-8')
+        out_file.write_bytes(b'a' + encoded[:1])
+
+        offsets = {}
+        assert read_logs(tmpdir, offsets) == {'out': 'a'}
+        with out_file.open('ab') as f:
+            f.write(encoded[1:])
+        assert read_logs(tmpdir, offsets) == {'out': 'é'}
+
+
+def test_log_cursor_truncated():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        out_file.write_text('first run\n')
+
+        cursor = LogCursor()
+        cursor.update(read_logs(tmpdir, cursor.offsets))
+        with out_file.open('a') as f:
+            f.write('more\n')
+        new_logs = read_logs(tmpdir, cursor.offsets)
+        assert cursor.truncated_logs() == set()
+        cursor.update(new_logs)
+        assert cursor.logs['out'] == 'first run\nmore\n'
+
+        out_file.write_text('again\n')
+        new_logs = read_logs(tmpdir, cursor.offsets)
+        assert cursor.truncated_logs() == {'out'}
+        cursor.update(new_logs)
+        assert cursor.logs['out'] == 'again\n'
+
+
+def test_log_parser_progress():
+    parser = LogParser()
+    parser.feed('progress', 'epoch\tphase\titer\tn_iter\ttime\n0\ttrn\t0\t2\t100.0\n0\ttrn\t1\t2\t1')
+    assert parser.cur_epoch == 0
+    assert parser.cur_iter == 0
+    assert parser.epoch_duration is None
+
+    # The incomplete line is completed by the next chunk
+    parser.feed('progress', '10.0\n1\tval\t0\t2\t130.0\n')
+    assert parser.cur_iter == 0
+    assert parser.cur_phase == 'val'
+    assert parser.iter_per_epoch == 2
+    assert parser.epoch_duration == 30.0
+
+    parser.feed('progress', '2\ttrn\t1\t2\t190.0\n')
+    assert parser.cur_epoch == 2
+    assert parser.epoch_duration == 45.0
+    assert parser.cur_epoch_start_time == 190.0
+
+    parser.reset(['progress'])
+    assert not parser.has_progress
+
+
+def test_progress_summarizer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        progress_file = Path(tmpdir) / 'progress.log'
+        summarizer = ProgressSummarizer(tmpdir)
+        assert not summarizer.update()
+        assert summarizer.summary is None
+
+        progress_file.write_text('0\ttrn\t0\t2\t100.0\n1\ttrn\t0\t2\t130.0\n')
+        assert summarizer.update()
+        assert summarizer.summary == {'cur_epoch': 1, 'cur_phase': 'trn', 'cur_iter': 0, 'iter_per_epoch': 2,
+                                      'epoch_duration': 30.0, 'cur_epoch_start_time': 130.0}
+        assert not summarizer.update()  # Nothing new
+
+        # The log is rewritten, e.g. when the task is resumed
+        progress_file.write_text('0\tval\t1\t2\t200.0\n')
+        assert summarizer.update()
+        assert summarizer.summary['cur_epoch'] == 0
+        assert summarizer.summary['epoch_duration'] is None
+
+
+def test_log_parser_metrics():
+    parser = LogParser()
+    parser.feed('metric_loss', '0\t0.5\n')
+    parser.feed('metric_classwise_acc', '0\t0\t0.1\n0\t1\t0.2\n')
+    cleared, new_rows = parser.pop_metric_updates()
+    assert cleared == set()
+    assert set(new_rows.keys()) == {('loss', None), ('acc', '0'), ('acc', '1')}
+    np.testing.assert_array_equal(new_rows[('loss', None)], [[0, 0.5]])
+
+    parser.feed('metric_loss', '1\t0.25\n')
+    cleared, new_rows = parser.pop_metric_updates()
+    np.testing.assert_array_equal(new_rows[('loss', None)], [[1, 0.25]])
+
+    parser.reset(['metric_classwise_acc'])
+    parser.feed('metric_classwise_acc', '0\t1\t0.3\n')
+    cleared, new_rows = parser.pop_metric_updates()
+    assert cleared == {'acc'}
+    np.testing.assert_array_equal(new_rows[('acc', '1')], [[0, 0.3]])
+
+
+def test_read_logs_keys():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in ('out.txt', 'progress.log', 'metric_loss.log', 'metric_classwise_iou.log'):
+            (Path(tmpdir) / name).write_text(name)
+
+        assert read_logs(tmpdir, keys=['progress']) == {'progress': 'progress.log'}
+        assert set(read_logs(tmpdir, keys=['metric_*', 'out']).keys()) == {'out', 'metric_loss', 'metric_classwise_iou'}
+
+        offsets = {}
+        read_logs(tmpdir, offsets, keys=['progress'])
+        assert offsets == {'progress': len('progress.log')}
+
+
+def test_read_logs_max_bytes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        out_file.write_text('0123456789')
+        (Path(tmpdir) / 'progress.log').write_text('0123456789')
+
+        cursor = LogCursor()
+        cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=4, starts=cursor.starts))
+        assert cursor.logs == {'out': '6789', 'progress': '0123456789'}  # Only out and err are capped
+        assert cursor.is_partial('out')
+        assert cursor.offsets['out'] == 10
+
+        with out_file.open('a') as f:
+            f.write('ab')
+        cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=4, starts=cursor.starts))
+        assert cursor.logs['out'] == '6789ab'
+
+        # Load more history
+        cursor.request_history(100)
+        cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=100, starts=cursor.starts))
+        assert cursor.logs['out'] == '0123456789ab'
+        assert not cursor.is_partial('out')
+
+
+def test_log_cursor_max_bytes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        out_file.write_text('0123456789')
+
+        # The appended data does not grow the capped logs beyond max_bytes
+        cursor = LogCursor(max_bytes=4)
+        for _ in range(3):
+            cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=4, starts=cursor.starts))
+            with out_file.open('a') as f:
+                f.write('ab')
+        assert cursor.logs['out'] == 'abab'
+        assert cursor.log_starts['out'] == 10
+
+        # The history is returned by the request that loads it only
+        cursor.request_history(100)
+        cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=100, starts=cursor.starts))
+        assert cursor.logs['out'] == '0123456789ababab'
+        assert not cursor.is_partial('out')
+        with out_file.open('a') as f:
+            f.write('cd')
+        cursor.update(read_logs(tmpdir, cursor.offsets, max_bytes=4, starts=cursor.starts))
+        assert cursor.logs['out'] == 'abcd'
+        assert cursor.log_starts['out'] == 14
+
+
+def test_compress_data():
+    obj = {'logs': {'out': 'x' * 1000}, 'offsets': {'out': 1000}}
+    data = compress_data(obj)
+    assert len(data) < 100
+    assert decompress_data(data) == obj
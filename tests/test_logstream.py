@@ -0,0 +1,88 @@
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+from redis import Redis
+
+import hypertrainer.logstream
+from hypertrainer.logstream import LogForwarder, LogStreamReader
+from hypertrainer.utils import read_config, LogCursor
+
+
+@pytest.fixture
+def redis_conn():
+    return Redis(port=read_config()['ht_platform']['redis_port'])
+
+
+def test_log_stream(redis_conn):
+    job_id = str(uuid.uuid4())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = Path(tmpdir) / 'out.txt'
+        out_file.write_text('first\n')
+        (Path(tmpdir) / 'progress.log').write_text('0\n')
+
+        forwarder = LogForwarder(redis_conn, job_id, tmpdir)
+        reader = LogStreamReader(redis_conn)
+        cursor = LogCursor()
+        assert reader.read(job_id, cursor.offsets) is None  # Nothing forwarded yet
+
+        forwarder.forward()
+        cursor.update(reader.read(job_id, cursor.offsets, keys=['progress'], starts=cursor.starts))
+        assert cursor.logs == {'progress': '0\n'}
+
+        with out_file.open('a') as f:
+            f.write('second\n')
+        forwarder.forward()
+        cursor.update(reader.read(job_id, cursor.offsets, starts=cursor.starts))
+        assert cursor.logs == {'progress': '0\n', 'out': 'first\nsecond\n'}
+        assert reader.read(job_id, cursor.offsets) == {}
+
+        # Capped logs
+        cursor = LogCursor()
+        cursor.update(reader.read(job_id, cursor.offsets, max_bytes=7, starts=cursor.starts))
+        assert cursor.logs['out'] == 'second\n'
+        assert cursor.is_partial('out')
+
+        # Truncated log
+        out_file.write_text('new\n')
+        forwarder.close()
+        cursor.update(reader.read(job_id, cursor.offsets, starts=cursor.starts))
+        assert cursor.logs['out'] == 'new\n'
+    redis_conn.delete(hypertrainer.logstream.log_stream_key_prefix + job_id)
+
+
+def test_log_stream_trimmed(redis_conn, monkeypatch):
+    monkeypatch.setattr(hypertrainer.logstream, 'log_stream_chunk_bytes', 1)
+    monkeypatch.setattr(hypertrainer.logstream, 'log_stream_maxlen', 10)
+    job_id = str(uuid.uuid4())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / 'out.txt').write_text('x' * 1000)
+        forwarder = LogForwarder(redis_conn, job_id, tmpdir)
+        forwarder.forward()
+        reader = LogStreamReader(redis_conn)
+        assert reader.read(job_id, {}) is None  # The beginning has been trimmed
+
+        # The caller read the logs through the worker: the next read resumes after the trimmed entries
+        offsets = {'out': 1000}
+        with (Path(tmpdir) / 'out.txt').open('a') as f:
+            f.write('yz')
+        forwarder.close()
+        assert reader.read(job_id, offsets) == {'out': 'yz'}
+        assert offsets == {'out': 1002}
+    redis_conn.delete(hypertrainer.logstream.log_stream_key_prefix + job_id)
+
+
+def test_log_stream_expired(redis_conn):
+    job_id = str(uuid.uuid4())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        (Path(tmpdir) / 'out.txt').write_text('first\n')
+        LogForwarder(redis_conn, job_id, tmpdir).close()
+        reader = LogStreamReader(redis_conn)
+        assert reader.read(job_id, {}) == {'out': 'first\n'}
+        assert job_id in reader._cursors
+
+        # The cursor of the job is evicted when its stream is gone
+        redis_conn.delete(hypertrainer.logstream.log_stream_key_prefix + job_id)
+        assert reader.read(job_id, {}) is None
+        assert job_id not in reader._cursors
@@ -0,0 +1,30 @@
+import tempfile
+import uuid
+from pathlib import Path
+
+import numpy as np
+
+from hypertrainer.metricstore import MetricStore
+
+
+def test_append_load():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = MetricStore(Path(tmpdir))
+        task_uuid = uuid.uuid4()
+        assert store.load(task_uuid) == {}
+
+        store.append(task_uuid, 'loss', np.array([[0, 0.5]]))
+        store.append(task_uuid, 'loss', np.array([[1, 0.25], [2, 0.125]]))
+        store.append(task_uuid, 'iou', np.array([[0, 0.1]]), label='10')
+        store.append(task_uuid, 'iou', np.array([[0, 0.2]]), label='2')
+
+        metrics = store.load(task_uuid)
+        np.testing.assert_array_equal(metrics['loss'], [[0, 0.5], [1, 0.25], [2, 0.125]])
+        assert list(metrics['iou'].keys()) == ['2', '10']
+        np.testing.assert_array_equal(metrics['iou']['10'], [[0, 0.1]])
+
+        store.clear(task_uuid, 'iou')
+        assert set(store.load(task_uuid).keys()) == {'loss'}
+
+        store.delete(task_uuid)
+        assert store.load(task_uuid) == {}
@@ -0,0 +1,37 @@
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from hypertrainer.resources import required_resources, read_host_capacity, free_resources, best_fit_host
+
+
+def test_required_resources():
+    assert required_resources({}) == {'cpus': 1, 'mem_gb': 0, 'gpus': 0}
+    assert required_resources({'num_gpus': 2}) == {'cpus': 1, 'mem_gb': 0, 'gpus': 2}
+    assert required_resources({'resources': {'cpus': 4, 'mem_gb': 16}}) == {'cpus': 4, 'mem_gb': 16, 'gpus': 0}
+    with pytest.raises(ValueError):
+        required_resources({'resources': {'ram': 16}})
+
+
+def test_read_host_capacity():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        proc_path = Path(tmpdir)
+        (proc_path / 'cpuinfo').write_text('processor\t: 0\nmodel name\t: x\n\nprocessor\t: 1\nmodel name\t: x\n')
+        (proc_path / 'meminfo').write_text('MemTotal:       16777216 kB\nMemFree:         1000 kB\n')
+        assert read_host_capacity(proc_path, num_gpus=1) == {'cpus': 2, 'mem_gb': 16, 'gpus': 1}
+
+
+def test_best_fit_host():
+    capacities = {'small': {'cpus': 4, 'mem_gb': 8, 'gpus': 0},
+                  'big': {'cpus': 32, 'mem_gb': 256, 'gpus': 0}}
+    free = {h: free_resources(c, []) for h, c in capacities.items()}
+
+    # The small job fits better on the small host, the big one only on the big host
+    assert best_fit_host(free, capacities, {'cpus': 2, 'mem_gb': 4, 'gpus': 0}) == 'small'
+    assert best_fit_host(free, capacities, {'cpus': 2, 'mem_gb': 64, 'gpus': 0}) == 'big'
+    assert best_fit_host(free, capacities, {'cpus': 1, 'mem_gb': 1, 'gpus': 1}) is None
+
+    # Once the small host is full, the small jobs go to the big host
+    free['small'] = free_resources(free['small'], [{'cpus': 4, 'mem_gb': 1}])
+    assert best_fit_host(free, capacities, {'cpus': 2, 'mem_gb': 4, 'gpus': 0}) == 'big'
@@ -0,0 +1,43 @@
+import tempfile
+from pathlib import Path
+
+from hypertrainer.slurmplatform import SlurmPlatform
+from hypertrainer.sshconnection import SshConnection
+from test_sshconnection import make_fake_ssh
+
+
+def test_fetch_logs(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        log_path = make_fake_ssh(tmpdir, monkeypatch)
+        job_path = tmpdir / 'job'
+        job_path.mkdir()
+        (job_path / 'out.txt').write_text('0123456789')
+        (job_path / 'progress.log').write_text('epoch 1\n')
+        (job_path / 'metric_loss.log').write_text('1.0\n')
+
+        platform = SlurmPlatform('user@server')
+        platform.ssh = SshConnection('user@server', control_dir=tmpdir)
+        monkeypatch.setattr(platform, '_make_job_path', lambda task: str(job_path))
+        try:
+            assert platform.fetch_logs(None) == {'out': '0123456789', 'progress': 'epoch 1\n', 'metric_loss': '1.0\n'}
+
+            # Only the new data is transferred, and only the last max_bytes of out and err
+            offsets, starts = {}, {}
+            assert platform.fetch_logs(None, offsets=offsets, max_bytes=4, starts=starts) == \
+                {'out': '6789', 'progress': 'epoch 1\n', 'metric_loss': '1.0\n'}
+            assert offsets == {'out': 10, 'progress': 8, 'metric_loss': 4}
+            assert starts['out'] == 6
+            with (job_path / 'out.txt').open('a') as f:
+                f.write('ab')
+            assert platform.fetch_logs(None, offsets=offsets, max_bytes=4) == \
+                {'out': 'ab', 'progress': '', 'metric_loss': ''}
+
+            # Keys, and truncated logs
+            (job_path / 'progress.log').write_text('new\n')
+            assert platform.fetch_logs(None, keys=['progress', 'metric_*'], offsets=offsets) == \
+                {'progress': 'new\n', 'metric_loss': ''}
+            assert platform.fetch_logs(None, keys=[], offsets=offsets) == {}
+            assert set(log_path.read_text().splitlines()) == {'master', 'ssh mux'}
+        finally:
+            platform.ssh.close()
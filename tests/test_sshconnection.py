@@ -0,0 +1,130 @@
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from hypertrainer.sshconnection import SshConnection
+
+# Fake ssh and scp: the master is a process listening on the control socket, and the commands run locally. Each
+# connection is logged to $FAKE_SSH_LOG: 'master', or the name of the command and whether it used the master.
+fake_ssh = '''#!{python}
+import os, socket, subprocess, sys, time
+
+options, control_command, positional = {{}}, None, []
+args = sys.argv[1:]
+while args:
+    arg = args.pop(0)
+    if arg == '-o':
+        key, value = args.pop(0).split('=', 1)
+        options[key] = value
+    elif arg == '-O':
+        control_command = args.pop(0)
+    elif not arg.startswith('-'):
+        positional.append(arg)
+control_path = options.get('ControlPath')
+name = os.path.basename(sys.argv[0])
+
+
+def log(line):
+    with open(os.environ['FAKE_SSH_LOG'], 'a') as f:
+        f.write(line + '\\n')
+
+
+def master_alive():
+    conn = socket.socket(socket.AF_UNIX)
+    try:
+        conn.connect(control_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        conn.close()
+
+
+if control_command == 'check':
+    sys.exit(0 if master_alive() else 255)
+elif control_command == 'exit':
+    os.kill(int(open(control_path + '.pid').read()), 15)
+    sys.exit(0)
+elif options.get('ControlMaster') == 'yes':
+    if os.environ.get('FAKE_SSH_MASTER_FAILS'):
+        print('mux_client_request_session: session request failed', file=sys.stderr)
+        sys.exit(255)
+    if os.path.exists(control_path + '.pid'):
+        os.unlink(control_path + '.pid')  # Of a master which was killed
+    listener = socket.socket(socket.AF_UNIX)
+    listener.bind(control_path)
+    listener.listen(8)
+    if os.fork() == 0:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        with open(control_path + '.pid', 'w') as f:
+            f.write(str(os.getpid()))
+        while True:
+            listener.accept()[0].close()
+    while not os.path.exists(control_path + '.pid'):
+        time.sleep(0.01)
+    log('master')
+    sys.exit(0)
+
+log(name + (' mux' if master_alive() else ' direct'))
+if name == 'scp':
+    source, destination = [p.split(':', 1)[-1] for p in positional]
+    sys.exit(subprocess.run(['bash', '-c', f'cp {{source}} {{destination}}']).returncode)
+command = positional[1] if len(positional) > 1 else 'sh'  # The script is read from stdin
+sys.exit(subprocess.run(command, shell=True).returncode)
+'''
+
+
+def make_fake_ssh(bin_path: Path, monkeypatch):
+    for name in ('ssh', 'scp'):
+        path = bin_path / name
+        path.write_text(fake_ssh.format(python=sys.executable))
+        path.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_path}:{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_SSH_LOG', str(bin_path / 'log.txt'))
+    return bin_path / 'log.txt'
+
+
+def test_ssh_connection(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        log_path = make_fake_ssh(tmpdir, monkeypatch)
+        ssh = SshConnection('user@server', control_dir=tmpdir)
+        try:
+            # The commands share one connection
+            assert ssh.run('echo hello', stdout=subprocess.PIPE).stdout == b'hello\n'
+            assert ssh.run(input=b'echo world', stdout=subprocess.PIPE).stdout == b'world\n'
+            (tmpdir / 'remote').mkdir()
+            (tmpdir / 'remote' / 'out.txt').write_text('remote')
+            (tmpdir / 'local').mkdir()
+            ssh.scp(f'user@server:{tmpdir}/remote/*.txt', str(tmpdir / 'local'))
+            assert (tmpdir / 'local' / 'out.txt').read_text() == 'remote'
+            assert log_path.read_text().splitlines() == ['master', 'ssh mux', 'ssh mux', 'scp mux']
+
+            # The master died: it is restarted at the next check
+            os.kill(int(Path(f'{ssh.control_path}.pid').read_text()), signal.SIGKILL)
+            assert not ssh.is_connected()
+            ssh.check_interval_secs = 0
+            ssh.run('true')
+            assert log_path.read_text().splitlines()[-2:] == ['master', 'ssh mux']
+        finally:
+            ssh.close()
+        assert not ssh.is_connected()
+
+
+def test_ssh_connection_without_master(monkeypatch):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        log_path = make_fake_ssh(tmpdir, monkeypatch)
+        monkeypatch.setenv('FAKE_SSH_MASTER_FAILS', '1')
+        ssh = SshConnection('user@server', control_dir=tmpdir)
+
+        # The commands connect by themselves
+        assert ssh.run('echo hello', stdout=subprocess.PIPE).stdout == b'hello\n'
+        assert log_path.read_text().splitlines() == ['ssh direct']
+        assert 'session request failed' in ssh.log_path.read_text()
@@ -0,0 +1,96 @@
+import itertools
+import json
+import sys
+from pathlib import Path
+
+import pytest
+from redis import Redis
+from rq.worker import WorkerStatus
+
+from hypertrainer.htplatform_worker import jobs_queue_name, worker_pool_key_prefix, reservations_key_prefix
+from hypertrainer.utils import read_config
+
+sys.path.insert(0, str(Path(__file__).parents[1]))  # worker.py is a script at the root of the repository
+import worker  # noqa: E402
+
+
+class FakeQueue:
+    def __init__(self, name, count=0):
+        self.name = name
+        self.count = count
+
+
+class FakeProcess:
+    def __init__(self):
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+
+@pytest.fixture
+def context(monkeypatch):
+    monkeypatch.setenv('CUDA_VISIBLE_DEVICES', '')
+    c = worker.WorkerContext('test_host', num_workers=1, max_workers=8)
+    c.redis_conn = Redis(port=read_config()['ht_platform']['redis_port'], db=1)  # Not seen by the running workers
+    c.redis_conn.flushdb()
+    c.capacity = {'cpus': 4, 'mem_gb': 16, 'gpus': 0}
+    c.max_workers = 4
+    c.jobs_queues = [FakeQueue(jobs_queue_name(0))]
+
+    # The workers are fake processes, busy unless they are marked idle
+    names = (f'worker_{i}' for i in itertools.count())
+    idle = set()
+    monkeypatch.setattr(c, 'start_jobs_worker',
+                        lambda max_idle_time=None: c.jobs_worker_processes.__setitem__(next(names), FakeProcess()))
+    monkeypatch.setattr(c, 'get_worker_state', lambda name: WorkerStatus.IDLE if name in idle else WorkerStatus.BUSY)
+    c.idle = idle
+    c.start_jobs_worker()
+    return c
+
+
+def pool_stats(c):
+    return json.loads(c.redis_conn.get(worker_pool_key_prefix + c.hostname))
+
+
+def test_autoscale_grow(context):
+    # No waiting job
+    context.autoscale()
+    assert len(context.jobs_worker_processes) == 1
+
+    # A worker is idle
+    context.jobs_queues[0].count = 10
+    context.idle.add('worker_0')
+    context.autoscale()
+    assert len(context.jobs_worker_processes) == 1
+
+    # All the workers are busy: one more at each pass, up to the cpus of the host
+    context.idle.clear()
+    for _ in range(6):
+        context.autoscale()
+    assert len(context.jobs_worker_processes) == 4
+    assert pool_stats(context) == {'queue_depth': 10, 'num_workers': 4, 'num_busy_workers': 4, 'max_workers': 4}
+
+
+def test_autoscale_reserved_cpus(context):
+    # A job placed on this host reserved 3 cpus: one cpu is left for another worker
+    context.redis_conn.hset(reservations_key_prefix + context.hostname, 'job', json.dumps({'cpus': 3}))
+    context.jobs_queues[0].count = 10
+    for _ in range(3):
+        context.autoscale()
+    assert len(context.jobs_worker_processes) == 2
+
+
+def test_autoscale_shrink(context):
+    context.jobs_queues[0].count = 10
+    for _ in range(2):
+        context.autoscale()
+    assert list(context.jobs_worker_processes) == ['worker_0', 'worker_1', 'worker_2']
+
+    # The extra workers quit when they are idle for too long; the initial one is replaced if it dies
+    context.jobs_queues[0].count = 0
+    for p in context.jobs_worker_processes.values():
+        p.alive = False
+    context.autoscale()
+    assert list(context.jobs_worker_processes) == ['worker_3']
+    assert pool_stats(context)['num_workers'] == 1
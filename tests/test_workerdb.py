@@ -0,0 +1,54 @@
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+
+import pytest
+
+from hypertrainer.workerdb import WorkerDb
+
+
+def _set_statuses(args):
+    db_path, worker_idx = args
+    db = WorkerDb(Path(db_path))
+    for i in range(20):
+        db.set_status(f'{worker_idx}_{i}', 'Running')
+
+
+def test_worker_db():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = WorkerDb(Path(tmpdir) / 'db.sqlite')
+        db.insert_job('a', 123, 'Unknown')
+        with pytest.raises(KeyError):
+            db.insert_job('a', 456, 'Unknown')
+        db.set_status('a', 'Running')
+        db.set_status('b', 'Finished')  # Inserted
+        assert db.get_status('a') == 'Running'
+        assert db.get_status('c') is None
+        assert db.get_jobs() == {'a': {'pid': 123, 'status': 'Running'}, 'b': {'pid': None, 'status': 'Finished'}}
+        assert db.get_jobs(['Running', 'Waiting']).keys() == {'a'}
+
+        assert db.get_jobs(job_ids=['b', 'c']).keys() == {'b'}
+        assert db.get_jobs(job_ids=[]) == {}
+
+        # More ids than the parameters allowed in a query
+        many_ids = [str(i) for i in range(1200)]
+        db.set_statuses(many_ids, 'Waiting')
+        assert db.get_jobs(['Waiting'], job_ids=many_ids + ['a']).keys() == set(many_ids)
+        db.delete_jobs(many_ids)
+
+        db.delete_job('a')
+        assert db.get_jobs().keys() == {'b'}
+        with pytest.raises(KeyError):
+            db.delete_job('a')
+
+        db.set_statuses(['a', 'b'], 'Cancelled')
+        assert db.delete_jobs(['a', 'b', 'c']) == ['c']
+        assert db.get_jobs() == {}
+
+
+def test_worker_db_concurrent():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_path = Path(tmpdir) / 'db.sqlite'
+        with Pool(4) as pool:
+            pool.map(_set_statuses, [(str(db_path), w) for w in range(4)])
+        assert len(WorkerDb(db_path).get_jobs()) == 80  # No lost update
@@ -1,61 +1,156 @@
 #!/usr/bin/env python
 import argparse
+import json
 import socket
+import time
+import uuid
 from multiprocessing import Process
-from typing import List
+from typing import List, Dict
 
 from redis import Redis
-from rq import Connection, Worker
-from rq.worker import StopRequested
+from rq import Connection, Queue, Worker
+from rq.worker import StopRequested, WorkerStatus
 
 
-# Preload libraries
-# TODO import library_that_you_want_preloaded
-from hypertrainer.utils import config_context
+# NOTE: To preload the libraries of the training scripts, enable the fork server in the config (see forkserver.py)
+import hypertrainer.htplatform_worker
+from hypertrainer.htplatform_worker import GpuAwareWorker, capacity_key_prefix, capacity_ttl_secs, queue_num_gpus, \
+    worker_pool_key_prefix, worker_heartbeat_key_prefix, worker_heartbeat_ttl_secs, reservations_key_prefix
+from hypertrainer.resources import read_host_capacity
+from hypertrainer.utils import read_config, GpuLockManager
 
 
 class WorkerContext:
-    def __init__(self, hostname, num_workers=1):
+    supervision_interval_secs = 2
+    idle_cooldown_secs = 60  # The extra workers quit after being idle for this long
+
+    def __init__(self, hostname, num_workers=1, max_workers=None):
+        """If max_workers is given, the pool of workers on the jobs queues is elastic (see autoscale)"""
+
         self.hostname = hostname if hostname is not None else socket.gethostname()
-        with config_context() as config:
-            redis_port = config['ht_platform']['redis_port']
-            self.redis_conn = Redis(port=redis_port)
+        redis_port = read_config()['ht_platform']['redis_port']
+        self.redis_conn = Redis(port=redis_port)
         self.conn = Connection(self.redis_conn)
 
         self.worker_processes: List[Process] = []
+        self.jobs_worker_processes: Dict[str, Process] = {}  # rq worker name -> process
         self.num_workers = num_workers
+        self.gpu_lock_manager = GpuLockManager()
+        self.capacity = read_host_capacity(num_gpus=len(self.gpu_lock_manager.locks))
+        self.max_workers = max_workers
+        if max_workers is not None:
+            self.max_workers = min(max_workers, self.capacity['cpus'])  # Each job uses at least one cpu
+        self.jobs_queues = [Queue(name, connection=self.redis_conn)
+                            for name in GpuAwareWorker.get_queue_names(self.hostname, len(self.gpu_lock_manager.locks))]
+        self._last_pool_stats = None
 
         print('Redis port:', redis_port)
 
     def __enter__(self):
         self.conn.__enter__()
 
-        self.worker_processes.append(Process(target=work, args=(self.hostname,)))  # Worker specific queue
-        self.worker_processes += [Process(target=work, args=('jobs',)) for _ in range(self.num_workers)]
-
+        self.worker_processes.append(Process(target=work, args=(self.hostname, self.hostname)))  # Worker specific queue
         for w in self.worker_processes:
             w.start()
+        for _ in range(self.num_workers):
+            self.start_jobs_worker()
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.conn.__exit__(exc_type, exc_val, exc_tb)
 
-        for w in self.worker_processes:
+        for w in self.worker_processes + list(self.jobs_worker_processes.values()):
             w.terminate()
 
     def wait(self):
-        for w in self.worker_processes:
-            w.join()
-
-
-def work(queue_name):
+        """Supervise the workers until they all exit"""
+
+        # NOTE: No threads in this process, since it forks the workers
+        while any(w.is_alive() for w in self.worker_processes + list(self.jobs_worker_processes.values())):
+            self.publish_heartbeat()
+            self.publish_capacity()
+            if self.max_workers is not None:
+                self.autoscale()
+            time.sleep(self.supervision_interval_secs)
+
+    def publish_heartbeat(self):
+        """Tell the server that the workers of this host are alive (see HtPlatform.handle_lost_jobs)"""
+
+        self.redis_conn.set(worker_heartbeat_key_prefix + self.hostname, 1, ex=worker_heartbeat_ttl_secs)
+
+    def publish_capacity(self):
+        """Report the capacity of this host, for the placement of the jobs (see HtPlatform.place_pending_jobs)"""
+
+        self.redis_conn.set(capacity_key_prefix + self.hostname, json.dumps(self.capacity), ex=capacity_ttl_secs)
+
+    def start_jobs_worker(self, max_idle_time=None):
+        name = f'{self.hostname}.{uuid.uuid4().hex[:8]}'
+        p = Process(target=work, args=(None, self.hostname, name, max_idle_time))
+        p.start()
+        self.jobs_worker_processes[name] = p
+
+    def autoscale(self):
+        """Start a worker on the jobs queues if jobs are waiting and no worker is idle, up to max_workers, and as long
+        as a cpu is left for it (see cpus_committed).
+
+        The workers started in addition to the num_workers initial ones quit by themselves after being idle for
+        idle_cooldown_secs. The stats of the pool are published in Redis (see HtPlatform.get_worker_pools).
+        """
+
+        for name, p in list(self.jobs_worker_processes.items()):
+            if not p.is_alive():
+                del self.jobs_worker_processes[name]  # Idle for too long, or crashed
+        for _ in range(self.num_workers - len(self.jobs_worker_processes)):
+            self.start_jobs_worker()
+
+        # Only count the jobs that can run now
+        num_available_gpus = self.gpu_lock_manager.num_available_gpus()
+        queue_depth = sum(q.count for q in self.jobs_queues if queue_num_gpus(q.name) <= num_available_gpus)
+        states = [self.get_worker_state(name) for name in self.jobs_worker_processes]
+        num_busy = states.count(WorkerStatus.BUSY)
+        num_workers = len(self.jobs_worker_processes)
+        if queue_depth > 0 and num_busy == num_workers and num_workers < self.max_workers \
+                and self.cpus_committed(num_workers) + 1 <= self.capacity['cpus']:
+            self.start_jobs_worker(max_idle_time=self.idle_cooldown_secs)
+            num_workers += 1
+
+        stats = {'queue_depth': queue_depth, 'num_workers': num_workers, 'num_busy_workers': num_busy,
+                 'max_workers': self.max_workers}
+        self.redis_conn.set(worker_pool_key_prefix + self.hostname, json.dumps(stats),
+                            ex=self.supervision_interval_secs * 5)
+        if stats != self._last_pool_stats:
+            print('Worker pool:', ', '.join(f'{k}={v}' for k, v in stats.items()))
+            self._last_pool_stats = stats
+
+    def cpus_committed(self, num_workers: int) -> float:
+        """Cpus used by the workers on the jobs queues: the cpus reserved by the jobs placed on this host (see
+        HtPlatform.place_pending_jobs), which each take a worker, and one cpu per other worker
+        """
+
+        reservations = [json.loads(r) for r in self.redis_conn.hvals(reservations_key_prefix + self.hostname)]
+        return sum(r.get('cpus', 1) for r in reservations) + max(num_workers - len(reservations), 0)
+
+    def get_worker_state(self, name):
+        """State of a worker (see rq WorkerStatus), or None if it is not registered yet"""
+
+        w = Worker.find_by_key(Worker.redis_worker_namespace_prefix + name, connection=self.redis_conn)
+        return None if w is None else w.get_state()
+
+
+def work(queue_name, hostname, name=None, max_idle_time=None):
+    """Work on the specified queue, or on the jobs queues if queue_name is None"""
     # NOTE: Executed in a separate process. This affects print and logging.
 
-    print('Working on queue', queue_name)
-    w = Worker([queue_name])
+    hypertrainer.htplatform_worker.worker_hostname = hostname  # Published with the status of the jobs
+
+    if queue_name is None:
+        w = GpuAwareWorker(name=name)
+    else:
+        w = Worker([queue_name])
+    print('Working on queues', ', '.join(w.queue_names()))
     try:
-        w.work()
+        w.work(max_idle_time=max_idle_time)
     except StopRequested:
         print('StopRequested')
         pass
@@ -69,7 +164,8 @@ def start_worker(**kwargs):
 if __name__ == '__main__':
     ap = argparse.ArgumentParser()
     ap.add_argument('--hostname', type=str)
-    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--workers', type=int, default=1, help='number of workers on the jobs queues')
+    ap.add_argument('--max-workers', type=int, help='autoscale the number of workers, up to this number')
     args = ap.parse_args()
 
-    start_worker(hostname=args.hostname, num_workers=args.workers)
+    start_worker(hostname=args.hostname, num_workers=args.workers, max_workers=args.max_workers)